@@ -0,0 +1,235 @@
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+import numpy as np
+
+from logger import get_logger
+from metrics import RNN_STEPS
+from utils import encode_text, ID2CHAR, sample_from_probs_batch
+
+logger = get_logger(__name__)
+
+
+class GenerationSlot(object):
+    """
+    One pending text generation, with its own row of GRU states in the batch.
+    """
+    def __init__(self, seed: str, length: int, top_n: int, deadline=None, on_text=None, partial=False):
+        self.seed = seed
+        self.length = length
+        self.top_n = top_n
+        self.deadline = deadline
+        self.on_text = on_text
+        self.partial = partial
+        self.stopped = False
+        # An empty seed is fed as the padding char
+        self.encoded = encode_text(seed) if seed else np.zeros(1, dtype=int)
+        self.position = 0
+        self.next_index = 0
+        self.num_generated = 0
+        self.num_steps = 0
+        self.generated = seed
+        self.future = Future()
+
+    def next_input(self):
+        """
+        Char id to feed on the next step: the seed chars first, then the last sampled char.
+        """
+        self.num_steps += 1
+        if self.position < len(self.encoded):
+            index = self.encoded[self.position]
+            self.position += 1
+            return index
+        return self.next_index
+
+    def is_generating(self):
+        """
+        Whether the whole seed has been fed, so the model output is the distribution of the next char.
+        """
+        return self.position >= len(self.encoded)
+
+    def consume(self, next_index):
+        """
+        Append a sampled char, with the same stopping rules as rnn.generate_text(), and pass it on to on_text.
+        Returns:
+            True if the generation is finished, or was stopped by on_text returning False.
+        """
+        self.next_index = next_index
+        self.num_generated += 1
+        char = ID2CHAR[self.next_index]
+        if char == "\n":
+            return True
+        self.generated += char
+        if self.on_text is not None and self.on_text(char) is False:
+            self.stopped = True
+        return self.stopped or char in [".", "!", "?"] or self.num_generated >= self.length
+
+
+class BatchScheduler(object):
+    """
+    Collects RNN text generations from concurrent requests and steps them together as one batch.
+    A worker thread waits up to window seconds after the first pending generation for others to arrive, then
+    advances every generation in the batch by one char per model step.  Each generation keeps its own row of
+    GRU states, joins the batch as soon as there is room, and drops out as soon as it is finished.
+    If a StateCache is given, a generation resumes from the cached states of the longest prefix of its seed,
+    and the states after consuming each seed are cached in turn.
+    The duration of a batch step is tracked as a moving average in step_seconds, so that callers with a latency
+    budget can bound the number of chars they ask for.
+    The model must provide zero_states() and step(), like NumpyGRU.
+    """
+    def __init__(self, model, window=0.002, max_batch_size=32, length=512, top_n=2, state_cache=None):
+        self.model = model
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.length = length
+        self.top_n = top_n
+        self.state_cache = state_cache
+        self.step_seconds = None
+        self._pending = queue.Queue()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the worker thread once the generations in flight are finished.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, seed: str, length=None, top_n=None, deadline=None, on_text=None, partial=False):
+        """
+        Queue a text generation from a seed.
+        Args:
+            seed (str): the prefix to complete.
+            length (int): maximum number of chars to generate, defaults to the scheduler's length.
+            top_n (int): number of most likely chars to sample from, defaults to the scheduler's top_n.
+            deadline (float): time.monotonic() value after which the generation is abandoned.
+            on_text (callable): called from the worker thread with each generated char, except the newline ending
+                a generation; the generation stops early if it returns False.
+            partial (bool): if True, a generation still running at its deadline resolves to the text generated so
+                far instead of failing.
+        Returns:
+            concurrent.futures.Future resolving to the generated text, seed included,
+            or failing with TimeoutError once the deadline has passed, unless partial is True.
+        """
+        slot = GenerationSlot(seed, length or self.length, top_n or self.top_n, deadline, on_text, partial)
+        self._pending.put(slot)
+        return slot.future
+
+    def _admit(self, slots, block):
+        """
+        Move pending generations into the batch, up to max_batch_size.
+        If block is True, wait for a first generation, then for the batching window to collect more.
+        """
+        deadline = None
+        while len(slots) < self.max_batch_size:
+            try:
+                if block and not slots:
+                    slot = self._pending.get(timeout=0.1)
+                    deadline = time.monotonic() + self.window
+                elif deadline is not None and time.monotonic() < deadline:
+                    slot = self._pending.get(timeout=deadline - time.monotonic())
+                else:
+                    slot = self._pending.get_nowait()
+            except queue.Empty:
+                if block and not slots and self._running:
+                    continue
+                break
+
+            # Skip generations whose requests went away while queued
+            if slot.future.set_running_or_notify_cancel():
+                slots.append(slot)
+
+    def _resume(self, slot, states):
+        """
+        Start a generation from the cached states of the longest prefix of its seed, leaving at least one seed
+        char to feed so the model outputs the distribution of the first generated char.
+        """
+        length, cached_states = self.state_cache.longest_prefix(slot.seed[:-1])
+        if cached_states is not None:
+            states[...] = cached_states
+            slot.position = length
+
+    def _run(self):
+        slots = []
+        states = self.model.zero_states(0)
+
+        while self._running or slots or not self._pending.empty():
+            num_active = len(slots)
+            self._admit(slots, block=not slots)
+            if not slots:
+                continue
+            if len(slots) > num_active:
+                logger.debug("batch of %s generations, %s joined.", len(slots), len(slots) - num_active)
+                new_states = self.model.zero_states(len(slots) - num_active)
+                if self.state_cache is not None:
+                    for i, slot in enumerate(slots[num_active:]):
+                        self._resume(slot, new_states[:, i])
+                states = np.concatenate([states, new_states], axis=1)
+
+            indices = np.array([slot.next_input() for slot in slots])
+            step_start = time.monotonic()
+            try:
+                probs = self.model.step(indices, states)
+            except Exception as e:
+                logger.exception(e)
+                for slot in slots:
+                    slot.future.set_exception(e)
+                slots = []
+                states = self.model.zero_states(0)
+                continue
+            step_seconds = time.monotonic() - step_start
+            if self.step_seconds is None:
+                self.step_seconds = step_seconds
+            else:
+                self.step_seconds += 0.1 * (step_seconds - self.step_seconds)
+
+            # Sample the next char of every generation past its seed, grouped by top_n
+            sampled = {}
+            generating = [i for i, slot in enumerate(slots) if slot.is_generating()]
+            if self.state_cache is not None:
+                for i in generating:
+                    if slots[i].num_generated == 0:
+                        self.state_cache.put(slots[i].seed, states[:, i])
+            for top_n in set(slots[i].top_n for i in generating):
+                rows = [i for i in generating if slots[i].top_n == top_n]
+                sampled.update(zip(rows, sample_from_probs_batch(probs[rows], top_n)))
+
+            # Finished and expired generations drop out of the batch, along with their states
+            now = time.monotonic()
+            keep = []
+            for i, slot in enumerate(slots):
+                try:
+                    finished = i in sampled and slot.consume(sampled[i])
+                except Exception as e:
+                    # A failing on_text, e.g. for a closed event loop, only fails its own generation
+                    logger.exception(e)
+                    slot.future.set_exception(e)
+                    continue
+                if finished:
+                    slot.future.set_result(slot.generated)
+                elif slot.deadline is not None and now > slot.deadline:
+                    if slot.partial:
+                        slot.future.set_result(slot.generated)
+                    else:
+                        slot.future.set_exception(TimeoutError("generation deadline exceeded"))
+                else:
+                    keep.append(i)
+            if len(keep) < len(slots):
+                for i in set(range(len(slots))) - set(keep):
+                    RNN_STEPS.observe(slots[i].num_steps)
+                slots = [slots[i] for i in keep]
+                states = states[:, keep]
@@ -0,0 +1,105 @@
+import time
+
+import numpy as np
+
+from logger import get_logger
+from utils import encode_text, ID2CHAR
+
+logger = get_logger(__name__)
+
+# Chars that end a completion: kept at the end of the completion, except for the newline
+END_CHARS = (".", "!", "?")
+END_INDICES = set(i for i, char in ID2CHAR.items() if char in END_CHARS)
+NEWLINE_INDEX = [i for i, char in ID2CHAR.items() if char == "\n"][0]
+
+
+def consume_seed(model, seed: str, state_cache=None):
+    """
+    Feed a seed to the model, one char per step.
+    If a StateCache is given, start from the cached states of the longest prefix of the seed, and cache the
+    states after the whole seed.
+    Returns:
+        (GRU states of shape (num_layers, 1, units), next char probabilities of shape (vocab_size,))
+    """
+    encoded = encode_text(seed) if seed else np.zeros(1, dtype=int)
+    states = model.zero_states(1)
+    start = 0
+    if state_cache is not None:
+        start, cached_states = state_cache.longest_prefix(seed[:-1])
+        if cached_states is not None:
+            states[:, 0] = cached_states
+
+    for index in encoded[start:]:
+        probs = model.step(np.array([index]), states)
+    if state_cache is not None:
+        state_cache.put(seed, states[:, 0])
+    return states, probs[0].copy()
+
+
+def beam_search(model, seed: str, n=3, beam_width=None, length=128, deadline=None, state_cache=None):
+    """
+    Generate the n most likely completions of a seed, ranked by log-probability.
+    Each step advances every live beam as one batch, and keeps the beam_width most likely extensions of all beams.
+    A beam is finished at ".", "!" or "?" (kept) or at a newline (dropped), like rnn.generate_text(), and the
+    search stops as soon as no live beam can beat the n best finished ones, since log-probabilities only decrease.
+    Args:
+        model (NumpyGRU): model providing zero_states() and step().
+        seed (str): the prefix to complete.
+        n (int): number of completions to return.
+        beam_width (int): number of live beams kept at each step, defaults to n.
+        length (int): maximum number of chars to generate; live beams are returned as they are after that.
+        deadline (float): time.monotonic() value after which the search stops with the beams found so far.
+        state_cache (StateCache): optional cache of GRU states by prefix.
+    Returns:
+        list of at most n str, seed included, most likely first.
+    """
+    beam_width = beam_width or n
+    states, probs = consume_seed(model, seed, state_cache)
+    log_probs = np.log(np.maximum(probs, 1e-30))[None, :]
+
+    # Live beams: generated text and log-probability, with one row of GRU states each
+    texts = [""]
+    scores = np.zeros(1)
+    finished = []
+
+    for i in range(length):
+        # Score every one-char extension of every beam, and keep the best beam_width of them
+        candidates = (scores[:, None] + log_probs).ravel()
+        best = np.argsort(-candidates)[:beam_width]
+        parents, indices = np.divmod(best, log_probs.shape[1])
+
+        next_texts = []
+        next_rows = []
+        for candidate, parent, index in zip(best, parents, indices):
+            text = texts[parent] + ID2CHAR[index]
+            if index == NEWLINE_INDEX:
+                finished.append((candidates[candidate], texts[parent]))
+            elif index in END_INDICES:
+                finished.append((candidates[candidate], text))
+            else:
+                next_texts.append(text)
+                next_rows.append((candidate, parent, index))
+
+        finished.sort(key=lambda item: -item[0])
+        finished = finished[:n]
+        if not next_rows:
+            texts = []
+            break
+
+        texts = next_texts
+        scores = np.array([candidates[candidate] for candidate, _, _ in next_rows])
+        if len(finished) == n and finished[-1][0] >= scores.max():
+            texts = []
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            logger.info("beam search stopped at deadline.")
+            break
+
+        states = states[:, [parent for _, parent, _ in next_rows]]
+        probs = model.step(np.array([index for _, _, index in next_rows]), states)
+        log_probs = np.log(np.maximum(probs, 1e-30))
+
+    # Beams still live after the length limit or deadline compete with the finished ones
+    finished.extend(zip(scores, texts))
+    finished.sort(key=lambda item: -item[0])
+    return [seed + text for _, text in finished[:n]]
@@ -0,0 +1,374 @@
+# Load test and microbenchmarks of the autocomplete server: a request log or a synthetic keystroke stream is replayed
+# against a running server, and the hot paths are timed in process, with results saved as JSON to compare commits
+
+from argparse import ArgumentParser
+from collections import Counter
+import asyncio
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import numpy as np
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+PERCENTILES = (50, 95, 99)
+
+
+def keystroke_prefixes(sentences, num_sentences=200, seed=0):
+    """
+    Simulate users typing sentences: every prefix of each sampled sentence, one per keystroke, in order.
+    Args:
+        sentences (list): sentences to sample from, e.g. the lines of data/sentences.txt.
+        num_sentences (int): number of sentences typed.
+        seed (int): random seed of the sample, so that runs replay the same stream.
+    Returns:
+        list of str.
+    """
+    sample = random.Random(seed).sample(sentences, min(num_sentences, len(sentences)))
+    return [sentence[:i] for sentence in sample for i in range(1, len(sentence) + 1)]
+
+
+def read_request_log(file_path: str):
+    """
+    Read a request log, one request per line: a JSON object of query args such as {"q": "What is", "mode": "beam"},
+    or a plain prefix.
+    Returns:
+        list of dicts of query args.
+    """
+    requests = []
+    with open(file_path) as file_handler:
+        for line in file_handler:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            requests.append(request if isinstance(request, dict) else {"q": line})
+    return requests
+
+
+def latency_summary(seconds):
+    """
+    Summarize latencies, given in seconds, in milliseconds.
+    Returns:
+        dict of the mean, max and p50, p95 and p99 latencies, empty if there are none.
+    """
+    if len(seconds) == 0:
+        return {}
+    milliseconds = np.asarray(seconds) * 1000.
+    summary = {"p{}".format(p): float(value) for p, value in zip(PERCENTILES, np.percentile(milliseconds, PERCENTILES))}
+    summary.update(mean=float(milliseconds.mean()), max=float(milliseconds.max()))
+    return summary
+
+
+def time_calls(function, inputs, repeat=1):
+    """
+    Time a function called on each input.
+    Args:
+        function (callable): called with each input.
+        inputs (list): the inputs.
+        repeat (int): number of passes over the inputs.
+    Returns:
+        dict of the number of calls and of their latency summary, in microseconds.
+    """
+    seconds = []
+    for _ in range(repeat):
+        for value in inputs:
+            start = time.perf_counter()
+            function(value)
+            seconds.append(time.perf_counter() - start)
+    return dict(calls=len(seconds), **{key + "_us": value * 1000. for key, value in latency_summary(seconds).items()})
+
+
+def time_once(function):
+    """
+    Returns:
+        (result of calling function, seconds it took).
+    """
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+async def replay(url: str, requests, concurrency=16, timeout=10.):
+    """
+    Send GET /autocomplete requests to a running server, concurrency at a time, as fast as it answers them.
+    Args:
+        url (str): base URL of the server.
+        requests (list): dicts of query args.
+        concurrency (int): number of requests in flight.
+        timeout (float): request timeout in seconds.
+    Returns:
+        dict of the throughput, the latency summary in milliseconds, overall and by answering tier, and the counts
+        of statuses and tiers.
+    """
+    from tornado.httpclient import AsyncHTTPClient
+
+    client = AsyncHTTPClient(max_clients=concurrency)
+    pending = iter(requests)
+    latencies = []
+    tier_latencies = {}
+    statuses = Counter()
+
+    async def worker():
+        for args in pending:
+            start = time.monotonic()
+            response = await client.fetch("{}/autocomplete?{}".format(url, urllib.parse.urlencode(args)),
+                                          raise_error=False, request_timeout=timeout)
+            latency = time.monotonic() - start
+            latencies.append(latency)
+            statuses[response.code] += 1
+            if response.code == 200:
+                tier = json.loads(response.body).get("Tier", "unknown")
+                tier_latencies.setdefault(tier, []).append(latency)
+
+    start = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    seconds = time.monotonic() - start
+    client.close()
+
+    return {"requests": len(latencies), "seconds": seconds, "qps": len(latencies) / seconds,
+            "latency_ms": latency_summary(latencies),
+            "tier_latency_ms": {tier: latency_summary(values) for tier, values in tier_latencies.items()},
+            "statuses": {str(code): count for code, count in statuses.items()},
+            "tiers": {tier: len(values) for tier, values in tier_latencies.items()}}
+
+
+def read_sentences(file_path: str):
+    with open(file_path) as file_handler:
+        return [line.rstrip("\n") for line in file_handler if line.strip()]
+
+
+def load_main(args):
+    """
+    Replay a request log, or a keystroke stream typing sentences, against a running server.
+    """
+    if args.log:
+        requests = read_request_log(args.log)
+    else:
+        requests = [{"q": prefix} for prefix in keystroke_prefixes(read_sentences(args.sentences),
+                                                                  num_sentences=args.num_sentences, seed=args.seed)]
+    if args.budget_ms:
+        for request in requests:
+            request.setdefault("budget_ms", args.budget_ms)
+    if args.max_requests:
+        requests = requests[:args.max_requests]
+
+    logger.info("replaying %s requests against %s, %s at a time.", len(requests), args.url, args.concurrency)
+    return asyncio.run(replay(args.url, requests, concurrency=args.concurrency, timeout=args.timeout))
+
+
+def micro_main(args):
+    """
+    Time the trie build and load, trie lookups and completions, and RNN generation per char, in process.
+    """
+    from compact_trie import CompactTrie
+    from trie import Trie
+
+    sentences = read_sentences(args.sentences)
+    prefixes = keystroke_prefixes(sentences, num_sentences=args.num_sentences, seed=args.seed)
+    results = {"prefixes": len(prefixes)}
+
+    # Counts in order of first occurrence, as ingest.count_sentences() returns them
+    counts = dict(Counter(sentences))
+    trie, results["trie_build_s"] = time_once(lambda: Trie.from_counts(counts))
+    if os.path.isfile(args.trie_obj):
+        with open(args.trie_obj, "rb") as file_handler:
+            _, results["trie_unpickle_s"] = time_once(lambda: pickle.load(file_handler))
+    _, results["cache_top_completions_s"] = time_once(lambda: trie.cache_top_completions(k=args.top_k))
+    compact_trie, results["compact_trie_build_s"] = time_once(lambda: CompactTrie.from_trie(trie))
+    if os.path.isfile(args.trie_bin):
+        mapped_trie, results["compact_trie_mmap_s"] = time_once(lambda: CompactTrie.load(args.trie_bin))
+        mapped_trie.close()
+
+    nodes = [node for contains, node in (trie.contains(trie.root, prefix) for prefix in prefixes) if contains]
+    results["trie_hit_rate"] = len(nodes) / len(prefixes)
+    results["contains"] = time_calls(lambda prefix: trie.contains(trie.root, prefix), prefixes)
+    results["compact_contains"] = time_calls(lambda prefix: compact_trie.contains(compact_trie.root, prefix), prefixes)
+    # Enumerating every sentence below a node is slow near the root, so it is timed on a sample of the nodes
+    sample = random.Random(args.seed).sample(nodes, min(len(nodes), args.num_enumerated))
+    results["return_completions_from_node"] = time_calls(trie.return_completions_from_node, sample)
+    results["top_completions"] = time_calls(lambda node: trie.top_completions(node, n=3), nodes)
+
+    if args.checkpoint_path:
+        results.update(generation_benchmarks(args, sentences))
+    return results
+
+
+def generation_benchmarks(args, sentences):
+    """
+    Time the RNN(GRU) generation per char: a single generation at a time, and a full batch of them.
+    """
+    seeds = [sentence[:len(sentence) // 2] for sentence in random.Random(args.seed).sample(sentences, args.generations)]
+    results = {}
+
+    if args.inference_engine == "keras":
+        from keras.models import load_model
+        from rnn import build_inference_model, generate_text
+
+        # The training model is stateful with a fixed batch shape, so it is rebuilt for one char at a time
+        training_model = load_model(args.checkpoint_path, compile=False)
+        model = build_inference_model(training_model)
+        model.set_weights(training_model.get_weights())
+        start = time.perf_counter()
+        num_chars = sum(len(generate_text(model, seed, length=args.length)) - len(seed) for seed in seeds)
+        results["generate_text_per_char_ms"] = (time.perf_counter() - start) * 1000. / max(1, num_chars)
+        return results
+
+    from batching import BatchScheduler
+    from numpy_gru import NumpyGRU
+
+    model = NumpyGRU.from_checkpoint(args.checkpoint_path)
+    for batch_size in (1, args.max_batch_size):
+        states = model.zero_states(batch_size)
+        indices = np.zeros(batch_size, dtype=int)
+        results["step_batch_{}".format(batch_size)] = time_calls(lambda _: model.step(indices, states), range(1000))
+
+    # Generations of a BatchScheduler, one at a time, then all at once, in chars generated per second
+    scheduler = BatchScheduler(model, window=0., max_batch_size=args.max_batch_size, length=args.length).start()
+    try:
+        start = time.perf_counter()
+        num_chars = sum(len(scheduler.submit(seed).result()) - len(seed) for seed in seeds)
+        results["generate_per_char_ms"] = (time.perf_counter() - start) * 1000. / max(1, num_chars)
+        start = time.perf_counter()
+        futures = [scheduler.submit(seed) for seed in seeds]
+        num_chars = sum(len(future.result()) - len(seed) for seed, future in zip(seeds, futures))
+        results["batched_generate_per_char_ms"] = (time.perf_counter() - start) * 1000. / max(1, num_chars)
+    finally:
+        scheduler.stop()
+    return results
+
+
+def compare_main(args):
+    """
+    Compare two results files: the relative change of every number from the baseline to the candidate.
+    """
+    with open(args.baseline) as file_handler:
+        baseline = json.load(file_handler)
+    with open(args.candidate) as file_handler:
+        candidate = json.load(file_handler)
+    return {"baseline": baseline.get("commit"), "candidate": candidate.get("commit"),
+            "changes": compare_results(baseline["results"], candidate["results"])}
+
+
+def compare_results(baseline, candidate):
+    """
+    Returns:
+        dict with the same nesting as the results, of the candidate / baseline ratios of the numbers in both.
+    """
+    changes = {}
+    for key, value in candidate.items():
+        if isinstance(value, dict) and isinstance(baseline.get(key), dict):
+            changes[key] = compare_results(baseline[key], value)
+        elif isinstance(value, (int, float)) and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+            changes[key] = value / baseline[key]
+    return changes
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def is_saved_model(file_path: str):
+    """
+    Whether a checkpoint holds a whole Keras model, which load_model() can read, rather than only its weights like
+    data/model_weights.h5.
+    """
+    import h5py
+
+    # Files other than HDF5, such as the .keras archives of Keras 3, are left to load_model()
+    if not h5py.is_hdf5(file_path):
+        return True
+    with h5py.File(file_path, "r") as f:
+        return "model_config" in f.attrs
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Benchmark the autocomplete server.")
+    subparsers = arg_parser.add_subparsers(title="subcommands")
+
+    load_parser = subparsers.add_parser("load", help="replay requests against a running server")
+    load_parser.add_argument("--url", default="http://localhost:13000",
+                             help="base URL of the server (default: %(default)s)")
+    load_parser.add_argument("--log",
+                             help="request log to replay, one JSON object of query args or plain prefix per line; "
+                                  "defaults to a keystroke stream typing sentences of --sentences")
+    load_parser.add_argument("--concurrency", type=int, default=16,
+                             help="number of requests in flight (default: %(default)s)")
+    load_parser.add_argument("--max-requests", type=int, default=0,
+                             help="number of requests replayed, 0 for all (default: %(default)s)")
+    load_parser.add_argument("--budget-ms", type=float, default=0.,
+                             help="latency budget of the requests without one, 0 for the server default "
+                                  "(default: %(default)s)")
+    load_parser.add_argument("--timeout", type=float, default=10.,
+                             help="request timeout in seconds (default: %(default)s)")
+    load_parser.set_defaults(main=load_main)
+
+    micro_parser = subparsers.add_parser("micro", help="time the trie and RNN hot paths in process")
+    micro_parser.add_argument("--trie-obj", default="data/trie.obj",
+                              help="pickled trie whose load is timed, if it exists (default: %(default)s)")
+    micro_parser.add_argument("--trie-bin", default="data/trie.bin",
+                              help="compact trie file whose mmap is timed, if it exists (default: %(default)s)")
+    micro_parser.add_argument("--top-k", type=int, default=3,
+                              help="number of completions cached on every trie node (default: %(default)s)")
+    micro_parser.add_argument("--num-enumerated", type=int, default=200,
+                              help="number of trie nodes whose sentences are all enumerated (default: %(default)s)")
+    micro_parser.add_argument("--checkpoint-path",
+                              help="RNN(GRU) model checkpoint whose generation is timed, e.g. data/model_weights.h5")
+    micro_parser.add_argument("--inference-engine", choices=("numpy", "keras"), default="numpy",
+                              help="numpy times NumpyGRU steps and batched generations, keras times "
+                                   "rnn.generate_text() (default: %(default)s)")
+    micro_parser.add_argument("--generations", type=int, default=32,
+                              help="number of RNN generations timed (default: %(default)s)")
+    micro_parser.add_argument("--length", type=int, default=128,
+                              help="maximum number of chars per generation (default: %(default)s)")
+    micro_parser.add_argument("--max-batch-size", type=int, default=32,
+                              help="batch size of the batched step and generations (default: %(default)s)")
+    micro_parser.set_defaults(main=micro_main)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("baseline", help="results file of the baseline, e.g. of the previous commit")
+    compare_parser.add_argument("candidate", help="results file of the candidate")
+    compare_parser.set_defaults(main=compare_main)
+
+    for parser in (load_parser, micro_parser):
+        parser.add_argument("--sentences", default="data/sentences.txt",
+                            help="sentences typed by the synthetic keystroke stream (default: %(default)s)")
+        parser.add_argument("--num-sentences", type=int, default=200,
+                            help="number of sentences typed (default: %(default)s)")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="random seed of the sentences typed (default: %(default)s)")
+        parser.add_argument("--output", help="path of the JSON results, printed if not given")
+
+    args = arg_parser.parse_args()
+    if not hasattr(args, "main"):
+        arg_parser.error("a subcommand is required")
+    if getattr(args, "inference_engine", None) == "keras" and args.checkpoint_path and \
+            not is_saved_model(args.checkpoint_path):
+        arg_parser.error("--inference-engine keras requires a model saved by rnn.py train, not a weights file")
+
+    results = args.main(args)
+    if args.main is not compare_main:
+        results = {"benchmark": sys.argv[1], "commit": current_commit(), "timestamp": time.time(),
+                   "args": {key: value for key, value in vars(args).items() if key != "main"}, "results": results}
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if getattr(args, "output", None):
+        with open(args.output, "w") as file_handler:
+            file_handler.write(output + "\n")
+        logger.info("saved %s results to %s.", sys.argv[1], args.output)
+    else:
+        print(output)
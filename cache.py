@@ -0,0 +1,197 @@
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+class StateCache(object):
+    """
+    LRU cache mapping a prefix to the GRU states of the model after consuming it, bounded by memory.
+    Autocomplete traffic arrives as growing prefixes ("W", "Wh", "Wha", ...), so a generation for a prefix can
+    resume from the cached states of the longest prefix of it seen before, instead of feeding the whole seed.
+    """
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def entry_size(prefix: str, states):
+        return sys.getsizeof(prefix) + states.nbytes
+
+    def longest_prefix(self, text: str):
+        """
+        Find the longest cached prefix of a text.
+        Args:
+            text (str): the text to look up.
+        Returns:
+            (length of the prefix, copy of its states of shape (num_layers, units)), or (0, None) if none is cached.
+        """
+        with self._lock:
+            for end in range(len(text), 0, -1):
+                states = self._entries.get(text[:end])
+                if states is not None:
+                    self._entries.move_to_end(text[:end])
+                    self.hits += 1
+                    return end, states.copy()
+            self.misses += 1
+            return 0, None
+
+    def put(self, prefix: str, states):
+        """
+        Cache the states after consuming a prefix, evicting the least recently used entries beyond max_bytes.
+        Args:
+            prefix (str): the consumed prefix.
+            states (array): GRU states of shape (num_layers, units), copied into the cache.
+        """
+        if not prefix:
+            return
+        states = np.array(states, dtype=np.float32)
+        size = self.entry_size(prefix, states)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(prefix, None)
+            if previous is not None:
+                self.num_bytes -= self.entry_size(prefix, previous)
+            self._entries[prefix] = states
+            self.num_bytes += size
+
+            while self.num_bytes > self.max_bytes:
+                evicted_prefix, evicted_states = self._entries.popitem(last=False)
+                self.num_bytes -= self.entry_size(evicted_prefix, evicted_states)
+
+    def clear(self):
+        """
+        Drop all entries, e.g. when the model weights change.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict of cache counters.
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.num_bytes}
+
+
+class ResponseCache(object):
+    """
+    LRU cache of final autocomplete responses, keyed by (prefix, n, mode), bounded by entry count and memory.
+    Entries expire ttl seconds after they were cached, if ttl is given.
+    Responses depend on the trie and model that computed them, so every lookup passes them as sources, and the
+    cache is cleared as soon as they are not the same objects as for the previous lookup, e.g. after a reload.
+    """
+    def __init__(self, max_entries=10000, max_bytes=32 * 2 ** 20, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._sources = ()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def entry_size(key, response):
+        return sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key) + ResponseCache.response_size(response)
+
+    @staticmethod
+    def response_size(response):
+        """
+        Size of a response made of str, lists and tuples, such as a (completions, tier) pair.
+        """
+        if isinstance(response, (list, tuple)):
+            return sys.getsizeof(response) + sum(ResponseCache.response_size(part) for part in response)
+        return sys.getsizeof(response)
+
+    def _same_sources(self, sources):
+        return len(sources) == len(self._sources) and all(a is b for a, b in zip(sources, self._sources))
+
+    def _check_sources(self, sources):
+        if not self._same_sources(sources):
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.num_bytes = 0
+            self._sources = tuple(sources)
+
+    def get(self, key, sources=()):
+        """
+        Look up a cached response.
+        Args:
+            key (tuple): (prefix, n, mode).
+            sources (tuple): the objects the response is computed from, e.g. (trie, model).
+        Returns:
+            the cached response, or None.
+        """
+        with self._lock:
+            self._check_sources(sources)
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, response, sources=()):
+        """
+        Cache a response, evicting the least recently used entries beyond max_entries or max_bytes.
+        Responses computed from sources that have been replaced since the lookup are not cached.
+        """
+        size = self.entry_size(key, response)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            if not self._same_sources(sources):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (response, expiry, size)
+            self.num_bytes += size
+
+            while len(self._entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.num_bytes -= size
+
+    def clear(self):
+        """
+        Drop all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict of cache counters.
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.num_bytes,
+                "evictions": self.evictions, "invalidations": self.invalidations}
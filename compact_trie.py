@@ -0,0 +1,308 @@
+# Compact, array-backed alternative to the TrieNode/Trie object graph
+
+from array import array
+from bisect import bisect_left
+import heapq
+import mmap
+import os
+import struct
+import sys
+
+# On-disk format: header (magic, format version, number of nodes), then the first_child, chars, counts,
+# max_counts and ranks arrays, each stored as little-endian uint32
+FILE_MAGIC = b"ACTRIE\x00\x00"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<8sII")
+ARRAY_NAMES = ("first_child", "chars", "counts", "max_counts", "ranks")
+
+
+class CompactTrie(object):
+    """
+    A read-only trie stored as flat arrays instead of one Python object per character.
+    Nodes are integers numbered in breadth-first order, so the children of a node are a contiguous run of
+    node ids, sorted by character, and a child is found by binary search in O(log(alphabet)).
+    Per node, the arrays hold:
+        first_child: id of the first child; children of node i are first_child[i]..first_child[i + 1] - 1.
+        chars: code point of the character leading to the node.
+        counts: number of times the sentence ending at the node was added, 0 if no sentence ends there.
+        max_counts: largest count in the subtree rooted at the node.
+        ranks: preorder index of the node in the source Trie, used to break ties in insertion order.
+    Exposes the same contains / return_completions_from_node / top_completions interface as Trie.
+    Arrays can be array.array objects, or memoryviews into a memory-mapped file opened with load().
+    """
+    def __init__(self, first_child, chars, counts, max_counts, ranks, mapped_file=None):
+        self.first_child = first_child
+        self.chars = chars
+        self.counts = counts
+        self.max_counts = max_counts
+        self.ranks = ranks
+        self.root = 0
+        # Completions are not cached per node, the best-first search is used for every lookup
+        self.top_k = 0
+        # Keeps the memory map alive for as long as the arrays point into it
+        self._mapped_file = mapped_file
+
+    def save(self, file_path: str):
+        """
+        Write the trie to a binary file that load() can memory-map.
+        The file is written next to its destination and renamed into place, so readers never see a partial file.
+        Args:
+            file_path (str): path of file to be written.
+        """
+        temp_file_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(temp_file_path, "wb") as file_handler:
+            file_handler.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, len(self)))
+            for name in ARRAY_NAMES:
+                values = array("I", getattr(self, name))
+                if sys.byteorder != "little":
+                    values.byteswap()
+                values.tofile(file_handler)
+        os.replace(temp_file_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Open a trie written by save() with mmap, and query it in place without deserializing it.
+        Pages are read lazily and shared between all processes that map the same file.
+        Args:
+            file_path (str): path of file to be read.
+        Returns:
+            CompactTrie object.
+        Raises:
+            ValueError if the file is not a trie file of the current format version.
+        """
+        if sys.byteorder != "little" or array("I").itemsize != 4:
+            raise ValueError("Memory-mapped tries require little-endian 32-bit unsigned ints")
+
+        with open(file_path, "rb") as file_handler:
+            mapped_file = mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(mapped_file) < FILE_HEADER.size:
+            raise ValueError("{} is not a trie file".format(file_path))
+        magic, version, num_nodes = FILE_HEADER.unpack_from(mapped_file)
+        if magic != FILE_MAGIC:
+            raise ValueError("{} is not a trie file".format(file_path))
+        if version != FILE_VERSION:
+            raise ValueError("{} has trie format version {}, expected {}".format(file_path, version, FILE_VERSION))
+
+        # first_child has one more entry than there are nodes
+        lengths = (num_nodes + 1,) + (num_nodes,) * (len(ARRAY_NAMES) - 1)
+        if len(mapped_file) != FILE_HEADER.size + 4 * sum(lengths):
+            raise ValueError("{} is truncated or corrupt".format(file_path))
+
+        view = memoryview(mapped_file)
+        arrays = []
+        offset = FILE_HEADER.size
+        for length in lengths:
+            arrays.append(view[offset:offset + 4 * length].cast("I"))
+            offset += 4 * length
+
+        return cls(*arrays, mapped_file=mapped_file)
+
+    def close(self):
+        """
+        Release the memory map of a trie opened with load().  The trie can no longer be queried afterwards.
+        """
+        if self._mapped_file is None:
+            return
+        for name in ARRAY_NAMES:
+            getattr(self, name).release()
+        self._mapped_file.close()
+        self._mapped_file = None
+
+    @classmethod
+    def from_trie(cls, trie):
+        """
+        Build a CompactTrie from a Trie of TrieNode objects.
+        Args:
+            trie (Trie): the trie to convert.
+        Returns:
+            CompactTrie object.
+        """
+        # Preorder ranks of the source trie, so that ties are ranked in insertion order like the Trie
+        ranks_by_node = {}
+        stack = [trie.root]
+        while stack:
+            node = stack.pop()
+            ranks_by_node[id(node)] = len(ranks_by_node)
+            stack.extend(reversed(node.children))
+
+        first_child = array("I")
+        chars = array("I")
+        counts = array("I")
+        max_counts = array("I")
+        ranks = array("I")
+
+        # Breadth-first numbering: node ids are assigned in the order nodes are appended to the queue
+        queue = [trie.root]
+        next_id = 1
+        for node in queue:
+            first_child.append(next_id)
+            chars.append(ord(node.char) if node.char else 0)
+            counts.append(node.count if node.is_end_of_sentence else 0)
+            max_counts.append(node.max_count)
+            ranks.append(ranks_by_node[id(node)])
+
+            children = sorted(node.children, key=lambda child: child.char)
+            queue.extend(children)
+            next_id += len(children)
+
+        first_child.append(next_id)
+        return cls(first_child, chars, counts, max_counts, ranks)
+
+    def __len__(self):
+        return len(self.chars)
+
+    def child(self, node: int, character: str):
+        """
+        Find the child of a node for a given character.
+        Args:
+            node (int): id of the parent node.
+            character (str): character leading to the child.
+        Returns:
+            id of the child node, or -1 if the node has no such child.
+        """
+        start = self.first_child[node]
+        end = self.first_child[node + 1]
+        code = ord(character)
+        index = bisect_left(self.chars, code, start, end)
+        if index < end and self.chars[index] == code:
+            return index
+        return -1
+
+    def iter_children(self, node: int):
+        """
+        Iterate over the (character, child id) pairs of a node.
+        """
+        for child in range(self.first_child[node], self.first_child[node + 1]):
+            yield chr(self.chars[child]), child
+
+    def max_count(self, node: int):
+        """
+        Return the largest count of a sentence ending at or below a node.
+        """
+        return self.max_counts[node]
+
+    def count(self, node: int):
+        """
+        Return the number of times the sentence ending at a node was added, 0 if no sentence ends there.
+        """
+        return self.counts[node]
+
+    def contains(self, root: int, sentence: str):
+        """
+        Check if a given sentence exists in the trie, starting at the given node.
+        Args:
+            root (int): node at which to begin checking for existence of sentence.
+            sentence (str): string to check for existence in the trie.
+        Returns:
+            (bool, int)
+            (True, last node visited) if a sentence exists in the trie, starting at a given node.
+            (False, None) otherwise.
+        """
+        node = root
+        for character in sentence:
+            node = self.child(node, character)
+            if node < 0:
+                return (False, None)
+        return (True, node)
+
+    def contains_many(self, root: int, sentences):
+        """
+        Look up many sentences at once, starting at the given node.
+        Sentences are walked in sorted order, so the walk down to the common prefix of consecutive sentences is
+        shared instead of repeated.
+        Args:
+            root (int): node at which to begin checking for existence of the sentences.
+            sentences (list): strings to check for existence in the trie.
+        Returns:
+            list of the last node visited for each sentence, in the order of sentences, None where a sentence
+            does not exist in the trie.
+        """
+        nodes = [None] * len(sentences)
+        # path[i] is the node reached after the first i chars of the previous sentence
+        path = [root]
+        previous = ""
+        for index in sorted(range(len(sentences)), key=sentences.__getitem__):
+            sentence = sentences[index]
+            common = min(len(os.path.commonprefix([previous, sentence])), len(path) - 1)
+            del path[common + 1:]
+            node = path[-1]
+            for character in sentence[common:]:
+                node = self.child(node, character)
+                if node < 0:
+                    node = None
+                    break
+                path.append(node)
+            nodes[index] = node
+            previous = sentence
+        return nodes
+
+    def return_completions_from_node(self, node: int, prefix=""):
+        """
+        Enumerate all possible sentence completions given a prefix, most frequent first.
+        Args:
+            node (int): the node at which to begin our search for possible completions.
+            prefix (str): the prefix for which completions are enumerated.
+        Returns:
+            a list of str, where each element is a possible completion of the prefix.
+        """
+        if node is None:
+            return []
+
+        sentences = []
+        stack = [(node, prefix)]
+        while stack:
+            current, text = stack.pop()
+            for character, child in self.iter_children(current):
+                child_text = text + character
+                if self.counts[child]:
+                    sentences.append((-self.counts[child], self.ranks[child], child_text))
+                stack.append((child, child_text))
+
+        sentences.sort()
+        return [sentence for _, _, sentence in sentences]
+
+    def search_completions(self, node: int, prefix="", n=3):
+        """
+        Best-first search for the n most frequent completions given a prefix.
+        Args:
+            node (int): the node at which to begin our search for possible completions.
+            prefix (str): the prefix for which completions are returned.
+            n (int): number of completions to return.
+        Returns:
+            a list of at most n str, in the same order as return_completions_from_node().
+        """
+        if node is None:
+            return []
+
+        # Heap entries: (-count, rank, kind, text, node).  A node's rank is smaller than the ranks of its
+        # descendants, so a subtree (kind 0) is always popped before any sentence (kind 1) inside it.
+        completions = []
+        heap = [(-self.max_counts[node], self.ranks[node], 0, prefix, node)]
+        while heap and len(completions) < n:
+            _, _, kind, text, current = heapq.heappop(heap)
+            if kind == 1:
+                completions.append(text)
+                continue
+
+            for character, child in self.iter_children(current):
+                child_text = text + character
+                if self.counts[child]:
+                    heapq.heappush(heap, (-self.counts[child], self.ranks[child], 1, child_text, child))
+                if self.first_child[child] < self.first_child[child + 1]:
+                    heapq.heappush(heap, (-self.max_counts[child], self.ranks[child], 0, child_text, child))
+
+        return completions
+
+    def top_completions(self, node: int, prefix="", n=3):
+        """
+        Return the n most frequent completions of a prefix.
+        Args:
+            node (int): the node reached by following the prefix from the root.
+            prefix (str): the prefix for which completions are returned.
+            n (int): number of completions to return.
+        Returns:
+            a list of at most n str, where each element is a possible completion of the prefix.
+        """
+        return self.search_completions(node, prefix=prefix, n=n)
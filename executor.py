@@ -0,0 +1,167 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from beam_search import beam_search
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Time left to a generation cut by a latency budget for returning its partial text, past its deadline
+PARTIAL_GRACE = 0.02
+
+
+class RNNUnavailableError(Exception):
+    """
+    Raised when an RNN completion cannot be run now, but may be retried shortly.
+    """
+    pass
+
+
+class QueueFullError(RNNUnavailableError):
+    """
+    Raised when an RNN completion is submitted while max_pending completions are already queued or running.
+    """
+    pass
+
+
+class ModelNotReadyError(RNNUnavailableError):
+    """
+    Raised when an RNN completion is submitted before the model is loaded.
+    """
+    pass
+
+
+class RNNExecutor(object):
+    """
+    Runs RNN(GRU) completions off the Tornado IOLoop, so that trie completions never wait behind the model.
+    Completions come in two modes:
+        "sample": a single completion sampled char by char, batched with the concurrent ones by the
+            BatchScheduler of the model.
+        "beam": the n most likely completions found by beam search, on the worker thread.  Requires a model
+            providing step(), like NumpyGRU.
+    At most max_pending completions are queued or running at once; further completions are rejected with
+    QueueFullError.  Each completion is abandoned once its timeout (in seconds) has passed.
+    The model may be None while it is loaded in the background, until swap_model() is called; completions are
+    rejected with ModelNotReadyError meanwhile.
+    A completion may also be given a latency budget (in seconds), which caps its length by the recent step time
+    of the BatchScheduler, and returns the text generated so far once the budget has passed instead of failing.
+    """
+    def __init__(self, model, batch_scheduler=None, max_pending=64, timeout=None, state_cache=None):
+        self.model = model
+        self.batch_scheduler = batch_scheduler
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.state_cache = state_cache
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, prefix: str, deadline=None, mode="sample", n=3, on_text=None, length=None, partial=False):
+        """
+        Queue an RNN completion of a prefix.
+        Args:
+            prefix (str): the prefix to complete.
+            deadline (float): time.monotonic() value after which the generation is abandoned.
+            mode (str): "sample" for a single sampled completion, "beam" for the n most likely completions.
+            n (int): number of completions in beam mode.
+            on_text (callable): in sample mode, called from a worker thread with each generated char; the
+                generation stops early if it returns False.
+            length (int): maximum number of chars to generate, defaults to the generator's own limit.
+            partial (bool): if True, a sampled completion still running at its deadline resolves to the text
+                generated so far instead of failing.  Beam search always does so.
+        Returns:
+            concurrent.futures.Future resolving to the completion, or to a list of completions in beam mode.
+        Raises:
+            QueueFullError if max_pending completions are already queued or running.
+            ModelNotReadyError if the model is not loaded yet.
+            ValueError if the mode is unknown or not supported by the model, or there is no BatchScheduler to
+                sample with.
+        """
+        if mode not in ("sample", "beam"):
+            raise ValueError("Unknown completion mode: {}".format(mode))
+        if self.model is None:
+            raise ModelNotReadyError("The RNN model is not loaded yet")
+        if mode == "beam" and not hasattr(self.model, "step"):
+            raise ValueError("Beam search requires the numpy inference engine")
+        if mode == "sample" and self.batch_scheduler is None:
+            raise ValueError("Sampling requires a BatchScheduler")
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError("{} RNN completions already pending".format(self.max_pending))
+
+        limits = {} if length is None else dict(length=length)
+        try:
+            if mode == "beam":
+                future = self._pool.submit(beam_search, self.model, prefix, n=n, deadline=deadline,
+                                           state_cache=self.state_cache, **limits)
+            else:
+                future = self.batch_scheduler.submit(prefix, deadline=deadline, on_text=on_text, partial=partial,
+                                                     **limits)
+        except Exception:
+            self._slots.release()
+            raise
+
+        # The slot is freed when the generation finishes, fails or is cancelled before it starts
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def max_length(self, seconds: float):
+        """
+        Number of chars the BatchScheduler is expected to generate within a number of seconds, from its recent
+        step time.  Seed chars missing from the StateCache take steps as well, so the deadline still applies.
+        Returns:
+            int, at least 1, or None if no step time has been measured yet.
+        """
+        step_seconds = getattr(self.batch_scheduler, "step_seconds", None)
+        if not step_seconds:
+            return None
+        return max(1, int(seconds / step_seconds))
+
+    async def complete(self, prefix: str, mode="sample", n=3, on_text=None, budget=None):
+        """
+        Complete a prefix with the RNN without blocking the IOLoop.
+        on_text is passed on to submit(), and is called from a worker thread.
+        If a budget (in seconds) is given, the completion is limited to the chars that fit in it, and is returned
+        as generated so far once it has passed, or after the timeout if that comes first.
+        Returns:
+            the completion, or a list of completions in beam mode.
+        Raises:
+            QueueFullError if too many completions are pending.
+            ModelNotReadyError if the model is not loaded yet.
+            ValueError if the mode is unknown or not supported by the model.
+            asyncio.TimeoutError if the completion is not ready before the timeout.
+        """
+        if budget is None:
+            deadline = None if self.timeout is None else time.monotonic() + self.timeout
+            future = asyncio.wrap_future(self.submit(prefix, deadline=deadline, mode=mode, n=n, on_text=on_text))
+            # Cancelling the wrapped future on timeout also cancels completions that have not started yet
+            return await asyncio.wait_for(future, self.timeout)
+
+        budget = budget if self.timeout is None else min(budget, self.timeout)
+        future = asyncio.wrap_future(self.submit(prefix, deadline=time.monotonic() + budget, mode=mode, n=n,
+                                                 on_text=on_text, length=self.max_length(budget), partial=True))
+        # Completions still queued when the budget has passed never started, and time out
+        return await asyncio.wait_for(future, budget + PARTIAL_GRACE)
+
+    def swap_model(self, model, batch_scheduler=None, state_cache=None):
+        """
+        Serve new completions with another model, e.g. reloaded from a new checkpoint.
+        Must be called from the thread submitting completions, so that no completion sees half of the swap.
+        Completions in flight finish on the previous model.
+        Returns:
+            the previous BatchScheduler, to be stopped by the caller once its generations are finished, or None.
+        """
+        previous_scheduler = self.batch_scheduler
+        self.model = model
+        self.batch_scheduler = batch_scheduler
+        self.state_cache = state_cache
+        logger.info("swapped in a new RNN model.")
+        return previous_scheduler
+
+    def shutdown(self):
+        """
+        Stop accepting completions and wait for those in flight.
+        """
+        self._pool.shutdown(wait=True)
+        if self.batch_scheduler is not None:
+            self.batch_scheduler.stop()
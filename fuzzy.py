@@ -0,0 +1,102 @@
+import time
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Typo-tolerant prefix matching: an edit distance row is carried down the trie, so that only the paths within
+# max_distance edits of the prefix are explored
+
+
+def allowed_distance(prefix: str, max_distance=1, chars_per_edit=4):
+    """
+    Number of edits tolerated for a prefix: one per chars_per_edit chars, up to max_distance, so that short
+    prefixes, which are within one edit of too many paths, are only matched exactly.
+    """
+    return min(max_distance, len(prefix) // chars_per_edit)
+
+
+def fuzzy_prefix_nodes(trie, prefix: str, max_distance=1, exact_chars=1, deadline=None, max_nodes=20000):
+    """
+    Find the trie nodes whose path from the root is within max_distance edits of a prefix.
+    Edits are insertions, deletions, substitutions and transpositions of adjacent chars (optimal string alignment
+    distance).  Each node gets the distances between its path and every prefix of the prefix, computed from the
+    row of its parent, and subtrees are pruned as soon as no entry of the row is within max_distance.
+    Args:
+        trie (Trie or CompactTrie): trie providing iter_children() and max_count().
+        prefix (str): the mistyped prefix.
+        max_distance (int): maximum number of edits.
+        exact_chars (int): number of leading chars that must match exactly.  Near the root every path is within
+            a few edits of the prefix, so this prunes most of the search, and typos rarely hit the first char.
+        deadline (float): time.monotonic() value after which the search stops with the nodes found so far.
+        max_nodes (int): maximum number of nodes visited.
+    Returns:
+        list of (distance, path, node), best matches first: fewest edits, then paths closest in length to the
+        prefix, then most frequent sentences below.
+    """
+    columns = len(prefix) + 1
+    # Distances beyond max_distance are capped, as only whether they are within it matters
+    beyond = max_distance + 1
+    matches = []
+    # Stack entries: (node, path, distance row, row of the parent)
+    stack = [(trie.root, "", [min(i, beyond) for i in range(columns)], None)]
+    num_visited = 0
+
+    while stack:
+        node, path, row, parent_row = stack.pop()
+        num_visited += 1
+        if num_visited > max_nodes or (deadline is not None and num_visited % 64 == 0 and time.monotonic() > deadline):
+            logger.info('fuzzy search of "%s" stopped after %s nodes.', prefix, num_visited)
+            break
+
+        # A path of depth chars is more than max_distance edits away from the prefixes of the prefix whose length
+        # differs by more than max_distance, so only the band of the row around depth is computed
+        depth = len(path) + 1
+        low = max(1, depth - max_distance)
+        high = min(columns - 1, depth + max_distance)
+        for char, child in trie.iter_children(node):
+            if depth <= exact_chars and (depth > len(prefix) or char != prefix[depth - 1]):
+                continue
+            child_row = [beyond] * columns
+            child_row[0] = min(depth, beyond)
+            for i in range(low, high + 1):
+                distance = min(child_row[i - 1] + 1, row[i] + 1, row[i - 1] + (prefix[i - 1] != char))
+                if i > 1 and parent_row is not None and prefix[i - 1] == path[-1] and prefix[i - 2] == char:
+                    distance = min(distance, parent_row[i - 2] + 1)
+                child_row[i] = min(distance, beyond)
+
+            child_path = path + char
+            if child_row[-1] <= max_distance:
+                matches.append((child_row[-1], child_path, child))
+            if low <= high and min(child_row[low - 1:high + 1]) <= max_distance:
+                stack.append((child, child_path, child_row, row))
+
+    matches.sort(key=lambda match: (match[0], abs(len(match[1]) - len(prefix)), -trie.max_count(match[2])))
+    return matches
+
+
+def fuzzy_completions(trie, prefix: str, n=3, max_distance=1, exact_chars=1, deadline=None):
+    """
+    Complete a prefix that is not in the trie from the paths within a few edits of it.
+    Args:
+        trie (Trie or CompactTrie): the trie.
+        prefix (str): the prefix, possibly mistyped.
+        n (int): number of completions to return.
+        max_distance (int): maximum number of edits, further limited by allowed_distance().
+        exact_chars (int): number of leading chars that must match exactly.
+        deadline (float): time.monotonic() value after which the search stops with the nodes found so far.
+    Returns:
+        list of at most n str, from the best matching paths first, empty if no path is close enough.
+    """
+    distance = allowed_distance(prefix, max_distance)
+    if distance == 0:
+        return []
+
+    completions = []
+    for _, path, node in fuzzy_prefix_nodes(trie, prefix, distance, exact_chars=exact_chars, deadline=deadline):
+        for completion in trie.top_completions(node, prefix=path, n=n):
+            if completion not in completions:
+                completions.append(completion)
+        if len(completions) >= n:
+            break
+    return completions[:n]
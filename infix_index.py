@@ -0,0 +1,236 @@
+from array import array
+import gc
+import heapq
+from itertools import groupby
+import re
+
+from normalized_index import iter_sentences
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Infix completion: the trie only completes prefixes from the start of a sentence, so text typed from the middle of
+# a sentence, or after a first sentence of a message, is completed from a suffix array of the word starts of every
+# sentence instead
+
+WORD = re.compile(r"\S+")
+
+
+def fold(text: str):
+    """
+    Lowercase a text for matching, unless that changes its length, so that offsets in the folded text are offsets
+    in the text.
+    """
+    folded = text.lower()
+    return folded if len(folded) == len(text) else text
+
+
+def word_starts(text: str):
+    """
+    Return the offsets of the words of a text.
+    """
+    return [match.start() for match in WORD.finditer(text)]
+
+
+def sort_suffixes(entries, texts, window=32):
+    """
+    Sort (text id, offset) entries in place by the text from the offset to its end.
+    Sorting by whole suffixes would hold them all at once, quadratic in the length of each text, so entries are
+    sorted by their first window chars, and only the runs tied on a full window are sorted again by twice as many.
+    Args:
+        entries (list): (text id, offset) pairs.
+        texts (list): the texts, by id.
+        window (int): number of chars compared in the first pass.
+    """
+    stack = [(0, len(entries), window)]
+    while stack:
+        start, end, window = stack.pop()
+
+        def key(entry):
+            return texts[entry[0]][entry[1]:entry[1] + window]
+
+        entries[start:end] = sorted(entries[start:end], key=key)
+        # Suffixes shorter than the window are tied because they are equal, and need no further sorting
+        for suffix, run in groupby(entries[start:end], key=key):
+            length = sum(1 for _ in run)
+            if length > 1 and len(suffix) == window:
+                stack.append((start, start + length, window * 2))
+            start += length
+
+
+class InfixIndex(object):
+    """
+    A suffix array over the word starts of the distinct sentences of a trie: one (sentence id, offset) entry per
+    word, sorted by the case-folded text from the offset to the end of the sentence.
+    The entries whose text starts with a query are a contiguous run, found by binary search, so the index answers
+    a query from any word position in O(len(query) * log(words)), and takes two integers per word of the corpus.
+    """
+    def __init__(self, counts, min_chars=6, max_matches=10000):
+        """
+        Args:
+            counts (dict): maps each distinct sentence to its count, in the order of iter_sentences() for an index
+                built from a trie, which breaks ties between equally frequent sentences as the trie does.
+            min_chars (int): minimum length of the text matched inside a sentence, as very short matches are
+                found in too many sentences to be good completions.
+            max_matches (int): maximum number of matches ranked per query.
+        """
+        self.min_chars = min_chars
+        self.max_matches = max_matches
+        self.sentences = list(counts)
+        self.folded = [fold(sentence) for sentence in self.sentences]
+        self.counts = array("I", counts.values())
+        self.sentence_ids = {sentence: sentence_id for sentence_id, sentence in enumerate(self.sentences)}
+
+        entries = [(sentence_id, offset) for sentence_id, text in enumerate(self.folded)
+                   for offset in word_starts(text)]
+        sort_suffixes(entries, self.folded)
+        self.ids = array("I", (sentence_id for sentence_id, _ in entries))
+        self.offsets = array("I", (offset for _, offset in entries))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_trie(cls, trie, **kwargs):
+        """
+        Build the index of the sentences of a trie, which are the distinct sentences of data/sentences.txt and
+        the sentences added since.
+        Args:
+            trie (Trie or CompactTrie): the trie serving completions.
+            kwargs: passed on to InfixIndex().
+        Returns:
+            InfixIndex object.
+        """
+        # The trie makes every collection slow, and nothing built here is garbage
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            index = cls(dict(iter_sentences(trie)), **kwargs)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        logger.info("indexed %s word starts of %s sentences.", len(index), len(index.sentences))
+        return index
+
+    def _suffix(self, entry: int, length=None):
+        text = self.folded[self.ids[entry]]
+        offset = self.offsets[entry]
+        return text[offset:] if length is None else text[offset:offset + length]
+
+    def find(self, query: str):
+        """
+        Find the entries whose text starts with a folded query.
+        Returns:
+            (start, end) range of the matching entries, empty if there are none.
+        """
+        length = len(query)
+        low, high = 0, len(self.ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self._suffix(middle, length) < query:
+                low = middle + 1
+            else:
+                high = middle
+        start, high = low, len(self.ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self._suffix(middle, length) <= query:
+                low = middle + 1
+            else:
+                high = middle
+        return start, low
+
+    def _bisect(self, suffix: str):
+        """
+        Return the index of the first entry whose text is not less than a folded suffix.
+        """
+        low, high = 0, len(self.ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self._suffix(middle) < suffix:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def add_sentence(self, sentence: str, count=1):
+        """
+        Add a sentence added to the live trie to the index as well, inserting an entry per word.
+        Args:
+            sentence (str): the sentence, as added to the trie.
+            count (int): number of occurrences of the sentence to add.
+        """
+        self.add_sentences([(sentence, count)])
+
+    def add_sentences(self, pairs):
+        """
+        Add sentences added to the live trie to the index as well.
+        The entries of the new sentences are sorted, then merged into the suffix array in one pass, rather than
+        inserted one by one, which would move the entries after each of them.
+        Args:
+            pairs (list): (sentence, count) pairs, as added to the trie.
+        """
+        entries = []
+        for sentence, count in pairs:
+            sentence_id = self.sentence_ids.get(sentence)
+            if sentence_id is not None:
+                self.counts[sentence_id] += count
+                continue
+            sentence_id = len(self.sentences)
+            self.sentence_ids[sentence] = sentence_id
+            self.sentences.append(sentence)
+            self.folded.append(fold(sentence))
+            self.counts.append(count)
+            entries.extend((self.folded[sentence_id][offset:], sentence_id, offset)
+                           for offset in word_starts(self.folded[sentence_id]))
+        if not entries:
+            return
+
+        entries.sort()
+        positions = [self._bisect(suffix) for suffix, _, _ in entries]
+        ids, offsets = array("I"), array("I")
+        previous = 0
+        for position, (_, sentence_id, offset) in zip(positions, entries):
+            ids.extend(self.ids[previous:position])
+            offsets.extend(self.offsets[previous:position])
+            ids.append(sentence_id)
+            offsets.append(offset)
+            previous = position
+        ids.extend(self.ids[previous:])
+        offsets.extend(self.offsets[previous:])
+        self.ids, self.offsets = ids, offsets
+
+    def complete(self, prefix: str, n=3):
+        """
+        Complete the end of a prefix from the sentences containing it at a word start.
+        The longest end of the prefix starting at a word and found in a sentence is completed, so the most typed
+        context is matched: the text typed before it is kept, followed by the rest of the matching sentences.
+        Args:
+            prefix (str): the prefix, as typed.
+            n (int): number of completions to return.
+        Returns:
+            list of at most n str, from the most frequent matching sentences, empty if no end of the prefix of at
+            least min_chars is found in a sentence.
+        """
+        folded = fold(prefix)
+        for start in word_starts(folded):
+            query = folded[start:]
+            if len(query) < self.min_chars:
+                break
+            low, high = self.find(query)
+            if low == high:
+                continue
+
+            # Pop the matches by count, then by sentence id, until n distinct completions are found, as many
+            # sentences share the same ending
+            heap = [(-self.counts[self.ids[entry]], self.ids[entry], self.offsets[entry])
+                    for entry in range(low, min(high, low + self.max_matches))]
+            heapq.heapify(heap)
+            completions = []
+            while heap and len(completions) < n:
+                _, sentence_id, offset = heapq.heappop(heap)
+                completion = prefix[:start] + self.sentences[sentence_id][offset:]
+                if completion not in completions:
+                    completions.append(completion)
+            return completions
+        return []
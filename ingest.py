@@ -0,0 +1,224 @@
+# Streaming ingestion of conversation corpora: the JSON is parsed one issue at a time, messages are split into
+# sentences in a process pool, and distinct sentences are counted, so memory grows with the number of distinct
+# sentences rather than with the size of the corpus
+
+from argparse import ArgumentParser
+from functools import partial
+from itertools import islice
+import json
+import multiprocessing
+import os
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+_nltk_sent_tokenize = None
+
+
+def sent_tokenize(text: str):
+    """
+    Split a text into sentences with NLTK's punkt tokenizer.
+    NLTK is imported and the punkt models are fetched on first use, as only building the trie needs them, and
+    importing NLTK is slow.
+    """
+    global _nltk_sent_tokenize
+    if _nltk_sent_tokenize is None:
+        import nltk
+        nltk.download("punkt")
+        from nltk.tokenize import sent_tokenize as _nltk_sent_tokenize
+    return _nltk_sent_tokenize(text)
+
+
+def iter_json_array(file_handler, key: str, chunk_size=2 ** 20):
+    """
+    Iterate over the elements of the array stored under a key of a JSON document, such as the "Issues" of
+    sample_conversations.json, reading the file chunk_size chars at a time instead of loading the whole document.
+    The first occurrence of the key in the document is used, and the array must hold objects, arrays or strings.
+    Args:
+        file_handler (file): JSON file opened in text mode.
+        key (str): key of the array.
+        chunk_size (int): number of chars read at a time.
+    Yields:
+        the decoded elements of the array.
+    """
+    decoder = json.JSONDecoder()
+    marker = '"{}"'.format(key)
+    buffer = ""
+    eof = False
+
+    def read_more():
+        chunk = file_handler.read(chunk_size)
+        return chunk, not chunk
+
+    # Find the opening bracket of the array
+    while True:
+        chunk, eof = read_more()
+        buffer += chunk
+        start = buffer.find(marker)
+        if start >= 0:
+            bracket = buffer.find("[", start + len(marker))
+            if bracket >= 0:
+                position = bracket + 1
+                break
+        if eof:
+            raise ValueError("No array under key {!r}".format(key))
+
+    while True:
+        # Skip whitespace and commas between elements
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Unterminated array under key {!r}".format(key))
+            chunk, eof = read_more()
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        if buffer[position] == "]":
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # The element continues in the next chunk
+            if eof:
+                raise
+            chunk, eof = read_more()
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield element
+        position = end
+
+
+def iter_messages(file_path: str):
+    """
+    Iterate over the text of every message in a conversations JSON file like data/sample_conversations.json.
+    """
+    with open(file_path) as file_handler:
+        for issue in iter_json_array(file_handler, "Issues"):
+            for message in issue["Messages"]:
+                yield message["Text"]
+
+
+def tokenize_messages(texts, tokenizer=sent_tokenize):
+    """
+    Split messages into the sentences added to the trie: each message, followed by its individual sentences if
+    it has more than one, as in trie.extract_sentences_from_json().
+    Args:
+        texts (list): message texts.
+        tokenizer (callable): splits a text into a list of sentences.
+    Returns:
+        list of str.
+    """
+    sentences = []
+    for text in texts:
+        sentences.append(text)
+        sub_sentences = tokenizer(text)
+        if len(sub_sentences) > 1:
+            sentences.extend(sub_sentences)
+    return sentences
+
+
+def iter_chunks(iterable, size: int):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def count_sentences(file_path: str, processes=None, chunk_size=1000, sentences_file_path=None,
+                    tokenizer=sent_tokenize):
+    """
+    Count the sentences of a conversations JSON file, tokenizing chunks of messages in a process pool while the
+    file is parsed.
+    Args:
+        file_path (str): path of the JSON file.
+        processes (int): number of tokenizing processes, defaults to the number of CPUs; 1 tokenizes in this
+            process.
+        chunk_size (int): number of messages sent to a process at a time.
+        sentences_file_path (str): if given, every sentence is also written to this file, one per line and in
+            corpus order, like trie.save_sentences_to_file().
+        tokenizer (callable): splits a text into a list of sentences; must be picklable with several processes.
+    Returns:
+        dict mapping each distinct sentence to its count, in order of first occurrence.
+    """
+    processes = processes or os.cpu_count()
+    tokenize = partial(tokenize_messages, tokenizer=tokenizer)
+    chunks = iter_chunks(iter_messages(file_path), chunk_size)
+    counts = {}
+    num_sentences = 0
+
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    sentences_file = open(sentences_file_path, "w") if sentences_file_path else None
+    try:
+        # imap() keeps the order of the chunks, so first occurrences are in corpus order
+        tokenized = pool.imap(tokenize, chunks) if pool is not None else map(tokenize, chunks)
+        for sentences in tokenized:
+            for sentence in sentences:
+                counts[sentence] = counts.get(sentence, 0) + 1
+            if sentences_file is not None:
+                sentences_file.writelines(sentence + "\n" for sentence in sentences)
+            num_sentences += len(sentences)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if sentences_file is not None:
+            sentences_file.close()
+
+    logger.info("counted %s sentences, %s distinct, from %s.", num_sentences, len(counts), file_path)
+    return counts
+
+
+def count_sentences_file(file_path: str):
+    """
+    Count the sentences of a file of one sentence per line, such as data/sentences.txt written by count_sentences(),
+    without tokenizing the conversations again.
+    Returns:
+        dict mapping each distinct sentence to its count, in order of first occurrence.
+    """
+    counts = {}
+    with open(file_path) as file_handler:
+        for line in file_handler:
+            sentence = line.rstrip("\n")
+            if sentence:
+                counts[sentence] = counts.get(sentence, 0) + 1
+    logger.info("counted %s distinct sentences from %s.", len(counts), file_path)
+    return counts
+
+
+if __name__ == "__main__":
+    import pickle
+    import sys
+
+    from compact_trie import CompactTrie
+    from trie import Trie
+
+    arg_parser = ArgumentParser(description="Build the prefix trie from a conversations JSON file.")
+    arg_parser.add_argument("--json", default="data/sample_conversations.json",
+                            help="path of the conversations JSON file (default: %(default)s)")
+    arg_parser.add_argument("--processes", type=int, default=0,
+                            help="number of tokenizing processes, 0 for one per CPU (default: %(default)s)")
+    arg_parser.add_argument("--output", default="data/trie.obj",
+                            help="path of the pickled trie (default: %(default)s)")
+    arg_parser.add_argument("--compact-output",
+                            help="also save the trie as a memory-mappable CompactTrie file, e.g. data/trie.bin")
+    arg_parser.add_argument("--sentences",
+                            help="also write every sentence to this text file, e.g. data/sentences.txt")
+    args = arg_parser.parse_args()
+
+    counts = count_sentences(args.json, processes=args.processes, sentences_file_path=args.sentences)
+    trie = Trie.from_counts(counts)
+    del counts
+
+    # Write next to the destination and rename, so that a serving process reloading the trie never reads a
+    # partial file
+    sys.setrecursionlimit(5000)
+    with open(args.output + ".tmp", "wb") as file_handler:
+        pickle.dump(trie, file_handler)
+    os.replace(args.output + ".tmp", args.output)
+    if args.compact_output:
+        CompactTrie.from_trie(trie).save(args.compact_output)
+    logger.info("saved trie to %s.", args.output)
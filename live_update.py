@@ -0,0 +1,130 @@
+import os
+import unicodedata
+
+import tornado.ioloop
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def parse_sentences(sentences):
+    """
+    Check and normalize sentences to add to a live Trie.
+    Args:
+        sentences (list): sentences as str, or as [str, count] pairs.
+    Returns:
+        list of (sentence, count) pairs, without the blank sentences.
+    Raises:
+        ValueError if a sentence or count is malformed.
+    """
+    pairs = []
+    for sentence in sentences:
+        count = 1
+        if isinstance(sentence, (list, tuple)) and len(sentence) == 2:
+            sentence, count = sentence
+        if not isinstance(sentence, str) or not isinstance(count, int) or isinstance(count, bool) or count < 1:
+            raise ValueError("Expected a sentence, or a [sentence, positive count] pair: {!r}".format(sentence))
+        sentence = unicodedata.normalize("NFC", sentence.strip())
+        if sentence:
+            pairs.append((sentence, count))
+    return pairs
+
+
+def ingest_sentences(trie, sentences, indexes=()):
+    """
+    Add new sentences to a live Trie, updating the cached completions along their paths only.
+    Args:
+        trie (Trie): the Trie serving completions.
+        sentences (list): sentences as str, or as [str, count] pairs.
+        indexes (list): the secondary indexes of the Trie, such as NormalizedIndex or InfixIndex, which the sentences
+            are added to as well.
+    Returns:
+        number of sentences added.
+    Raises:
+        ValueError if a sentence or count is malformed, in which case none of the sentences are added.
+    """
+    # The whole batch is parsed before the trie is touched, so a malformed entry adds none of the sentences
+    pairs = parse_sentences(sentences)
+    for sentence, count in pairs:
+        trie.add_sentence(trie.root, sentence, count)
+    for index in indexes:
+        index.add_sentences(pairs)
+    return len(pairs)
+
+
+class SentenceFileWatcher(object):
+    """
+    Follows a text file with one sentence per line, like data/sentences.txt, and passes the lines appended to it
+    to a callback, polling the file from the IOLoop every interval seconds.
+    Lines are only passed on once they end with a newline.  If the file is truncated or replaced, it is read
+    again from the start.  Lines longer than max_bytes are skipped, with a warning.
+    """
+    def __init__(self, file_path: str, callback, interval=1., max_bytes=2 ** 20):
+        self.file_path = file_path
+        self.callback = callback
+        self.max_bytes = max_bytes
+        self.offset = 0
+        # Whether the rest of the current line is skipped, as it is longer than max_bytes
+        self._skipping = False
+        self._inode = None
+        self._periodic_callback = tornado.ioloop.PeriodicCallback(self.poll, interval * 1000)
+
+    def start(self, from_end=True):
+        """
+        Start polling the file.
+        Args:
+            from_end (bool): skip the lines already in the file.
+        """
+        if from_end and os.path.isfile(self.file_path):
+            stat = os.stat(self.file_path)
+            self._inode = stat.st_ino
+            self.offset = stat.st_size
+        self._periodic_callback.start()
+        return self
+
+    def stop(self):
+        self._periodic_callback.stop()
+
+    def poll(self):
+        """
+        Pass on the complete lines appended since the last poll, at most max_bytes of them.
+        """
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._inode or stat.st_size < self.offset:
+            self._inode = stat.st_ino
+            self.offset = 0
+            self._skipping = False
+        if stat.st_size == self.offset:
+            return
+
+        with open(self.file_path, "rb") as file_handler:
+            file_handler.seek(self.offset)
+            data = file_handler.read(self.max_bytes)
+        if self._skipping:
+            newline = data.find(b"\n")
+            self.offset += len(data) if newline < 0 else newline + 1
+            if newline < 0:
+                return
+            data = data[newline + 1:]
+            self._skipping = False
+
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            # Without a newline in a full read, the line would never be passed on, and would stall the watcher
+            if len(data) >= self.max_bytes:
+                logger.warning("skipping a line longer than %s bytes at offset %s of %s.", self.max_bytes,
+                               self.offset, self.file_path)
+                self.offset += len(data)
+                self._skipping = True
+            return
+        self.offset += end
+
+        lines = data[:end].decode("utf8", errors="replace").splitlines()
+        try:
+            self.callback(lines)
+        except Exception as e:
+            logger.exception(e)
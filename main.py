@@ -1,66 +1,880 @@
+import asyncio
+import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
 import tornado.web
+import gc
+import hmac
+import json
 import os
+import sys
+import time
+import unicodedata
+from argparse import ArgumentParser
 import pickle
-from keras.models import load_model
 from trie import Trie, TrieNode, extract_sentences_from_json, save_sentences_to_file, initialize_prefix_trie
-from rnn import generate_text, build_inference_model
+from numpy_gru import NumpyGRU
+from batching import BatchScheduler
+from executor import RNNExecutor, RNNUnavailableError
+from cache import ResponseCache, StateCache
+from prefork import ActiveRequests, Supervisor, shutdown_gracefully
+from live_update import SentenceFileWatcher, ingest_sentences, parse_sentences
+from fuzzy import fuzzy_completions
+from normalized_index import NormalizedIndex
+from infix_index import InfixIndex
+from metrics import (REGISTRY, REQUESTS, COMPLETIONS, REQUEST_SECONDS, EventLoopLagMonitor, cache_metrics,
+                     format_stacks, sample_stacks, slowest_tier)
 from logger import get_logger
 
 logger = get_logger(__name__)
 
 
-class autocomplete_handler(tornado.web.RequestHandler):
+class tracked_handler(tornado.web.RequestHandler):
+    """
+    Counts the requests in flight in the "active_requests" setting, if set, so that a graceful shutdown waits for
+    them to finish before closing their connections.
+    """
+    def prepare(self):
+        self.active_requests = self.settings.get("active_requests")
+        if self.active_requests is not None:
+            self.active_requests.started()
+
+    def on_finish(self):
+        # Requests rejected before prepare(), e.g. with an unsupported method, were never counted
+        active_requests = getattr(self, "active_requests", None)
+        if active_requests is not None:
+            active_requests.finished()
+            self.active_requests = None
+
+
+class autocomplete_handler(tracked_handler):
+    # Label of the endpoint in the request metrics
+    endpoint = "autocomplete"
 
-    def autocomplete(self, trie: Trie, model, prefix: str):
+    def initialize(self, trie: Trie, rnn_executor: RNNExecutor, rnn_mode="sample", response_cache=None,
+                   normalized_index=None, infix_index=None, **models):
         """
-        Check if prefix is in trie. If yes, then autocomplete using trie.  Else, use RNN(GRU) model.
         Args:
             trie (Trie): the Trie object for completing prefixes seen during training.
-            model (Keras model): the RNN(GRU) Keras model for completing novel prefixes.
-        Returns: 
-            list of strings, where each element is a possible completion.
+            rnn_executor (RNNExecutor): runs the RNN(GRU) model for completing novel prefixes off the IOLoop.
+            rnn_mode (str): default RNN completion mode, "sample" or "beam".
+            response_cache (ResponseCache): if given, responses are cached by (prefix, n, mode).
+            normalized_index (NormalizedIndex): if given, completes the prefixes missing from the trie that only
+                differ from its sentences by case, whitespace or punctuation.
+            infix_index (InfixIndex): if given, completes the prefixes missing from the trie whose end is found
+                in the middle of its sentences.
         """
-        # n (int): Number of completions to return from trie
-        n = 3
-        (contains, node) = trie.contains(trie.root, prefix)
+        self.trie = trie
+        self.normalized_index = normalized_index
+        self.infix_index = infix_index
+        self.rnn_executor = rnn_executor
+        self.rnn_mode = rnn_mode
+        self.response_cache = response_cache
+        # Tiers that answered the prefixes of the request, for the metrics
+        self.tiers = []
+
+    def on_finish(self):
+        super(autocomplete_handler, self).on_finish()
+        REQUESTS.inc(self.endpoint, self.get_status())
+        for tier in self.tiers:
+            COMPLETIONS.inc(tier)
+        REQUEST_SECONDS.observe(self.request.request_time(), self.endpoint, slowest_tier(self.tiers))
+
+    def latency_deadline(self, budget_ms=None):
+        """
+        Parse a latency budget in milliseconds, defaulting to --latency-budget-ms.
+        Returns:
+            time.monotonic() value by which the response is due, or None for no budget.
+        """
+        budget = self.settings.get("latency_budget")
+        if budget_ms is not None:
+            try:
+                budget = float(budget_ms) / 1000.
+            except (ValueError, TypeError):
+                raise tornado.web.HTTPError(400, "budget_ms must be a number")
+            if not budget > 0:
+                raise tornado.web.HTTPError(400, "budget_ms must be positive")
+        return None if budget is None else time.monotonic() + budget
+
+    async def autocomplete(self, prefix: str, mode: str, n=3, deadline=None):
+        """
+        Route a prefix through the completion tiers, from the cheapest to the most expensive, within a deadline.
+        Check if prefix is in trie. If yes, then autocomplete using trie.  Else, autocomplete from the trie sentences
+        matching the prefix up to case, whitespace, punctuation or a few typos, or containing the end of the prefix,
+        and failing that, use RNN(GRU) model, generating only as many chars as fit in the time left.
+        Args:
+            prefix (str): the prefix to complete.
+            mode (str): how the RNN(GRU) model completes novel prefixes, "sample" or "beam".
+            n (int): number of completions to return from the trie, or from beam search.
+            deadline (float): time.monotonic() value by which to answer with the best completions found so far,
+                or None to let the RNN(GRU) model finish, up to --rnn-timeout-ms.
+        Returns:
+            (completions, tier) where completions is a list of strings, each a possible completion, or a single
+            sampled string when the RNN(GRU) model completes the prefix in "sample" mode, and tier is the one that
+            answered: "trie", "normalized", "fuzzy", "infix" or "rnn", or "none" if the deadline passed first.
+        """
+        (contains, node) = self.trie.contains(self.trie.root, prefix)
         if contains:
-            return trie.return_completions_from_node(node, prefix=prefix)[:n]
+            return self.trie.top_completions(node, prefix=prefix, n=n), "trie"
+        completions, tier = self.approximate_autocomplete(prefix, n=n, deadline=deadline)
+        if completions:
+            return completions, tier
+        if deadline is not None and time.monotonic() >= deadline:
+            return [], "none"
+        return await self.rnn_autocomplete(prefix, mode, n=n, deadline=deadline), "rnn"
+
+    def approximate_autocomplete(self, prefix: str, n=3, deadline=None):
+        """
+        Autocomplete a prefix missing from the trie from the normalized index, then from the trie paths within a
+        few typos of it, and failing that, from the sentences containing the end of the prefix.
+        Args:
+            deadline (float): time.monotonic() value after which the typo search stops with what it found.
+        Returns:
+            (list of strings, empty if no sentence matches, tier that matched or None).
+        """
+        if self.normalized_index is not None:
+            completions = self.normalized_index.complete(prefix, n=n)
+            if completions:
+                return completions, "normalized"
+        completions = self.fuzzy_autocomplete(prefix, n=n, deadline=deadline)
+        if completions:
+            return completions, "fuzzy"
+        if self.infix_index is not None:
+            completions = self.infix_index.complete(prefix, n=n)
+            if completions:
+                return completions, "infix"
+        return [], None
+
+    def fuzzy_autocomplete(self, prefix: str, n=3, deadline=None):
+        """
+        Autocomplete a prefix missing from the trie from the trie paths within --fuzzy-distance edits of it,
+        searching for at most --fuzzy-budget-ms, and not past a deadline.
+        Returns:
+            list of strings, empty if no path is close enough.
+        """
+        max_distance = self.settings.get("fuzzy_distance", 0)
+        if max_distance <= 0:
+            return []
+        fuzzy_deadline = time.monotonic() + self.settings.get("fuzzy_budget", 0.005)
+        if deadline is not None:
+            fuzzy_deadline = min(fuzzy_deadline, deadline)
+        return fuzzy_completions(self.trie, prefix, n=n, max_distance=max_distance, deadline=fuzzy_deadline)
+
+    async def rnn_autocomplete(self, prefix: str, mode: str, n=3, deadline=None):
+        """
+        Autocomplete a prefix with the RNN(GRU) model, cut short at a deadline if given.
+        """
+        budget = None if deadline is None else max(0., deadline - time.monotonic())
+        if mode == "beam":
+            # Beam search returns as many completions as the trie, ranked by log-probability
+            return await self.rnn_executor.complete(prefix, mode=mode, n=n, budget=budget)
         else:
-            # Returning a single completion because the RNN model is slower than the trie
-            return generate_text(model, prefix)
+            # Returning a single completion because sampling from the RNN model is slower than the trie
+            return await self.rnn_executor.complete(prefix, mode=mode, budget=budget)
 
-    def get(self):
+    async def get(self):
         """
         Parse args from URL and return autocompletions as JSON.
+        The optional "mode" arg picks how the RNN(GRU) model completes novel prefixes: "sample" or "beam".
+        The optional "budget_ms" arg overrides --latency-budget-ms: the response is due within it, with the
+        completions found so far, e.g. a partial RNN(GRU) completion.  The "Tier" of the response tells which
+        tier answered.
+        When the RNN(GRU) model is overloaded, not loaded yet or too slow, respond with no completions instead.
         """
-        args = self.get_arguments("q")[0]
-        response = {"Completions": self.autocomplete(trie, inference_model, args)}
+        args = unicodedata.normalize("NFC", self.get_argument("q"))
+        mode = self.get_argument("mode", self.rnn_mode)
+        deadline = self.latency_deadline(self.get_argument("budget_ms", None))
+        n = 3
+
+        key = (args, n, mode)
+        sources = (self.trie, self.rnn_executor.model, self.normalized_index, self.infix_index)
+        response = None
+        if self.response_cache is not None:
+            response = self.response_cache.get(key, sources)
+
+        try:
+            if response is None:
+                response = await self.autocomplete(args, mode, n=n, deadline=deadline)
+                # Responses cut short by the budget are not cached, as a later request may have time for more
+                if self.response_cache is not None and (deadline is None or time.monotonic() < deadline):
+                    self.response_cache.put(key, response, sources)
+            completions, tier = response
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        except RNNUnavailableError as e:
+            logger.warning("shedding request: %s", e)
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            completions, tier = [], "none"
+        except (asyncio.TimeoutError, TimeoutError):
+            logger.warning('RNN completion of "%s" timed out.', args)
+            self.set_status(504)
+            completions, tier = [], "none"
+
+        self.tiers = [tier]
+        response = {"Completions": completions, "Tier": tier}
         self.write(response)
         self.write('\n')
 
 
-def make_app():
+class batch_autocomplete_handler(autocomplete_handler):
+    endpoint = "batch"
+
+    async def post(self):
+        """
+        Parse a JSON body {"prefixes": [...], "mode": ..., "budget_ms": ...} and return the autocompletions of every
+        prefix, in order, as JSON, with the tier that answered each of them.
+        The prefixes are looked up in the trie in one pass, and the prefixes missing from it are all submitted to
+        the RNN(GRU) model at once, so that they are generated as one batch.  The optional latency budget applies
+        to the whole request, as in the single prefix endpoint.
+        A prefix whose RNN completion is shed or times out gets no completions.
+        """
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            body = None
+        # A str of prefixes would be iterated char by char, so the types are checked rather than duck-typed
+        prefixes = body.get("prefixes") if isinstance(body, dict) else None
+        if not isinstance(prefixes, list) or not all(isinstance(prefix, str) for prefix in prefixes):
+            raise tornado.web.HTTPError(400, "Expected a JSON object with a list of prefixes")
+        prefixes = [unicodedata.normalize("NFC", prefix) for prefix in prefixes]
+        max_prefixes = self.settings["max_batch_prefixes"]
+        if len(prefixes) > max_prefixes:
+            raise tornado.web.HTTPError(400, "At most {} prefixes per request".format(max_prefixes))
+        mode = body.get("mode", self.rnn_mode)
+        if not isinstance(mode, str):
+            raise tornado.web.HTTPError(400, "Expected mode to be a str")
+        deadline = self.latency_deadline(body.get("budget_ms"))
+        n = 3
+
+        sources = (self.trie, self.rnn_executor.model, self.normalized_index, self.infix_index)
+        responses = [None] * len(prefixes)
+        if self.response_cache is not None:
+            responses = [self.response_cache.get((prefix, n, mode), sources) for prefix in prefixes]
+
+        # Trie lookups, sharing the walk down to common prefixes
+        lookups = [i for i, response in enumerate(responses) if response is None]
+        nodes = self.trie.contains_many(self.trie.root, [prefixes[i] for i in lookups])
+        novel = {}
+        for i, node in zip(lookups, nodes):
+            if node is not None:
+                responses[i] = self.trie.top_completions(node, prefix=prefixes[i], n=n), "trie"
+                continue
+            completions, tier = self.approximate_autocomplete(prefixes[i], n=n, deadline=deadline)
+            if completions:
+                responses[i] = completions, tier
+            elif deadline is not None and time.monotonic() >= deadline:
+                responses[i] = [], "none"
+            else:
+                novel.setdefault(prefixes[i], []).append(i)
+
+        # RNN completions of every distinct novel prefix, submitted together so they are batched
+        results = await asyncio.gather(*[self.rnn_autocomplete(prefix, mode, n=n, deadline=deadline)
+                                         for prefix in novel], return_exceptions=True)
+        for (prefix, indices), result in zip(novel.items(), results):
+            tier = "rnn"
+            if isinstance(result, ValueError):
+                raise tornado.web.HTTPError(400, str(result))
+            elif isinstance(result, RNNUnavailableError):
+                logger.warning("shedding batch completion: %s", result)
+                result, tier = [], "none"
+            elif isinstance(result, (asyncio.TimeoutError, TimeoutError)):
+                logger.warning('RNN completion of "%s" timed out.', prefix)
+                result, tier = [], "none"
+            elif isinstance(result, Exception):
+                raise result
+            for i in indices:
+                responses[i] = result, tier
+
+        # Responses cut short by the budget are not cached, as a later request may have time for more
+        if self.response_cache is not None and (deadline is None or time.monotonic() < deadline):
+            for i in lookups:
+                if responses[i][1] != "none":
+                    self.response_cache.put((prefixes[i], n, mode), responses[i], sources)
+
+        self.tiers = [tier for _, tier in responses]
+        response = {"Completions": [completions for completions, _ in responses], "Tiers": self.tiers}
+        self.write(response)
+        self.write('\n')
+
+
+class stream_autocomplete_handler(autocomplete_handler):
+    endpoint = "stream"
+
+    def on_connection_close(self):
+        self.closed = True
+
+    async def send_event(self, event: str, data):
+        """
+        Send one Server-Sent Event with JSON data, and flush it to the client.
+        """
+        self.write("event: {}\ndata: {}\n\n".format(event, json.dumps(data)))
+        try:
+            await self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.closed = True
+
+    async def get(self):
+        """
+        Parse args from URL and stream autocompletions as Server-Sent Events:
+            "completions": the trie completions, sent at once, including those matching the prefix up to case,
+                whitespace, punctuation or a few typos, or containing its end, and empty if there are none.
+            "text": chars of the RNN(GRU) completion of a novel prefix, as they are generated.  In "beam" mode, the
+                beam search completions are sent as one "completions" event instead.
+            "error": {"status": 503 or 504} if the RNN(GRU) model is overloaded, not loaded yet or too slow.
+            "done": the end of the stream.
+        The RNN(GRU) generation stops as soon as the client disconnects.
+        """
+        prefix = unicodedata.normalize("NFC", self.get_argument("q"))
+        mode = self.get_argument("mode", self.rnn_mode)
+        n = 3
+        self.closed = False
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+
+        (contains, node) = self.trie.contains(self.trie.root, prefix)
+        completions = self.trie.top_completions(node, prefix=prefix, n=n) if contains else []
+        self.tiers = ["trie"]
+        if not contains:
+            completions, tier = self.approximate_autocomplete(prefix, n=n)
+            self.tiers = [tier or "none"]
+        await self.send_event("completions", completions)
+
+        if not completions and not contains and not self.closed:
+            self.tiers = ["rnn"]
+            try:
+                if mode == "beam":
+                    await self.send_event("completions", await self.rnn_autocomplete(prefix, mode, n=n))
+                else:
+                    await self.stream_rnn_autocomplete(prefix, mode)
+            except ValueError as e:
+                self.tiers = ["none"]
+                await self.send_event("error", {"status": 400, "message": str(e)})
+            except RNNUnavailableError as e:
+                logger.warning("shedding request: %s", e)
+                self.tiers = ["none"]
+                await self.send_event("error", {"status": 503})
+            except (asyncio.TimeoutError, TimeoutError):
+                logger.warning('RNN completion of "%s" timed out.', prefix)
+                self.tiers = ["none"]
+                await self.send_event("error", {"status": 504})
+
+        if not self.closed:
+            await self.send_event("done", None)
+
+    async def stream_rnn_autocomplete(self, prefix: str, mode: str):
+        """
+        Sample an RNN(GRU) completion of a prefix, sending its chars as "text" events as they are generated.
+        Chars generated while the previous event is being flushed are sent together.
+        """
+        loop = asyncio.get_event_loop()
+        chunks = asyncio.Queue()
+
+        def on_text(text):
+            # Called from the RNN worker thread
+            loop.call_soon_threadsafe(chunks.put_nowait, text)
+            return not self.closed
+
+        completion = asyncio.ensure_future(self.rnn_executor.complete(prefix, mode=mode, on_text=on_text))
+        completion.add_done_callback(lambda _: chunks.put_nowait(None))
+
+        finished = False
+        while not finished and not self.closed:
+            text = await chunks.get()
+            while text is not None and not chunks.empty():
+                chunk = chunks.get_nowait()
+                text = text + chunk if chunk is not None else text
+                finished = chunk is None
+            if text is None:
+                break
+            await self.send_event("text", text)
+
+        # Raises the errors of the completion
+        await completion
+
+
+class cache_stats_handler(tracked_handler):
+
+    def initialize(self, response_cache, rnn_executor, **models):
+        """
+        Args:
+            response_cache (ResponseCache): the cache of final responses, or None.
+            rnn_executor (RNNExecutor): runs the RNN(GRU) model, with its current StateCache.
+        """
+        self.caches = dict(response_cache=response_cache, state_cache=rnn_executor.state_cache)
+
+    def get(self):
+        """
+        Return the hit/miss counters of the caches as JSON.
+        """
+        self.write({name: cache.stats() for name, cache in self.caches.items() if cache is not None})
+        self.write('\n')
+
+
+class metrics_handler(cache_stats_handler):
+
+    def get(self):
+        """
+        Return the request, tier, latency, RNN step and event loop lag metrics of this process, and the counters of
+        its caches, in the Prometheus text format.
+        """
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(REGISTRY.render(extra=cache_metrics(self.caches)))
+
+
+class ready_handler(tracked_handler):
+
+    def initialize(self, trie, rnn_executor, normalized_index=None, infix_index=None, **models):
+        """
+        Args:
+            trie (Trie or CompactTrie): the trie serving completions.
+            rnn_executor (RNNExecutor): runs the RNN(GRU) model, once loaded.
+            normalized_index (NormalizedIndex): the index by normalized key, once built, or None.
+            infix_index (InfixIndex): the index by word position, once built, or None.
+        """
+        self.available = dict(trie=trie is not None, rnn=rnn_executor.model is not None,
+                              normalized_index=normalized_index is not None, infix_index=infix_index is not None)
+
+    def get(self):
+        """
+        Return which completion paths are available as JSON, with status 200 once the RNN(GRU) model is loaded,
+        and 503 before, e.g. while a server started with --fast-start loads it in the background.
+        """
+        if not self.available["rnn"]:
+            self.set_status(503)
+        self.write(self.available)
+        self.write('\n')
+
+
+def ingest_live(models, sentences):
+    """
+    Add sentences to the live trie and its secondary indexes, and drop the cached responses they made stale.
+    Args:
+        models (dict): the objects serving completions, as passed to the handlers.
+        sentences (list): sentences as str, or as [str, count] pairs.
+    Returns:
+        number of sentences added.
+    Raises:
+        ValueError if the trie cannot be updated in place, or a sentence is malformed, in which case nothing is
+        added and the cache is left as is.
+    """
+    trie = models["trie"]
+    if not isinstance(trie, Trie):
+        raise ValueError("Live updates require --trie-backend object, reload the trie file instead")
+    pending = models["pending_sentences"]
+    if pending is not None:
+        # The indexes are being built from the trie off the IOLoop, so it must not change under them meanwhile:
+        # the sentences are added to both once the indexes are swapped in, see load_in_background()
+        pairs = parse_sentences(sentences)
+        pending.extend(pairs)
+        return len(pairs)
+    indexes = [models[name] for name in ("normalized_index", "infix_index") if models[name] is not None]
+    num_added = ingest_sentences(trie, sentences, indexes=indexes)
+    if num_added and models["response_cache"] is not None:
+        models["response_cache"].clear()
+    return num_added
+
+
+class admin_handler(tracked_handler):
+
+    def initialize(self, models, admin_token, reload_trie=None, reload_model=None):
+        """
+        Args:
+            models (dict): the objects serving completions, shared with the other handlers, so that replacing
+                one of them swaps it in for all requests that start afterwards.
+            admin_token (str): token expected in the X-Admin-Token header.
+            reload_trie (callable): returns a dict of a new trie loaded from disk and its secondary indexes, keyed
+                like models.
+            reload_model (callable): returns (model, BatchScheduler, StateCache) loaded from the checkpoint.
+        """
+        self.models = models
+        self.admin_token = admin_token
+        self.reload_trie = reload_trie
+        self.reload_model = reload_model
+
+    def prepare(self):
+        super(admin_handler, self).prepare()
+        token = self.request.headers.get("X-Admin-Token", "")
+        if not hmac.compare_digest(token.encode("utf8"), self.admin_token.encode("utf8")):
+            raise tornado.web.HTTPError(403)
+
+    def parse_body(self):
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Expected a JSON object")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, "Expected a JSON object")
+        return body
+
+
+class admin_sentences_handler(admin_handler):
+
+    async def post(self):
+        """
+        Add the sentences of a JSON body {"sentences": [...]} to the live trie, as str or [str, count] pairs.
+        Sentences are added in chunks, so that completions are still served while a large body is ingested.
+        The whole body is checked first: if any sentence is malformed, none of them are added.
+        While a server started with --fast-start builds the trie indexes, sentences are added once they are built.
+        """
+        sentences = self.parse_body().get("sentences")
+        if not isinstance(sentences, list):
+            raise tornado.web.HTTPError(400, "Expected a JSON object with a list of sentences")
+
+        num_added = 0
+        try:
+            sentences = parse_sentences(sentences)
+            for start in range(0, len(sentences), 1000):
+                num_added += ingest_live(self.models, sentences[start:start + 1000])
+                await asyncio.sleep(0)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        logger.info("added %s sentences to the live trie.", num_added)
+        self.write({"added": num_added})
+        self.write('\n')
+
+
+class admin_reload_handler(admin_handler):
+
+    async def post(self):
+        """
+        Reload the trie from data/trie.obj or data/trie.bin and the RNN(GRU) model from its checkpoint, as chosen
+        by a JSON body {"trie": true, "model": true}, and swap them in without dropping requests.
+        The new trie and model are loaded off the IOLoop while the current ones keep serving, and requests in
+        flight finish on the objects they started with.
+        """
+        body = self.parse_body()
+        # Checked before anything is reloaded, so that a refused request leaves the trie as it was too
+        if body.get("trie", True) and self.reload_trie is None:
+            raise tornado.web.HTTPError(400, "Reloading the trie is not enabled")
+        if body.get("model", True) and self.reload_model is None:
+            raise tornado.web.HTTPError(400, "Reloading the model is not enabled")
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        reloaded = []
+
+        if body.get("trie", True):
+            self.models.update(await loop.run_in_executor(None, self.reload_trie))
+            reloaded.append("trie")
+
+        if body.get("model", True):
+            model, batch_scheduler, state_cache = await loop.run_in_executor(None, self.reload_model)
+            previous_scheduler = self.models["rnn_executor"].swap_model(model, batch_scheduler, state_cache)
+            if previous_scheduler is not None:
+                await loop.run_in_executor(None, previous_scheduler.stop)
+            reloaded.append("model")
+
+        logger.info("reloaded %s in %.2f seconds.", " and ".join(reloaded), time.monotonic() - start)
+        self.write({"reloaded": reloaded, "seconds": time.monotonic() - start})
+        self.write('\n')
+
+
+class admin_profile_handler(admin_handler):
+
+    async def get(self):
+        """
+        Sample the stacks of every thread of the server for "seconds" (default 5, at most 60) and return them in the
+        collapsed format of flamegraph.pl, one "thread;function;...;function count" line per stack:
+            $: curl -H "X-Admin-Token: TOKEN" "http://localhost:13000/admin/profile?seconds=10" > stacks.txt
+            $: flamegraph.pl stacks.txt > flamegraph.svg
+        The stacks are sampled off the IOLoop, so the requests served meanwhile are profiled too.
+        """
+        try:
+            seconds = float(self.get_argument("seconds", "5"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "seconds must be a number")
+        if not 0 < seconds <= 60:
+            raise tornado.web.HTTPError(400, "seconds must be between 0 and 60")
+
+        loop = asyncio.get_event_loop()
+        stacks = await loop.run_in_executor(None, sample_stacks, seconds)
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.write(format_stacks(stacks))
+
+
+def make_app(trie, rnn_executor, rnn_mode="sample", response_cache=None, max_batch_prefixes=1000,
+             admin_token=None, reload_trie=None, reload_model=None, fuzzy_distance=1, fuzzy_budget=0.005,
+             normalized_index=None, infix_index=None, latency_budget=None, profiler=False):
+    """
+    Initialize server with endpoints for sentence autocomplete of one or many prefixes, streaming sentence
+    autocomplete, cache statistics, metrics and readiness, plus admin endpoints for live updates if an admin token is
+    given, and for profiling if the profiler is enabled as well.
+    All handlers share the models dict, so that the admin endpoints can swap in a new trie or model, and count
+    their requests in flight in the active_requests setting.
+    """
+    # pending_sentences holds the live sentences ingested while the trie indexes are built in the background
+    models = dict(trie=trie, rnn_executor=rnn_executor, rnn_mode=rnn_mode, response_cache=response_cache,
+                  normalized_index=normalized_index, infix_index=infix_index, pending_sentences=None)
+    routes = [
+        (r"/autocomplete", autocomplete_handler, models),
+        (r"/autocomplete/batch", batch_autocomplete_handler, models),
+        (r"/autocomplete/stream", stream_autocomplete_handler, models),
+        (r"/cache/stats", cache_stats_handler, models),
+        (r"/ready", ready_handler, models),
+        (r"/metrics", metrics_handler, models),
+    ]
+    if admin_token:
+        admin = dict(models=models, admin_token=admin_token, reload_trie=reload_trie, reload_model=reload_model)
+        routes += [
+            (r"/admin/sentences", admin_sentences_handler, admin),
+            (r"/admin/reload", admin_reload_handler, admin),
+        ]
+        if profiler:
+            routes.append((r"/admin/profile", admin_profile_handler, admin))
+    return tornado.web.Application(routes, models=models, max_batch_prefixes=max_batch_prefixes,
+                                   fuzzy_distance=fuzzy_distance, fuzzy_budget=fuzzy_budget,
+                                   latency_budget=latency_budget, active_requests=ActiveRequests())
+
+
+def build_trie_indexes(trie, args):
+    """
+    Build the secondary indexes of a trie, unless disabled by the command line args.
+    Returns:
+        dict of the NormalizedIndex and InfixIndex or None, keyed like the models passed to the handlers.
+    """
+    normalized_index = None
+    if not args.no_normalized_index:
+        normalized_index = NormalizedIndex.from_trie(trie)
+    infix_index = None
+    if args.infix_min_chars > 0:
+        infix_index = InfixIndex.from_trie(trie, min_chars=args.infix_min_chars)
+    return dict(normalized_index=normalized_index, infix_index=infix_index)
+
+
+def load_trie(args):
     """
-    Initialize server with one endpoint for sentence autocomplete.
+    Load or create the prefix trie, and its secondary indexes unless disabled, as configured by the command line
+    args.
+    Returns:
+        dict of the Trie or CompactTrie, and of the NormalizedIndex and InfixIndex or None, keyed like the models
+        passed to the handlers.
     """
-    return tornado.web.Application([
-        (r"/autocomplete", autocomplete_handler),
-    ])
+    trie = initialize_prefix_trie(top_k=args.top_k, backend=args.trie_backend)
+    return dict(trie=trie, **build_trie_indexes(trie, args))
+
+
+def load_inference_model(args):
+    """
+    Load the RNN(GRU) model from its checkpoint, as configured by the command line args.
+    With the keras engine, the checkpoint is loaded by Keras, then compiled once into a NumpyGRU, so that
+    completions step the GRU cells with explicit states instead of running a stateful Keras predict() per char.
+    Returns:
+        NumpyGRU object.
+    """
+    if args.inference_engine == "keras":
+        # Keras takes seconds to import, so only servers using it pay for it
+        from keras.models import load_model
+        model = load_model(args.checkpoint_path)
+        model.summary(print_fn=logger.info)
+        return NumpyGRU.from_keras_model(model)
+    return NumpyGRU.from_checkpoint(args.checkpoint_path)
+
+
+async def load_in_background(models, args, reload_model):
+    """
+    Cache the top completions of an object trie, load the RNN(GRU) model and build the secondary indexes of the
+    trie off the IOLoop, for a server started with --fast-start, which serves trie completions meanwhile.  Each is
+    swapped in as soon as it is ready.
+    Args:
+        models (dict): the objects serving completions, as passed to the handlers.
+        args: the command line args.
+        reload_model (callable): returns (model, BatchScheduler, StateCache) loaded from the checkpoint.
+    """
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+    # Sentences ingested meanwhile are held back by ingest_live(), as the indexes are built from the trie off the
+    # IOLoop, then added to the trie and the new indexes
+    models["pending_sentences"] = []
+    try:
+        trie = models["trie"]
+        if isinstance(trie, Trie) and args.top_k > 0:
+            await loop.run_in_executor(None, trie.cache_top_completions, args.top_k)
+            logger.info("trie completions cached %.2f seconds after start.", time.monotonic() - start)
+
+        model, batch_scheduler, state_cache = await loop.run_in_executor(None, reload_model)
+        models["rnn_executor"].swap_model(model, batch_scheduler, state_cache)
+        logger.info("RNN model ready %.2f seconds after start.", time.monotonic() - start)
+
+        models.update(await loop.run_in_executor(None, build_trie_indexes, models["trie"], args))
+        logger.info("trie indexes ready %.2f seconds after start.", time.monotonic() - start)
+    except Exception:
+        logger.exception("background loading failed.")
+    finally:
+        pending, models["pending_sentences"] = models["pending_sentences"], None
+        if pending:
+            logger.info("added %s sentences ingested while loading.", ingest_live(models, pending))
+
+
+def start_batch_scheduler(model, args):
+    """
+    Start a BatchScheduler for a NumpyGRU model, with a new StateCache, as configured by the command line args.
+    Returns:
+        (BatchScheduler, StateCache or None)
+    """
+    state_cache = StateCache(max_bytes=int(args.state_cache_mb * 2 ** 20)) if args.state_cache_mb > 0 else None
+    batch_scheduler = BatchScheduler(model, window=args.batch_window_ms / 1000.,
+                                     max_batch_size=args.max_batch_size, state_cache=state_cache).start()
+    return batch_scheduler, state_cache
 
 
 if __name__ == "__main__":
 
-    # Load or create the prefix trie for autocompleting sequences seen in training
-    trie = initialize_prefix_trie()
+    arg_parser = ArgumentParser(description="Sentence autocomplete server.")
+    arg_parser.add_argument("--top-k", type=int, default=3,
+                            help="number of completions cached on each trie node, 0 to disable (default: %(default)s)")
+    arg_parser.add_argument("--trie-backend", choices=("object", "compact", "mmap"),
+                            help="trie implementation: TrieNode objects, flat arrays, or flat arrays "
+                                 "memory-mapped from data/trie.bin (default: mmap with --fast-start, else object)")
+    arg_parser.add_argument("--fuzzy-distance", type=int, default=1,
+                            help="maximum number of typos tolerated when completing a prefix missing from the trie "
+                                 "from the trie, 0 to disable (default: %(default)s)")
+    arg_parser.add_argument("--fuzzy-budget-ms", type=float, default=5.,
+                            help="time budget of the typo-tolerant trie search (default: %(default)s)")
+    arg_parser.add_argument("--no-normalized-index", action="store_true",
+                            help="do not complete prefixes missing from the trie from its sentences matching them up "
+                                 "to case, whitespace and punctuation")
+    arg_parser.add_argument("--infix-min-chars", type=int, default=6,
+                            help="complete prefixes missing from the trie whose last words, at least this many chars, "
+                                 "are found in the middle of a sentence; 0 to disable (default: %(default)s)")
+    arg_parser.add_argument("--checkpoint-path", default="checkpoints/stateful_gru_model_3_200.ckpt",
+                            help="path of the RNN(GRU) model checkpoint, or of quantized weights exported by "
+                                 "quantize.py (default: %(default)s)")
+    arg_parser.add_argument("--inference-engine", choices=("numpy", "keras"), default="numpy",
+                            help="read the RNN(GRU) checkpoint directly, or load it with Keras, for checkpoints only "
+                                 "Keras can read; either way the model runs as plain NumPy GRU steps "
+                                 "(default: %(default)s)")
+    arg_parser.add_argument("--rnn-mode", choices=("sample", "beam"), default="sample",
+                            help="default RNN completion mode: one sampled completion, or the top 3 completions "
+                                 "by beam search (default: %(default)s)")
+    arg_parser.add_argument("--batch-window-ms", type=float, default=2.,
+                            help="time to wait for concurrent RNN completions to batch together, 0 to only batch "
+                                 "completions that are already pending (default: %(default)s)")
+    arg_parser.add_argument("--max-batch-size", type=int, default=32,
+                            help="maximum number of RNN completions stepped together (default: %(default)s)")
+    arg_parser.add_argument("--state-cache-mb", type=float, default=64.,
+                            help="memory for caching GRU states by prefix, 0 to disable "
+                                 "(default: %(default)s)")
+    arg_parser.add_argument("--response-cache-size", type=int, default=10000,
+                            help="maximum number of cached responses, 0 to disable (default: %(default)s)")
+    arg_parser.add_argument("--response-cache-mb", type=float, default=32.,
+                            help="maximum memory of cached responses (default: %(default)s)")
+    arg_parser.add_argument("--response-cache-ttl", type=float, default=600.,
+                            help="seconds before a cached response expires, 0 for never (default: %(default)s)")
+    arg_parser.add_argument("--rnn-queue-depth", type=int, default=64,
+                            help="maximum number of RNN completions queued or running, further requests are "
+                                 "answered with 503 (default: %(default)s)")
+    arg_parser.add_argument("--rnn-timeout-ms", type=float, default=2000.,
+                            help="deadline of an RNN completion, 0 for none; late requests are answered with 504 "
+                                 "(default: %(default)s)")
+    arg_parser.add_argument("--latency-budget-ms", type=float, default=0.,
+                            help="default latency budget of a request, overridden by its budget_ms arg: the "
+                                 "completions found within it are returned, cutting RNN completions short; 0 for "
+                                 "none (default: %(default)s)")
+    arg_parser.add_argument("--max-batch-prefixes", type=int, default=1000,
+                            help="maximum number of prefixes in one /autocomplete/batch request (default: %(default)s)")
+    arg_parser.add_argument("--admin-token", default=os.environ.get("AUTOCOMPLETE_ADMIN_TOKEN"),
+                            help="enable the /admin endpoints for live updates, for requests with this token in "
+                                 "their X-Admin-Token header (default: $AUTOCOMPLETE_ADMIN_TOKEN)")
+    arg_parser.add_argument("--watch-sentences", metavar="PATH",
+                            help="add the sentences appended to this file, one per line, to the live trie")
+    arg_parser.add_argument("--profiler", action="store_true",
+                            help="enable GET /admin/profile, which samples the stacks of the server on demand for "
+                                 "flame graphs; requires --admin-token")
+    arg_parser.add_argument("--fast-start", action="store_true",
+                            help="serve trie completions as soon as the trie is loaded, and load the RNN(GRU) "
+                                 "model and trie indexes in the background; GET /ready reports when they are")
+    arg_parser.add_argument("--workers", type=int, default=1,
+                            help="number of server processes accepting on the port, sharing the trie and model "
+                                 "weights loaded before forking them; 0 for one per CPU (default: %(default)s)")
+    args = arg_parser.parse_args()
+    num_workers = args.workers or os.cpu_count()
+    # Unpickling the object trie takes seconds, while the memory-mapped trie opens at once
+    if args.trie_backend is None:
+        args.trie_backend = "mmap" if args.fast_start else "object"
+    if args.inference_engine == "keras" and args.checkpoint_path.endswith(".npz"):
+        arg_parser.error("quantized .npz weights require the numpy inference engine")
+    if num_workers > 1 and args.inference_engine == "keras":
+        arg_parser.error("--workers requires the numpy inference engine, as TensorFlow does not survive a fork")
+    if args.profiler and not args.admin_token:
+        arg_parser.error("--profiler requires --admin-token")
+    if num_workers > 1 and args.fast_start:
+        arg_parser.error("--fast-start loads the model in each worker, so it cannot share it with --workers")
+    if args.watch_sentences and args.trie_backend != "object":
+        arg_parser.error("--watch-sentences requires --trie-backend object, as the {} trie is read-only".format(
+            args.trie_backend))
+
+    # Load or create the prefix trie for autocompleting sequences seen in training, with its indexes by normalized
+    # case, whitespace and punctuation, and by word position
+    if args.fast_start:
+        # Only the trie is needed to serve the first requests, the rest is loaded once the server is up, including
+        # the cached completions of an object trie, which top_completions() searches for until then
+        tries = dict(trie=initialize_prefix_trie(backend=args.trie_backend))
+    else:
+        tries = load_trie(args)
 
     # Load RNN(GRU) model for autocompleting seed sequences not seen before
-    model = load_model("checkpoints/stateful_gru_model_3_200.ckpt")
-    print(model.summary())
-    inference_model = build_inference_model(model)
-    inference_model.set_weights(model.get_weights())
+    inference_model = None if args.fast_start else load_inference_model(args)
+
+    # Bind before forking, so that all workers accept on the same port
+    sockets = tornado.netutil.bind_sockets(13000)
+    worker_id = 0
+    if num_workers > 1:
+        # The trie and weights loaded so far are shared copy-on-write with the workers, so keep the garbage
+        # collector from writing to their objects
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        worker_id = Supervisor(num_workers).start()
+        if worker_id is None:
+            sys.exit(0)
+
+    # Threads do not survive a fork, so everything below is created in each worker
+
+    # Batch RNN completions of concurrent requests, each with its own GRU states,
+    # resuming from the cached states of the longest prefix seen before
+    batch_scheduler, state_cache = None, None
+    if inference_model is not None:
+        batch_scheduler, state_cache = start_batch_scheduler(inference_model, args)
+
+    # Run the RNN off the IOLoop, so trie completions never wait behind it
+    rnn_timeout = args.rnn_timeout_ms / 1000. if args.rnn_timeout_ms > 0 else None
+    rnn_executor = RNNExecutor(inference_model, batch_scheduler=batch_scheduler,
+                               max_pending=args.rnn_queue_depth, timeout=rnn_timeout, state_cache=state_cache)
+
+    # Cache final responses, as the same few thousand prefixes make up most queries
+    response_cache = None
+    if args.response_cache_size > 0:
+        response_cache = ResponseCache(max_entries=args.response_cache_size,
+                                       max_bytes=int(args.response_cache_mb * 2 ** 20),
+                                       ttl=args.response_cache_ttl if args.response_cache_ttl > 0 else None)
+
+    # Reload the trie and model from disk on demand, without restarting
+    def reload_trie():
+        return load_trie(args)
+
+    def reload_model():
+        model = load_inference_model(args)
+        return (model,) + start_batch_scheduler(model, args)
 
     # Start the server
-    app = make_app()
-    app.listen(13000)
+    app = make_app(rnn_executor=rnn_executor, rnn_mode=args.rnn_mode, response_cache=response_cache,
+                   max_batch_prefixes=args.max_batch_prefixes, admin_token=args.admin_token,
+                   reload_trie=reload_trie, reload_model=reload_model,
+                   fuzzy_distance=args.fuzzy_distance, fuzzy_budget=args.fuzzy_budget_ms / 1000.,
+                   latency_budget=args.latency_budget_ms / 1000. if args.latency_budget_ms > 0 else None,
+                   profiler=args.profiler, **tries)
+
+    models = app.settings["models"]
+    EventLoopLagMonitor().start()
+    if args.fast_start:
+        tornado.ioloop.IOLoop.current().add_callback(load_in_background, models, args, reload_model)
+
+    # Add the sentences appended to a file to the live trie
+    if args.watch_sentences:
+        SentenceFileWatcher(args.watch_sentences, lambda lines: ingest_live(models, lines)).start()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    shutdown_gracefully(server, on_shutdown=rnn_executor.shutdown, active_requests=app.settings["active_requests"])
+    logger.info("worker %s serving on port 13000.", worker_id)
     tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,293 @@
+from collections import Counter as Tally
+import os
+import sys
+import threading
+import time
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Counters, gauges and histograms of the server, rendered in the Prometheus text format by GET /metrics, and a
+# sampling profiler dumping the stacks of every thread in the collapsed format of flamegraph.pl
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.)
+STEP_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape_label(value)) for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """
+    A metric with one value per combination of label values, safe to update from any thread.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _check(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("{} expects labels {}".format(self.name, self.labelnames))
+        return tuple(str(value) for value in labelvalues)
+
+    def samples(self):
+        """
+        Returns:
+            list of (name suffix, label values, extra label pairs, value).
+        """
+        with self._lock:
+            return [("", labelvalues, (), value) for labelvalues, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for suffix, labelvalues, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, format_labels(self.labelnames, labelvalues, extra),
+                                            format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        labelvalues = self._check(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        with self._lock:
+            return self._values.get(self._check(labelvalues), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labelvalues):
+        labelvalues = self._check(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(Metric):
+    """
+    Counts of observations at or below each bucket bound, with their sum and count, per combination of labels.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, *labelvalues):
+        labelvalues = self._check(labelvalues)
+        with self._lock:
+            counts, total = self._values.get(labelvalues, ([0] * len(self.buckets), 0.))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[labelvalues] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = sorted((labelvalues, (list(counts), total))
+                            for labelvalues, (counts, total) in self._values.items())
+        for labelvalues, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(("_bucket", labelvalues, (("le", format_value(bound)),), cumulative))
+            samples.append(("_sum", labelvalues, (), total))
+            samples.append(("_count", labelvalues, (), cumulative))
+        return samples
+
+
+class Registry(object):
+    """
+    The metrics of a process, and callables collecting more metrics when rendered, such as cache counters.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Args:
+            collector (callable): returns a list of metrics, built when the registry is rendered.
+        """
+        self.collectors.append(collector)
+
+    def render(self, extra=()):
+        """
+        Args:
+            extra (list): more metrics to render, e.g. of objects that the registry does not know about.
+        Returns:
+            str of every metric in the Prometheus text exposition format.
+        """
+        metrics = list(self.metrics) + list(extra)
+        for collector in self.collectors:
+            metrics.extend(collector())
+        return "".join(line + "\n" for metric in metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "autocomplete_requests_total", "Autocomplete requests, by endpoint and HTTP status.", ["endpoint", "status"]))
+COMPLETIONS = REGISTRY.register(Counter(
+    "autocomplete_completions_total", "Completed prefixes, by the tier that answered them.", ["tier"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "autocomplete_request_duration_seconds",
+    "Autocomplete request latency, by endpoint and by the slowest tier that answered it.", ["endpoint", "tier"]))
+RNN_STEPS = REGISTRY.register(Histogram(
+    "autocomplete_rnn_steps", "GRU steps per RNN(GRU) generation, seed chars included.", buckets=STEP_BUCKETS))
+EVENT_LOOP_LAG = REGISTRY.register(Histogram(
+    "autocomplete_event_loop_lag_seconds", "Delay of the IOLoop in running callbacks past their due time."))
+
+# Tiers from the cheapest to the most expensive, as tried by the router
+TIERS = ("trie", "normalized", "fuzzy", "infix", "rnn", "none")
+TRIE_TIERS = ("trie", "normalized", "fuzzy", "infix")
+
+
+def slowest_tier(tiers):
+    """
+    Return the most expensive of the tiers that answered the prefixes of a request, "none" if there are none.
+    """
+    return max(tiers, key=TIERS.index, default="none")
+
+
+def trie_hit_ratio():
+    """
+    Returns:
+        list of a Gauge of the fraction of the prefixes answered from the trie or its indexes, rather than by the
+        RNN(GRU) model or not at all.
+    """
+    gauge = Gauge("autocomplete_trie_hit_ratio",
+                  "Fraction of the completed prefixes answered from the trie or its indexes, without the RNN(GRU).")
+    total = sum(COMPLETIONS.value(tier) for tier in TIERS)
+    if total:
+        gauge.set(sum(COMPLETIONS.value(tier) for tier in TRIE_TIERS) / total)
+    return [gauge]
+
+
+REGISTRY.add_collector(trie_hit_ratio)
+
+
+def cache_metrics(caches):
+    """
+    Args:
+        caches (dict): caches providing stats(), such as ResponseCache and StateCache, by name; None values are
+            skipped.
+    Returns:
+        list of metrics: a counter per growing stat, such as hits, and a gauge per other stat, such as bytes.
+    """
+    metrics = {}
+    for cache_name, cache in sorted(caches.items()):
+        if cache is None:
+            continue
+        for stat, value in sorted(cache.stats().items()):
+            if stat in ("hits", "misses", "evictions", "invalidations"):
+                metric = metrics.setdefault(stat, Counter(
+                    "autocomplete_cache_{}_total".format(stat), "Cache {}.".format(stat), ["cache"]))
+                metric.inc(cache_name, amount=value)
+            else:
+                metric = metrics.setdefault(stat, Gauge(
+                    "autocomplete_cache_{}".format(stat), "Cache {}.".format(stat), ["cache"]))
+                metric.set(value, cache_name)
+    return list(metrics.values())
+
+
+class EventLoopLagMonitor(object):
+    """
+    Measures how late the IOLoop runs a callback scheduled every interval seconds, which is how long requests
+    wait behind blocking work on the loop.
+    """
+    def __init__(self, interval=0.1, histogram=EVENT_LOOP_LAG):
+        self.interval = interval
+        self.histogram = histogram
+        self._io_loop = None
+
+    def start(self):
+        import tornado.ioloop
+
+        self._io_loop = tornado.ioloop.IOLoop.current()
+        self._schedule()
+        return self
+
+    def _schedule(self):
+        due = self._io_loop.time() + self.interval
+        self._io_loop.call_at(due, self._check, due)
+
+    def _check(self, due):
+        self.histogram.observe(max(0., self._io_loop.time() - due))
+        self._schedule()
+
+
+def collapse_stack(frame, thread_name: str):
+    """
+    Return a stack as "thread;outermost function;...;innermost function", in the collapsed format of flamegraph.pl.
+    """
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ";".join([thread_name] + functions[::-1])
+
+
+def sample_stacks(seconds: float, interval=0.005):
+    """
+    Sample the stacks of every other thread of the process, for a number of seconds.
+    Sampling uses sys._current_frames(), so it costs nothing until called, and only slows the sampled threads by
+    the GIL time it takes.
+    Args:
+        seconds (float): sampling duration.
+        interval (float): time between samples.
+    Returns:
+        collections.Counter of the number of samples per collapsed stack, see collapse_stack().
+    """
+    stacks = Tally()
+    own_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    num_samples = 0
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                stacks[collapse_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+        num_samples += 1
+        time.sleep(interval)
+    logger.info("sampled the stacks of the server %s times.", num_samples)
+    return stacks
+
+
+def format_stacks(stacks):
+    """
+    Format sampled stacks as lines of "stack count", the input of flamegraph.pl.
+    """
+    return "".join("{} {}\n".format(stack, count) for stack, count in stacks.most_common())
@@ -0,0 +1,153 @@
+from bisect import bisect_left, insort
+import gc
+import heapq
+import re
+import sys
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Secondary index of the trie sentences by a normalized key, so that prefixes typed with another case, extra
+# whitespace or missing punctuation ("what is  y") are completed from the trie like the sentences they stand for
+# ("What is your account number?"), instead of by the RNN(GRU) model
+
+PUNCTUATION = re.compile(r"[^\w\s]+")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_key(text: str):
+    """
+    Fold the case of a text, strip its punctuation and collapse its whitespace into single spaces.
+    Leading whitespace is dropped, and trailing whitespace kept as one space, so that a prefix ending with a
+    space only matches the words after it.
+    """
+    text = PUNCTUATION.sub("", text.casefold())
+    return WHITESPACE.sub(" ", text).lstrip()
+
+
+def iter_sentences(trie):
+    """
+    Iterate over the (sentence, count) pairs of every sentence in a trie, in trie order: depth first, each sentence
+    before the longer ones it is a prefix of, and the children of a node in order.  This is the order in which
+    top_completions() ranks equally frequent sentences.
+    Args:
+        trie (Trie or CompactTrie): trie providing iter_children() and count().
+    """
+    stack = [(trie.root, "")]
+    while stack:
+        node, path = stack.pop()
+        count = trie.count(node)
+        if count:
+            yield path, count
+        # Pushed in reverse, so that the first child is visited first
+        stack.extend((child, path + char) for char, child in reversed(list(trie.iter_children(node))))
+
+
+class NormalizedIndex(object):
+    """
+    The normalized keys of the sentences of a trie, in sorted order, each mapped back to its display sentences.
+    The keys starting with a normalized prefix are a contiguous run of the sorted keys, found by binary search.
+    Sentences sharing a key, such as "Thank you." and "thank you!", are merged into one completion, ranked by
+    their total count and displayed as the most frequent of them.
+    Keys are distinct sentences rather than trie nodes, so the index is a small fraction of the size of the trie.
+    """
+    def __init__(self, variants):
+        """
+        Args:
+            variants (dict): maps each key to a dict of its display sentences and their counts, in the order of
+                iter_sentences() for an index built from a trie, which breaks ties between equally frequent keys as
+                the trie does, then in the order the sentences were added.
+        """
+        self.variants = variants
+        self.keys = sorted(variants)
+        self.counts = {key: sum(counts.values()) for key, counts in variants.items()}
+        self.ranks = {key: rank for rank, key in enumerate(variants)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_trie(cls, trie):
+        """
+        Build the index of the sentences of a trie.
+        Args:
+            trie (Trie or CompactTrie): the trie serving completions.
+        Returns:
+            NormalizedIndex object.
+        """
+        variants = {}
+        # The trie makes every collection slow, and nothing built here is garbage
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for sentence, count in iter_sentences(trie):
+                key = normalize_key(sentence).rstrip()
+                if key:
+                    variants.setdefault(key, {})[sentence] = count
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        logger.info("indexed %s normalized keys.", len(variants))
+        return cls(variants)
+
+    def display(self, key: str):
+        """
+        Return the most frequent sentence with a given key, the first indexed among equally frequent ones.
+        """
+        counts = self.variants[key]
+        return max(counts, key=counts.get)
+
+    def add_sentence(self, sentence: str, count=1):
+        """
+        Add a sentence added to the live trie to the index as well.
+        Args:
+            sentence (str): the sentence, as added to the trie.
+            count (int): number of occurrences of the sentence to add.
+        """
+        key = normalize_key(sentence).rstrip()
+        if not key:
+            return
+        if key not in self.variants:
+            self.variants[key] = {}
+            self.counts[key] = 0
+            self.ranks[key] = len(self.ranks)
+            insort(self.keys, key)
+        counts = self.variants[key]
+        counts[sentence] = counts.get(sentence, 0) + count
+        self.counts[key] += count
+
+    def add_sentences(self, pairs):
+        """
+        Add sentences added to the live trie to the index as well.
+        Args:
+            pairs (list): (sentence, count) pairs, as added to the trie.
+        """
+        for sentence, count in pairs:
+            self.add_sentence(sentence, count)
+
+    def complete(self, prefix: str, n=3):
+        """
+        Complete a prefix from the sentences whose normalized key starts with the normalized prefix.
+        All the keys starting with it are ranked, so short prefixes cost more, but those rarely miss the trie.
+        Args:
+            prefix (str): the prefix, as typed.
+            n (int): number of completions to return.
+        Returns:
+            list of at most n display sentences, empty if no key starts with the normalized prefix.  The sentence
+            whose key is the normalized prefix itself comes first.
+        """
+        key = normalize_key(prefix)
+        if not key:
+            return []
+        start = bisect_left(self.keys, key)
+        end = bisect_left(self.keys, key + chr(sys.maxunicode), start)
+        if start == end:
+            return []
+
+        completions = heapq.nsmallest(n, self.keys[start:end], key=lambda k: (-self.counts[k], self.ranks[k]))
+        # Unlike a trie lookup, a whole sentence typed differently is completed, to its display form first
+        if self.keys[start] == key:
+            completions = [key] + [completion for completion in completions if completion != key][:n - 1]
+        return [self.display(completion) for completion in completions]
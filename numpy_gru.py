@@ -0,0 +1,371 @@
+import json
+import threading
+
+import numpy as np
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Plain NumPy inference for the character embeddings GRU model built in rnn.py, so that generating a
+# character is a handful of small matmuls instead of a full Keras/TensorFlow predict() call
+
+
+def hard_sigmoid(x):
+    """
+    Keras 1 and 2 piecewise linear approximation of the sigmoid, 0.2 * x + 0.5 clipped to [0, 1], computed in place.
+    """
+    x *= 0.2
+    x += 0.5
+    return np.clip(x, 0., 1., out=x)
+
+
+def hard_sigmoid_keras3(x):
+    """
+    Keras 3 piecewise linear approximation of the sigmoid, relu6(x + 3) / 6, computed in place.
+    """
+    x /= 6.
+    x += 0.5
+    return np.clip(x, 0., 1., out=x)
+
+
+def sigmoid(x):
+    """
+    Logistic sigmoid, computed in place.
+    """
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.
+    return np.reciprocal(x, out=x)
+
+
+def tanh(x):
+    return np.tanh(x, out=x)
+
+
+def relu(x):
+    return np.maximum(x, 0., out=x)
+
+
+def linear(x):
+    return x
+
+
+ACTIVATIONS = {
+    "hard_sigmoid": hard_sigmoid,
+    "hard_sigmoid_keras3": hard_sigmoid_keras3,
+    "sigmoid": sigmoid,
+    "tanh": tanh,
+    "relu": relu,
+    "linear": linear,
+}
+
+
+def resolve_activations(layer_config, keras_version: str):
+    """
+    Keras 3 changed hard_sigmoid from a slope of 0.2 to a slope of 1/6, so the same name in a layer config means
+    a different function depending on the Keras version that saved the model.
+    Args:
+        layer_config (dict): config of a layer.
+        keras_version (str): version of Keras that saved the model, e.g. "2.1.2".
+    Returns:
+        copy of the config, with the activations named after the functions of ACTIVATIONS they match.
+    Raises:
+        ValueError if the config uses hard_sigmoid and the Keras version is not supported.
+    """
+    layer_config = dict(layer_config)
+    major = keras_version.split(".")[0]
+    for key in ("activation", "recurrent_activation"):
+        if layer_config.get(key) != "hard_sigmoid":
+            continue
+        if major == "3":
+            layer_config[key] = "hard_sigmoid_keras3"
+        elif major not in ("1", "2"):
+            raise ValueError("Unsupported Keras version for hard_sigmoid: {}".format(keras_version))
+    return layer_config
+
+
+class GRULayer(object):
+    """
+    Weights of one Keras GRU layer, split by gate so each step only runs contiguous matmuls.
+    Keras stores the update (z), reset (r) and candidate (h) gates side by side, in that order.
+    """
+    def __init__(self, kernel, recurrent_kernel, bias, activation="tanh", recurrent_activation="hard_sigmoid"):
+        self.units = recurrent_kernel.shape[0]
+        self.kernel = np.ascontiguousarray(kernel, dtype=np.float32)
+        self.recurrent_kernel_zr = np.ascontiguousarray(recurrent_kernel[:, :2 * self.units], dtype=np.float32)
+        self.recurrent_kernel_h = np.ascontiguousarray(recurrent_kernel[:, 2 * self.units:], dtype=np.float32)
+
+        # GRUs saved with reset_after=True have separate input and recurrent biases
+        bias = np.asarray(bias, dtype=np.float32)
+        self.reset_after = bias.ndim == 2
+        if self.reset_after:
+            self.bias = bias[0]
+            self.recurrent_bias_zr = bias[1, :2 * self.units]
+            self.recurrent_bias_h = bias[1, 2 * self.units:]
+        else:
+            self.bias = bias
+
+        self.activation = ACTIVATIONS[activation]
+        self.recurrent_activation = ACTIVATIONS[recurrent_activation]
+
+
+class StepBuffers(object):
+    """
+    Preallocated arrays for stepping a batch of a given size, reused on every step.
+    """
+    def __init__(self, batch_size, units, vocab_size):
+        self.inputs = np.empty((batch_size, 3 * units), dtype=np.float32)
+        self.gates = np.empty((batch_size, 2 * units), dtype=np.float32)
+        self.candidate = np.empty((batch_size, units), dtype=np.float32)
+        self.scratch = np.empty((batch_size, units), dtype=np.float32)
+        self.probs = np.empty((batch_size, vocab_size), dtype=np.float32)
+
+
+class NumpyGRU(object):
+    """
+    Inference engine for the Embedding -> GRU layers -> Dense softmax model built by rnn.build_model().
+    Mirrors the interface of the stateful Keras inference model used by rnn.generate_text(): predict()
+    consumes a (batch_size, seq_len) array of char ids and keeps the GRU states between calls,
+    and reset_states() clears them.
+    Dropout layers are identity at inference time and are skipped.
+    step() only touches the states passed to it, so it can be called from several threads at once.
+    """
+    def __init__(self, embeddings, layers, dense_kernel, dense_bias):
+        self.layers = layers
+        self.units = layers[0].units
+        self.vocab_size = dense_kernel.shape[1]
+        self.dense_kernel = np.ascontiguousarray(dense_kernel, dtype=np.float32)
+        self.dense_bias = np.asarray(dense_bias, dtype=np.float32)
+
+        # Every char id maps to a fixed input projection of the first GRU layer, so precompute them all
+        first = layers[0]
+        self.input_table = np.dot(np.asarray(embeddings, dtype=np.float32), first.kernel) + first.bias
+
+        self.states = None
+        # Step buffers are per thread, so several threads can step the same weights
+        self._local = threading.local()
+
+    @classmethod
+    def from_checkpoint(cls, file_path: str):
+        """
+        Load weights from a Keras HDF5 file, either a full model saved by model.save() (such as the
+        checkpoints written by rnn.py train) or a weights file saved by model.save_weights(), or from a
+        quantized .npz weights file exported by quantize.py.
+        Args:
+            file_path (str): path of the HDF5 or .npz file.
+        Returns:
+            NumpyGRU object.
+        """
+        if file_path.endswith(".npz"):
+            from quantize import load_quantized
+            layer_weights, layer_configs = load_quantized(file_path)
+        else:
+            layer_weights, layer_configs = read_checkpoint(file_path)
+        logger.info("loaded weights of %s layers from %s.", len(layer_weights), file_path)
+        return cls.from_layer_weights(layer_weights, layer_configs)
+
+    @classmethod
+    def from_keras_model(cls, model):
+        """
+        Compile a trained Keras model, such as one built by rnn.build_model() or loaded by load_model(), into a
+        NumpyGRU, once: step() then advances the GRU cells with explicit states in and out, instead of running a
+        stateful Keras predict() per char.
+        The weights are copied, so later training of the Keras model does not change the NumpyGRU.
+        Args:
+            model (keras.models.Sequential): the Embedding -> GRU layers -> Dense softmax model.
+        Returns:
+            NumpyGRU object.
+        """
+        import keras
+
+        layer_weights = []
+        layer_configs = {}
+        for layer in model.layers:
+            if not layer.weights:
+                continue
+            # Keras 3 weight names drop the layer name, which is kept in the path
+            weight_names = [getattr(weight, "path", weight.name) for weight in layer.weights]
+            layer_weights.append((layer.name, weight_names, layer.get_weights()))
+            config = layer.get_config()
+            # TimeDistributed wraps the config of the Dense layer
+            config = config["layer"]["config"] if "layer" in config else config
+            layer_configs[layer.name] = resolve_activations(config, keras.__version__)
+        return cls.from_layer_weights(layer_weights, layer_configs)
+
+    @classmethod
+    def from_layer_weights(cls, layer_weights, layer_configs=None):
+        """
+        Build the engine from (layer name, weight names, weight arrays) triples, in model order.
+        Layers are recognised by their weight names: embeddings, GRU kernels, then the output Dense layer.
+        """
+        layer_configs = layer_configs or {}
+        embeddings = None
+        layers = []
+        dense = None
+
+        for layer_name, weight_names, weights in layer_weights:
+            config = layer_configs.get(layer_name, {})
+            if any("embeddings" in name for name in weight_names):
+                embeddings = weights[0]
+            elif any("recurrent_kernel" in name for name in weight_names):
+                kernel, recurrent_kernel, bias = weights
+                layers.append(GRULayer(kernel, recurrent_kernel, bias,
+                                       activation=config.get("activation", "tanh"),
+                                       recurrent_activation=config.get("recurrent_activation", "hard_sigmoid")))
+            else:
+                dense = weights
+
+        if embeddings is None or not layers or dense is None:
+            raise ValueError("Expected Embedding, GRU and Dense layer weights")
+
+        return cls(embeddings, layers, dense[0], dense[1])
+
+    def reset_states(self):
+        """
+        Reset the GRU states to zeros.
+        """
+        if self.states is not None:
+            self.states.fill(0.)
+
+    def zero_states(self, batch_size=1):
+        """
+        Returns:
+            array of shape (num_layers, batch_size, units) holding the initial GRU states.
+        """
+        return np.zeros((len(self.layers), batch_size, self.units), dtype=np.float32)
+
+    def step(self, indices, states):
+        """
+        Advance the model one character for a batch of sequences.
+        Args:
+            indices (array): char ids of shape (batch_size,).
+            states (array): GRU states of shape (num_layers, batch_size, units), updated in place.
+        Returns:
+            array of shape (batch_size, vocab_size) with next char probabilities.
+            The array is a reused buffer, so copy it before the next call if it must be kept.
+        """
+        batch_size = len(indices)
+        if not hasattr(self._local, "buffers"):
+            self._local.buffers = {}
+        buffers = self._local.buffers.get(batch_size)
+        if buffers is None:
+            buffers = self._local.buffers[batch_size] = StepBuffers(batch_size, self.units, self.vocab_size)
+
+        units = self.units
+        np.take(self.input_table, indices, axis=0, out=buffers.inputs)
+        for i, layer in enumerate(self.layers):
+            h = states[i]
+            if i > 0:
+                np.dot(states[i - 1], layer.kernel, out=buffers.inputs)
+                buffers.inputs += layer.bias
+
+            # Update and reset gates
+            gates = buffers.gates
+            np.dot(h, layer.recurrent_kernel_zr, out=gates)
+            if layer.reset_after:
+                gates += layer.recurrent_bias_zr
+            gates += buffers.inputs[:, :2 * units]
+            layer.recurrent_activation(gates)
+            z = gates[:, :units]
+            r = gates[:, units:]
+
+            # Candidate state
+            candidate = buffers.candidate
+            if layer.reset_after:
+                np.dot(h, layer.recurrent_kernel_h, out=candidate)
+                candidate += layer.recurrent_bias_h
+                candidate *= r
+            else:
+                np.multiply(r, h, out=buffers.scratch)
+                np.dot(buffers.scratch, layer.recurrent_kernel_h, out=candidate)
+            candidate += buffers.inputs[:, 2 * units:]
+            layer.activation(candidate)
+
+            # h = z * h + (1 - z) * candidate, written back into the states
+            np.subtract(h, candidate, out=buffers.scratch)
+            buffers.scratch *= z
+            np.add(candidate, buffers.scratch, out=h)
+
+        # Dense softmax output
+        probs = buffers.probs
+        np.dot(states[-1], self.dense_kernel, out=probs)
+        probs += self.dense_bias
+        probs -= probs.max(axis=1, keepdims=True)
+        np.exp(probs, out=probs)
+        probs /= probs.sum(axis=1, keepdims=True)
+        return probs
+
+    def predict(self, x, verbose=0):
+        """
+        Run a batch of char id sequences through the model, keeping the GRU states between calls.
+        Args:
+            x (array): char ids of shape (batch_size, seq_len).
+            verbose: ignored, for compatibility with Keras predict().
+        Returns:
+            array of shape (batch_size, seq_len, vocab_size) with next char probabilities after each char.
+        """
+        x = np.asarray(x)
+        batch_size, seq_len = x.shape
+        if self.states is None or self.states.shape[1] != batch_size:
+            self.states = self.zero_states(batch_size)
+
+        outputs = np.empty((batch_size, seq_len, self.vocab_size), dtype=np.float32)
+        for t in range(seq_len):
+            outputs[:, t] = self.step(x[:, t], self.states)
+        return outputs
+
+
+def read_checkpoint(file_path: str):
+    """
+    Read the weights of every layer of a Keras HDF5 model or weights file.
+    Returns:
+        (list of (layer name, weight names, weight arrays) triples in model order, dict of layer configs by name,
+        empty for a weights file)
+    """
+    import h5py
+
+    with h5py.File(file_path, "r") as f:
+        layer_configs = {}
+        if "model_config" in f.attrs:
+            # Files without a version predate Keras 3, which always writes it
+            keras_version = decode(f.attrs.get("keras_version", "2"))
+            layer_configs = {name: resolve_activations(config, keras_version) for name, config
+                             in layer_configs_from_model_config(f.attrs["model_config"]).items()}
+        weights_group = f["model_weights"] if "model_weights" in f else f
+
+        layer_weights = []
+        for layer_name in weights_group.attrs["layer_names"]:
+            layer_name = decode(layer_name)
+            group = weights_group[layer_name]
+            weight_names = [decode(name) for name in group.attrs["weight_names"]]
+            if weight_names:
+                weights = [group[name][()] for name in weight_names]
+                layer_weights.append((layer_name, weight_names, weights))
+    return layer_weights, layer_configs
+
+
+def decode(value):
+    """
+    HDF5 attributes written by Keras are bytes under Python 3.
+    """
+    return value.decode("utf8") if isinstance(value, bytes) else value
+
+
+def layer_configs_from_model_config(model_config):
+    """
+    Map layer names to layer configs from the JSON model config stored in a Keras HDF5 model file.
+    """
+    config = json.loads(decode(model_config))["config"]
+    # Sequential configs are a list of layers in Keras 2.1, and a dict with a "layers" list later on
+    layers = config["layers"] if isinstance(config, dict) else config
+
+    layer_configs = {}
+    for layer in layers:
+        layer_config = layer["config"]
+        # TimeDistributed wraps the config of the Dense layer
+        if "layer" in layer_config:
+            layer_configs[layer_config["name"]] = layer_config["layer"]["config"]
+        else:
+            layer_configs[layer_config["name"]] = layer_config
+    return layer_configs
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import random
+import signal
+import time
+
+import numpy as np
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Pre-fork serving: the trie and model weights are loaded once, then worker processes are forked from the loaded
+# process and accept on the same listening sockets.  Workers share the loaded pages copy-on-write: numpy arrays
+# and memory-mapped tries are never written to, so their pages stay shared between all workers.
+
+
+class Supervisor(object):
+    """
+    Forks num_workers worker processes and keeps them running.
+    A worker that dies or exits with an error is forked again, up to max_restarts times in total.
+    The supervisor forwards SIGTERM and SIGINT to the workers and waits for them to shut down gracefully.
+    SIGHUP restarts the workers one at a time, each replacement being forked before the next worker is stopped.
+    """
+    def __init__(self, num_workers, max_restarts=100):
+        self.num_workers = num_workers
+        self.max_restarts = max_restarts
+        self.num_restarts = 0
+        # pid -> worker id
+        self.children = {}
+        self._stopping = False
+        self._restarting = []
+
+    def start(self):
+        """
+        Fork the workers, then supervise them until they have all exited.
+        Returns:
+            the worker id, from 0 to num_workers - 1, in a worker process.
+            None in the supervisor process, once all workers have exited.
+        """
+        for worker_id in range(self.num_workers):
+            if self._fork(worker_id):
+                return worker_id
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            planned = pid in self._restarting
+            failed = os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0
+            if failed:
+                logger.warning("worker %s (pid %s) exited with status %s.", worker_id, pid, status)
+            else:
+                logger.info("worker %s (pid %s) exited.", worker_id, pid)
+
+            if self._stopping or not (planned or failed):
+                continue
+            if not planned:
+                if self.num_restarts >= self.max_restarts:
+                    raise RuntimeError("Too many worker restarts, giving up")
+                self.num_restarts += 1
+            else:
+                self._restarting.remove(pid)
+
+            if self._fork(worker_id):
+                return worker_id
+            self._restart_next()
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        return None
+
+    def _fork(self, worker_id):
+        """
+        Returns:
+            True in the new worker process, False in the supervisor.
+        """
+        pid = os.fork()
+        if pid == 0:
+            self.children = {}
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            # Workers must not sample the same completions
+            random.seed()
+            np.random.seed()
+            return True
+        logger.info("forked worker %s (pid %s).", worker_id, pid)
+        self.children[pid] = worker_id
+        return False
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+
+    def _restart(self, signum, frame):
+        if self._stopping or self._restarting:
+            return
+        logger.info("restarting %s workers.", len(self.children))
+        self._restarting = list(self.children)
+        self._restart_next()
+
+    def _restart_next(self):
+        """
+        Stop the next worker queued for a restart, once all the others are running.
+        """
+        if self._restarting and len(self.children) == self.num_workers:
+            os.kill(self._restarting[0], signal.SIGTERM)
+
+
+class ActiveRequests(object):
+    """
+    Number of requests being handled by a worker, counted by the handlers, so that a shutdown can wait for them.
+    Only used from the thread running the IOLoop.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def started(self):
+        self.count += 1
+
+    def finished(self):
+        self.count -= 1
+
+    async def wait_idle(self, timeout: float, interval=0.05):
+        """
+        Wait until no request is being handled, or until timeout seconds have passed.
+        Returns:
+            True if no request is being handled.
+        """
+        deadline = time.monotonic() + timeout
+        while self.count > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+        return self.count <= 0
+
+
+def shutdown_gracefully(server, on_shutdown=None, grace=10., active_requests=None):
+    """
+    Shut a worker down gracefully on SIGTERM or SIGINT: stop accepting connections, give the requests in flight up
+    to grace seconds to finish, close the connections, call on_shutdown(), then stop the IOLoop.
+    Must be called from the thread running the IOLoop.
+    Args:
+        server (tornado.httpserver.HTTPServer): the server to shut down.
+        on_shutdown (callable): called once the connections are closed, e.g. to stop the RNN worker threads.
+        grace (float): seconds to wait for the requests in flight.
+        active_requests (ActiveRequests): the requests in flight, counted by the handlers.  Without it, open
+            connections are closed at once, along with the requests they are running.
+    """
+    loop = asyncio.get_event_loop()
+
+    async def shutdown():
+        logger.info("shutting down.")
+        # Stop accepting connections, then let the requests in flight finish before closing the connections,
+        # which would drop their responses
+        server.stop()
+        if active_requests is not None and not await active_requests.wait_idle(grace):
+            logger.warning("%s requests still in flight after %s seconds.", active_requests.count, grace)
+        try:
+            await asyncio.wait_for(server.close_all_connections(), grace)
+        except asyncio.TimeoutError:
+            logger.warning("connections still open after %s seconds.", grace)
+        if on_shutdown is not None:
+            on_shutdown()
+        loop.stop()
+
+    def handle_signal():
+        # The supervisor forwards the signal the whole process group may have received already
+        if not shutting_down:
+            shutting_down.append(True)
+            asyncio.ensure_future(shutdown())
+
+    shutting_down = []
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, handle_signal)
@@ -0,0 +1,186 @@
+# Quantized export of the GRU weights: kernels are stored as int8 with one scale per output channel, or as float16,
+# and dequantized to float32 when loaded, so the matmuls keep running on float32 BLAS, which NumPy has no int8 or
+# float16 equivalent of
+
+from argparse import ArgumentParser
+import json
+import os
+import sys
+
+import numpy as np
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+FORMAT_VERSION = 1
+DTYPES = ("int8", "float16")
+
+
+def quantize_int8(weights):
+    """
+    Quantize a 2-D weight matrix to int8 with one symmetric scale per output channel (column).
+    Args:
+        weights (array): float matrix of shape (inputs, outputs).
+    Returns:
+        (int8 array of the same shape, float32 scales of shape (outputs,))
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    scales = np.abs(weights).max(axis=0) / 127.
+    # All-zero channels would divide by zero, and dequantize to zeros with any scale
+    scales[scales == 0.] = 1.
+    quantized = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def dequantize_int8(quantized, scales):
+    return quantized.astype(np.float32) * scales
+
+
+def is_quantized(weight_name: str, weights):
+    """
+    Kernels and embeddings are quantized; biases are small and shift every output, so they stay float32.
+    """
+    return np.ndim(weights) == 2 and "bias" not in weight_name
+
+
+def save_quantized(layer_weights, layer_configs, file_path: str, dtype="int8"):
+    """
+    Save model weights as an .npz file of quantized kernels.
+    Args:
+        layer_weights (list): (layer name, weight names, weight arrays) triples, as read by
+            numpy_gru.read_checkpoint().
+        layer_configs (dict): layer configs by layer name.
+        file_path (str): path of the .npz file.
+        dtype (str): "int8" for per-channel int8 kernels, or "float16".
+    """
+    if dtype not in DTYPES:
+        raise ValueError("Unsupported dtype: {}".format(dtype))
+
+    arrays = {}
+    layers = []
+    for i, (layer_name, weight_names, weights) in enumerate(layer_weights):
+        for j, (weight_name, weight) in enumerate(zip(weight_names, weights)):
+            key = "layer{}_weight{}".format(i, j)
+            if not is_quantized(weight_name, weight):
+                arrays[key] = np.asarray(weight, dtype=np.float32)
+            elif dtype == "int8":
+                arrays[key], arrays[key + "_scales"] = quantize_int8(weight)
+            else:
+                arrays[key] = np.asarray(weight, dtype=np.float16)
+        layers.append({"name": layer_name, "weight_names": list(weight_names),
+                       "config": layer_configs.get(layer_name, {})})
+
+    metadata = {"version": FORMAT_VERSION, "dtype": dtype, "layers": layers}
+    arrays["metadata"] = np.array(json.dumps(metadata))
+    with open(file_path, "wb") as file_handler:
+        np.savez(file_handler, **arrays)
+
+
+def load_quantized(file_path: str):
+    """
+    Load the weights of an .npz file written by save_quantized(), dequantized to float32.
+    Returns:
+        (list of (layer name, weight names, weight arrays) triples, dict of layer configs by name), as
+        numpy_gru.read_checkpoint().
+    """
+    with np.load(file_path, allow_pickle=False) as arrays:
+        metadata = json.loads(str(arrays["metadata"]))
+        if metadata.get("version") != FORMAT_VERSION:
+            raise ValueError("Unsupported quantized weights version: {}".format(metadata.get("version")))
+
+        layer_weights = []
+        layer_configs = {}
+        for i, layer in enumerate(metadata["layers"]):
+            weights = []
+            for j in range(len(layer["weight_names"])):
+                key = "layer{}_weight{}".format(i, j)
+                if key + "_scales" in arrays:
+                    weights.append(dequantize_int8(arrays[key], arrays[key + "_scales"]))
+                else:
+                    weights.append(arrays[key].astype(np.float32))
+            layer_weights.append((layer["name"], layer["weight_names"], weights))
+            layer_configs[layer["name"]] = layer["config"]
+    return layer_weights, layer_configs
+
+
+def compare_models(reference, candidate, text: str, batch_size=32, max_chars=20000):
+    """
+    Compare the next char distributions of two NumpyGRU models over a text, such as data/sentences.txt.
+    The text is split into batch_size rows read in parallel, as in training, and both models are stepped over
+    them from zero states.
+    Args:
+        reference (NumpyGRU): the float32 model.
+        candidate (NumpyGRU): the quantized model.
+        text (str): the text to predict.
+        batch_size (int): number of rows of the text.
+        max_chars (int): number of chars of the text used.
+    Returns:
+        dict with the mean and max KL divergence of the candidate distributions from the reference ones, in nats,
+        and the fraction of steps where both models agree on the most likely char.
+    """
+    from utils import encode_text
+
+    sequence = encode_text(text[:max_chars])
+    seq_len = len(sequence) // batch_size
+    if seq_len == 0:
+        raise ValueError("Text too short to compare models")
+    rows = sequence[:batch_size * seq_len].reshape(batch_size, seq_len)
+
+    reference_states = reference.zero_states(batch_size)
+    candidate_states = candidate.zero_states(batch_size)
+    divergences = []
+    agreements = 0
+    for t in range(seq_len):
+        p = reference.step(rows[:, t], reference_states).copy()
+        q = candidate.step(rows[:, t], candidate_states)
+        divergences.append(np.sum(p * (np.log(p + 1e-12) - np.log(q + 1e-12)), axis=1))
+        agreements += np.sum(p.argmax(axis=1) == q.argmax(axis=1))
+
+    divergences = np.concatenate(divergences)
+    return {"mean_kl": float(divergences.mean()), "max_kl": float(divergences.max()),
+            "top1_agreement": float(agreements) / rows.size}
+
+
+if __name__ == "__main__":
+    from numpy_gru import NumpyGRU, read_checkpoint
+
+    arg_parser = ArgumentParser(description="Export quantized GRU weights, and check them against the float model.")
+    arg_parser.add_argument("--checkpoint-path", default="checkpoints/stateful_gru_model_3_200.ckpt",
+                            help="path of the float32 RNN(GRU) model checkpoint (default: %(default)s)")
+    arg_parser.add_argument("--output", required=True,
+                            help="path of the quantized weights, ending with .npz, e.g. data/model_weights.int8.npz")
+    arg_parser.add_argument("--dtype", choices=DTYPES, default="int8",
+                            help="int8 kernels with per-channel scales, or float16 kernels (default: %(default)s)")
+    arg_parser.add_argument("--text", default="data/sentences.txt",
+                            help="text on which next char distributions are compared (default: %(default)s)")
+    arg_parser.add_argument("--max-chars", type=int, default=20000,
+                            help="number of chars of the text compared (default: %(default)s)")
+    arg_parser.add_argument("--max-kl", type=float, default=0.01,
+                            help="largest mean KL divergence from the float model accepted, in nats; the weights "
+                                 "are not written beyond it (default: %(default)s)")
+    args = arg_parser.parse_args()
+    if not args.output.endswith(".npz"):
+        arg_parser.error("--output must end with .npz")
+
+    layer_weights, layer_configs = read_checkpoint(args.checkpoint_path)
+    save_quantized(layer_weights, layer_configs, args.output + ".tmp.npz", dtype=args.dtype)
+    try:
+        reference = NumpyGRU.from_layer_weights(layer_weights, layer_configs)
+        candidate = NumpyGRU.from_checkpoint(args.output + ".tmp.npz")
+        with open(args.text) as file_handler:
+            metrics = compare_models(reference, candidate, file_handler.read(), max_chars=args.max_chars)
+    except Exception:
+        os.remove(args.output + ".tmp.npz")
+        raise
+
+    metrics.update(dtype=args.dtype, bytes=os.path.getsize(args.output + ".tmp.npz"),
+                   float32_bytes=os.path.getsize(args.checkpoint_path))
+    logger.info("quantized weights check: %s", metrics)
+    print(json.dumps(metrics))
+    if metrics["mean_kl"] > args.max_kl:
+        os.remove(args.output + ".tmp.npz")
+        logger.error("mean KL divergence above --max-kl %s, weights not written.", args.max_kl)
+        sys.exit(1)
+    os.replace(args.output + ".tmp.npz", args.output)
+    logger.info("saved quantized weights to %s.", args.output)
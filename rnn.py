@@ -9,6 +9,7 @@ from keras.models import load_model, Sequential
 from keras.optimizers import Adam
 
 from logger import get_logger
+from numpy_gru import NumpyGRU
 from utils import (batch_generator, encode_text, generate_seed, ID2CHAR, main,
                    sample_from_probs, VOCAB_SIZE)
 
@@ -22,9 +23,10 @@ logger = get_logger(__name__)
 
 def build_model(batch_size, seq_len, vocab_size=VOCAB_SIZE, embedding_size=32,
                 rnn_size=128, num_layers=3, drop_rate=0.5,
-                learning_rate=0.001, clip_norm=5.0):
+                learning_rate=0.001, clip_norm=5.0, sparse_labels=False):
     """
     Build character embeddings GRU text generation model.
+    With sparse_labels, the model is trained on char ids instead of one-hot encoded labels.
     """
     logger.info("building model: batch_size=%s, seq_len=%s, vocab_size=%s, "
                 "embedding_size=%s, rnn_size=%s, num_layers=%s, drop_rate=%s, "
@@ -46,7 +48,7 @@ def build_model(batch_size, seq_len, vocab_size=VOCAB_SIZE, embedding_size=32,
     # Output shape: (batch_size, seq_len, vocab_size)
 
     optimizer = Adam(learning_rate, clipnorm=clip_norm)
-    model.compile(loss="categorical_crossentropy", optimizer=optimizer)
+    model.compile(loss=training_loss(sparse_labels), optimizer=optimizer)
 
     logger.info("Model generated:")
     print(model.summary())    
@@ -54,6 +56,10 @@ def build_model(batch_size, seq_len, vocab_size=VOCAB_SIZE, embedding_size=32,
     return model
 
 
+def training_loss(sparse_labels=False):
+    return "sparse_categorical_crossentropy" if sparse_labels else "categorical_crossentropy"
+
+
 def build_inference_model(model, batch_size=1, seq_len=1):
     """
     Build inference model from model config.
@@ -61,13 +67,31 @@ def build_inference_model(model, batch_size=1, seq_len=1):
     """
     logger.info("building inference model.")
     config = model.get_config()
-    # Edit batch_size and seq_len
-    config[0]["config"]["batch_input_shape"] = (batch_size, seq_len)
+    # Sequential configs are a list of layers in Keras 2.1, and a dict with a "layers" list later on
+    layers = config["layers"] if isinstance(config, dict) else config
+    # Edit batch_size and seq_len, set on the InputLayer from Keras 3 on
+    layer_config = layers[0]["config"]
+    layer_config["batch_shape" if "batch_shape" in layer_config else "batch_input_shape"] = (batch_size, seq_len)
+    # Keras 3 also records the input shape each layer was built with, so they are built from the new one instead
+    for layer in layers:
+        layer.pop("build_config", None)
     inference_model = Sequential.from_config(config)
     inference_model.trainable = False
     return inference_model
 
 
+def reset_states(model):
+    """
+    Reset the states of a stateful model: Keras 3 models no longer have reset_states(), only their RNN layers do.
+    """
+    if hasattr(model, "reset_states"):
+        model.reset_states()
+        return
+    for layer in model.layers:
+        if getattr(layer, "stateful", False):
+            layer.reset_state()
+
+
 def generate_text(model, seed, length=512, top_n=2):
     """
     Generates text of specified length from trained model with given seed (e.g. the prefix string).
@@ -76,19 +100,19 @@ def generate_text(model, seed, length=512, top_n=2):
     logger.info('generating with seed: "%s".', seed)
     generated = seed
     encoded = encode_text(seed)
-    model.reset_states()
+    reset_states(model)
 
     for idx in encoded[:-1]:
         x = np.array([[idx]])
         # Input shape: (1, 1)
         # Set internal states
-        model.predict(x)
+        model.predict(x, verbose=0)
 
     next_index = encoded[-1]
     for i in range(length):
         x = np.array([[next_index]])
         # Input shape: (1, 1)
-        probs = model.predict(x)
+        probs = model.predict(x, verbose=0)
         # Output shape: (1, 1, vocab_size)
         next_index = sample_from_probs(probs.squeeze(), top_n)
         # Append to sequence
@@ -111,8 +135,6 @@ class LoggerCallback(Callback):
     def __init__(self, text, model):
         super(LoggerCallback, self).__init__()
         self.text = text
-        # Build inference model using config from learning model
-        self.inference_model = build_inference_model(model)
         self.time_train = self.time_epoch = time.time()
 
     def on_epoch_begin(self, epoch, logs=None):
@@ -122,12 +144,12 @@ class LoggerCallback(Callback):
         duration_epoch = time.time() - self.time_epoch
         logger.info("epoch: %s, duration: %ds, loss: %.6g.",
                     epoch, duration_epoch, logs["loss"])
-        # Transfer weights from learning model
-        self.inference_model.set_weights(self.model.get_weights())
+        # Compile the current weights of the learning model for inference
+        inference_model = NumpyGRU.from_keras_model(self.model)
 
         # Generate text
         seed = generate_seed(self.text)
-        generate_text(self.inference_model, seed)
+        generate_text(inference_model, seed)
 
     def on_train_begin(self, logs=None):
         logger.info("start of training.")
@@ -136,12 +158,12 @@ class LoggerCallback(Callback):
     def on_train_end(self, logs=None):
         duration_train = time.time() - self.time_train
         logger.info("end of training, duration: %ds.", duration_train)
-        # Transfer weights from learning model
-        self.inference_model.set_weights(self.model.get_weights())
+        # Compile the final weights of the learning model for inference
+        inference_model = NumpyGRU.from_keras_model(self.model)
 
         # Generate text
         seed = generate_seed(self.text)
-        generate_text(self.inference_model, seed, 1024, 3)
+        generate_text(inference_model, seed, 1024, 3)
 
 
 def train_main(args):
@@ -158,6 +180,9 @@ def train_main(args):
         load_path = args.checkpoint_path if args.restore is True else args.restore
         model = load_model(load_path)
         logger.info("model restored: %s.", load_path)
+        # The checkpoint may have been trained with the other kind of labels
+        if model.loss != training_loss(args.sparse_labels):
+            model.compile(loss=training_loss(args.sparse_labels), optimizer=model.optimizer)
     else:
         model = build_model(batch_size=args.batch_size,
                             seq_len=args.seq_len,
@@ -167,7 +192,8 @@ def train_main(args):
                             num_layers=args.num_layers,
                             drop_rate=args.drop_rate,
                             learning_rate=args.learning_rate,
-                            clip_norm=args.clip_norm)
+                            clip_norm=args.clip_norm,
+                            sparse_labels=args.sparse_labels)
 
     # Make and clear checkpoint directory
     model.save(args.checkpoint_path)
@@ -188,10 +214,12 @@ def train_main(args):
     # Start training
     num_batches = (len(text_train) - 1) // (args.batch_size * args.seq_len)
     val_batches = (len(text_validation) - 1) // (args.batch_size * args.seq_len)
+    # Batches are generated lazily, with char id labels or one-hot encoded ones
+    labels = dict(sparse_labels=True) if args.sparse_labels else dict(one_hot_labels=True)
     model.reset_states()
-    model.fit_generator(batch_generator(encode_text(text_train), args.batch_size, args.seq_len, one_hot_labels=True),
+    model.fit_generator(batch_generator(encode_text(text_train), args.batch_size, args.seq_len, **labels),
                         num_batches, args.num_epochs, callbacks=callbacks,
-                        validation_data=batch_generator(encode_text(text_validation), args.batch_size, args.seq_len, one_hot_labels=True),
+                        validation_data=batch_generator(encode_text(text_validation), args.batch_size, args.seq_len, **labels),
                         validation_steps=val_batches)
     return model
 
@@ -1,7 +1,43 @@
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import re
 import string
 import random
+import subprocess
+import sys
+import signal
+import tempfile
+import threading
+import time
 import unittest
-from trie import Trie, TrieNode
+import urllib.request
+import importlib.util
+import numpy as np
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from trie import Trie, TrieNode, initialize_prefix_trie, load_pickled_trie
+from compact_trie import CompactTrie
+from numpy_gru import NumpyGRU
+from batching import BatchScheduler
+from executor import ModelNotReadyError, QueueFullError, RNNExecutor
+from cache import ResponseCache, StateCache
+from prefork import Supervisor
+from ingest import count_sentences, iter_json_array
+from live_update import SentenceFileWatcher
+from fuzzy import fuzzy_completions
+from normalized_index import NormalizedIndex, normalize_key
+from infix_index import InfixIndex, sort_suffixes
+from quantize import compare_models, save_quantized
+from numpy_gru import hard_sigmoid, read_checkpoint, resolve_activations
+from utils import batch_generator, VOCAB_SIZE
+from beam_search import beam_search
+from main import load_in_background, make_app
+from metrics import REQUESTS, Counter, Histogram, Registry, cache_metrics, sample_stacks, slowest_tier
+from benchmark import compare_results, keystroke_prefixes, latency_summary, read_request_log
+
+KERAS_AVAILABLE = importlib.util.find_spec("keras") is not None
 
 
 class TestPreprocess(unittest.TestCase):
@@ -37,6 +73,1129 @@ class TestPreprocess(unittest.TestCase):
         # Although the unnittest method is misleadingly named, it actually checks if two arrays contain same elements
         self.assertCountEqual([self.ending_1, self.ending_2], completions)
 
+    def test_cache_top_completions(self):
+        """
+        Test to verify that cached completions match the enumerated completions, truncated to k.
+        """
+        self.trie.add_sentence(self.root, self.common_prefix)
+        node = self.trie.contains(self.root, self.common_prefix)[1]
+        expected = self.trie.return_completions_from_node(node, prefix=self.common_prefix)
+
+        self.trie.cache_top_completions(k=2)
+        self.assertEqual(expected[:2], self.trie.top_completions(node, prefix=self.common_prefix, n=2))
+        self.assertEqual([self.common_prefix] + expected[:1], self.trie.top_completions(self.root, n=2))
+        # Asking for more completions than were cached falls back to enumeration
+        self.assertEqual(expected, self.trie.top_completions(node, prefix=self.common_prefix, n=3))
+
+    def test_completions_ranked_by_count(self):
+        """
+        Test to verify that completions are returned most frequent first by enumeration, search and cache alike.
+        """
+        self.trie.add_sentence(self.root, self.string_2)
+        node = self.trie.contains(self.root, self.common_prefix)[1]
+        expected = [self.string_2, self.string_1]
+
+        self.assertEqual(expected, self.trie.return_completions_from_node(node, prefix=self.common_prefix))
+        self.assertEqual(expected[:1], self.trie.search_completions(node, prefix=self.common_prefix, n=1))
+        self.trie.cache_top_completions(k=2)
+        self.assertEqual(expected, self.trie.top_completions(node, prefix=self.common_prefix, n=2))
+
+    def test_add_sentence_updates_cached_completions(self):
+        """
+        Test to verify that sentences added after caching completions update the cached completions along their
+        path, ranked like the completions cached from scratch.
+        """
+        self.trie.cache_top_completions(k=2)
+        self.trie.add_sentence(self.root, self.not_string, count=3)
+        self.trie.add_sentence(self.root, self.string_1)
+        node = self.trie.contains(self.root, self.common_prefix)[1]
+        expected = [self.not_string, self.string_1]
+
+        self.assertEqual(expected, self.trie.top_completions(node, prefix=self.common_prefix, n=2))
+        self.assertEqual(expected, self.trie.search_completions(node, prefix=self.common_prefix, n=2))
+        self.assertEqual(expected, self.trie.top_completions(self.root, n=2))
+
+
+def split_sentences(text):
+    """
+    Simple stand-in for nltk's sent_tokenize, which needs the punkt data to be downloaded.
+    """
+    return re.split(r"(?<=[.!?]) ", text)
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = ["Hi! Where is my order?", "Where is my order?", "Thanks.", "Hi!", "Where is my order?"]
+        issues = [{"IssueId": i, "Messages": [{"Text": text}]} for i, text in enumerate(self.messages)]
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "conversations.json")
+        with open(self.file_path, "w") as file_handler:
+            json.dump({"NumTextMessages": len(self.messages), "Issues": issues}, file_handler)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_count_sentences(self):
+        """
+        Test to verify that sentences are counted in order of first occurrence, whether messages are parsed in
+        small chunks and tokenized in a process pool or not.
+        """
+        with open(self.file_path) as file_handler:
+            texts = [issue["Messages"][0]["Text"] for issue in iter_json_array(file_handler, "Issues", chunk_size=7)]
+        self.assertEqual(self.messages, texts)
+
+        expected = {"Hi! Where is my order?": 1, "Hi!": 2, "Where is my order?": 3, "Thanks.": 1}
+        for processes in (1, 2):
+            counts = count_sentences(self.file_path, processes=processes, chunk_size=2, tokenizer=split_sentences)
+            self.assertEqual(list(expected.items()), list(counts.items()))
+
+    def test_stale_pickled_trie_is_rebuilt(self):
+        """
+        Test to verify that a trie pickled before the current format, whose nodes lack counts, is rebuilt from
+        data/sentences.txt instead of being served.
+        """
+        stale = Trie(TrieNode(""))
+        del stale.format_version
+        for attribute in ("count", "max_count", "completions"):
+            delattr(stale.root, attribute)
+        os.mkdir(os.path.join(self.directory.name, "data"))
+        with open(os.path.join(self.directory.name, "data", "trie.obj"), "wb") as file_handler:
+            pickle.dump(stale, file_handler)
+        with open(os.path.join(self.directory.name, "data", "sentences.txt"), "w") as file_handler:
+            file_handler.write("\n".join(self.messages) + "\n")
+
+        directory = os.getcwd()
+        os.chdir(self.directory.name)
+        try:
+            self.assertIsNone(load_pickled_trie("data/trie.obj"))
+            trie = initialize_prefix_trie(top_k=3)
+            self.assertEqual(["Where is my order?"], trie.top_completions(trie.root, prefix="", n=1))
+            self.assertIsNotNone(load_pickled_trie("data/trie.obj"))
+        finally:
+            os.chdir(directory)
+
+    def test_trie_from_counts(self):
+        """
+        Test to verify that a Trie built from sentence counts is the same as one built by adding sentences in order.
+        """
+        sentences = ["Where is my order?", "Where", "What", "Hi!", "Where is my order?", "Whe", ""]
+        trie = Trie(TrieNode(""))
+        counts = {}
+        for sentence in sentences:
+            trie.add_sentence(trie.root, sentence)
+            counts[sentence] = counts.get(sentence, 0) + 1
+        bulk_trie = Trie.from_counts(counts)
+
+        def describe(node):
+            return (node.char, node.count, node.max_count, [describe(child) for child in node.children])
+
+        self.assertEqual(describe(trie.root), describe(bulk_trie.root))
+
+    def test_watcher_skips_long_lines(self):
+        """
+        Test to verify that the sentence watcher skips a line longer than max_bytes, instead of stalling on it,
+        and keeps passing on the lines after it.
+        """
+        file_path = os.path.join(self.directory.name, "sentences.txt")
+        received = []
+        watcher = SentenceFileWatcher(file_path, received.extend, max_bytes=16)
+        with open(file_path, "w") as file_handler:
+            file_handler.write("Hi!\n" + "x" * 40)
+        watcher.poll()
+        with open(file_path, "a") as file_handler:
+            file_handler.write("x" * 10 + "\nThanks.\n")
+        for _ in range(5):
+            watcher.poll()
+        self.assertEqual(["Hi!", "Thanks."], received)
+        self.assertEqual(os.path.getsize(file_path), watcher.offset)
+
+
+def sample_tries():
+    """
+    Build the Trie and CompactTrie shared by the tests of the trie backends and of the indexes built from them.
+    """
+    root = TrieNode("")
+    trie = Trie(root)
+    for sentence in ["What is your name?", "What is your address?", "What is your address?", "Where", "Why"]:
+        trie.add_sentence(root, sentence)
+    return trie, CompactTrie.from_trie(trie)
+
+
+class TestCompactTrie(unittest.TestCase):
+
+    def setUp(self):
+        (self.trie, self.compact_trie) = sample_tries()
+
+    def test_matches_trie(self):
+        """
+        Test to verify that CompactTrie returns the same lookups and completions as the Trie it was built from.
+        """
+        for prefix in ["W", "Wh", "What is your ", "Where", "Whe!"]:
+            (contains, node) = self.trie.contains(self.trie.root, prefix)
+            (compact_contains, compact_node) = self.compact_trie.contains(self.compact_trie.root, prefix)
+            self.assertEqual(contains, compact_contains)
+            self.assertEqual(self.trie.return_completions_from_node(node, prefix=prefix),
+                             self.compact_trie.return_completions_from_node(compact_node, prefix=prefix))
+            self.assertEqual(self.trie.top_completions(node, prefix=prefix, n=2),
+                             self.compact_trie.top_completions(compact_node, prefix=prefix, n=2))
+
+    def test_contains_many(self):
+        """
+        Test to verify that contains_many() finds the same nodes as one contains() call per sentence, in order.
+        """
+        prefixes = ["What is your ", "Whe!", "W", "Why", "What is your ", "Wh", "X", "What is your address?"]
+        for trie in (self.trie, self.compact_trie):
+            expected = [trie.contains(trie.root, prefix)[1] for prefix in prefixes]
+            self.assertEqual(expected, trie.contains_many(trie.root, prefixes))
+
+    def test_save_and_load(self):
+        """
+        Test to verify that a CompactTrie memory-mapped from a file returns the same completions as the original.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "trie.bin")
+            self.compact_trie.save(file_path)
+            loaded_trie = CompactTrie.load(file_path)
+
+            self.assertEqual(len(self.compact_trie), len(loaded_trie))
+            (contains, node) = loaded_trie.contains(loaded_trie.root, "Wh")
+            self.assertTrue(contains)
+            self.assertEqual(["What is your address?", "What is your name?", "Where"], loaded_trie.top_completions(node, prefix="Wh"))
+            loaded_trie.close()
+
+            with open(file_path, "r+b") as file_handler:
+                file_handler.write(b"NOTATRIE")
+            with self.assertRaises(ValueError):
+                CompactTrie.load(file_path)
+
+
+class TestFuzzy(unittest.TestCase):
+
+    def setUp(self):
+        (self.trie, self.compact_trie) = sample_tries()
+
+    def test_fuzzy_completions(self):
+        """
+        Test to verify that prefixes within a typo of a trie path are completed from it, by Trie and CompactTrie alike,
+        and that short prefixes and prefixes too far from any path are not.
+        """
+        for trie in (self.trie, self.compact_trie):
+            # Transposition, substitution, deletion and insertion
+            for prefix in ["Waht is", "Whet is your", "Wat is your", "What iis your"]:
+                self.assertEqual(["What is your address?", "What is your name?"],
+                                 fuzzy_completions(trie, prefix, n=2, max_distance=1))
+            self.assertEqual([], fuzzy_completions(trie, "Whx", max_distance=1))
+            self.assertEqual([], fuzzy_completions(trie, "Whax is yx", max_distance=1))
+            self.assertEqual(["What is your address?"], fuzzy_completions(trie, "Whax is yx", n=1, max_distance=2))
+
+
+class TestNormalizedIndex(unittest.TestCase):
+
+    def setUp(self):
+        (self.trie, self.compact_trie) = sample_tries()
+
+    def test_complete(self):
+        """
+        Test to verify that prefixes differing from trie sentences by case, whitespace or punctuation are completed
+        from the index with the most frequent display sentence, and that live additions are indexed.
+        """
+        self.assertEqual("what is your ", normalize_key("  What\tis  YOUR, "))
+        for trie in (self.trie, self.compact_trie):
+            index = NormalizedIndex.from_trie(trie)
+            self.assertEqual(["What is your address?", "What is your name?"], index.complete("what   is Your "))
+            self.assertEqual(["What is your name?"], index.complete("WHAT IS YOUR NAME"))
+            self.assertEqual([], index.complete("what is their"))
+            self.assertEqual([], index.complete("?!"))
+
+        index = NormalizedIndex.from_trie(self.trie)
+        index.add_sentence("where", 2)
+        self.assertEqual(["where"], index.complete("WHERE"))
+        index.add_sentence("Why?", 3)
+        self.assertEqual(["Why?", "where"], index.complete("wh", n=2))
+
+    def test_ties(self):
+        """
+        Test to verify that the index ranks equally frequent sentences in the same order as the trie.
+        """
+        trie = Trie.from_counts({"x ab": 1, "x ba": 1, "x a": 1, "x bb": 2})
+        trie.cache_top_completions(3)
+        for trie in (trie, CompactTrie.from_trie(trie)):
+            (_, node) = trie.contains(trie.root, "x ")
+            expected = trie.top_completions(node, prefix="x ", n=4)
+            self.assertEqual(["x bb", "x a", "x ab", "x ba"], expected)
+            self.assertEqual(expected, NormalizedIndex.from_trie(trie).complete("X", n=4))
+
+
+class TestInfixIndex(unittest.TestCase):
+
+    def setUp(self):
+        (self.trie, self.compact_trie) = sample_tries()
+
+    def test_complete(self):
+        """
+        Test to verify that the end of a prefix is completed from the sentences containing it at a word start, the
+        most frequent first, keeping the longest matching end of the prefix, and that live additions are indexed.
+        """
+        index = InfixIndex.from_trie(self.trie, min_chars=4)
+        self.assertEqual(["Hello. What is your address?", "Hello. What is your name?"],
+                         index.complete("Hello. What is your"))
+        self.assertEqual(["So your address?", "So your name?"], index.complete("So YOUR"))
+        self.assertEqual([], index.complete("So you"))
+        self.assertEqual([], index.complete("What is their"))
+
+        index.add_sentence("Is your order late?", 3)
+        self.assertEqual(["So your order late?", "So your address?"], index.complete("So your", n=2))
+
+        # Suffixes tied on their first chars are sorted by the following ones
+        texts = ["ab ab ab abc", "ab ab ab abd", "ab ab", "b", "ab ab ab abc"]
+        entries = [(text_id, offset) for text_id, text in enumerate(texts) for offset in range(len(text))]
+        expected = sorted(entries, key=lambda entry: texts[entry[0]][entry[1]:])
+        sort_suffixes(entries, texts, window=1)
+        self.assertEqual([texts[text_id][offset:] for text_id, offset in expected],
+                         [texts[text_id][offset:] for text_id, offset in entries])
+
+        # A batch of sentences is merged into the suffix array as if the index was built with them
+        pairs = [("Is your order {} late?".format(i), i + 1) for i in range(50)] + [("Is your order late?", 1)]
+        index.add_sentences(pairs)
+        counts = dict(zip(index.sentences, index.counts))
+        rebuilt = InfixIndex(counts, min_chars=4)
+        self.assertEqual([rebuilt._suffix(entry) for entry in range(len(rebuilt))],
+                         [index._suffix(entry) for entry in range(len(index))])
+        self.assertEqual(rebuilt.complete("So your order", n=5), index.complete("So your order", n=5))
+        self.assertEqual(4, counts["Is your order late?"])
+
+
+class TestNumpyGRU(unittest.TestCase):
+
+    def setUp(self):
+        self.model = NumpyGRU.from_checkpoint("data/model_weights.h5")
+
+    def test_predict(self):
+        """
+        Test to verify that NumpyGRU.predict() returns next char distributions, and keeps its states between calls
+        like the stateful Keras model.
+        """
+        sequence = np.array([[44, 73, 80, 85, 1]])
+        probs = self.model.predict(sequence)
+        self.assertEqual((1, 5, self.model.vocab_size), probs.shape)
+        np.testing.assert_allclose(np.ones((1, 5)), probs.sum(axis=2), rtol=1e-5)
+
+        self.model.reset_states()
+        for t in range(sequence.shape[1]):
+            step_probs = self.model.predict(sequence[:, t:t + 1])
+        np.testing.assert_allclose(probs[:, -1], step_probs[:, 0], rtol=1e-5)
+
+    def test_quantized_weights(self):
+        """
+        Test to verify that int8 and float16 weight files are smaller than the float32 weights, load into a NumpyGRU,
+        and predict next char distributions close to the float32 model.
+        """
+        layer_weights, layer_configs = read_checkpoint("data/model_weights.h5")
+        with open("data/sentences.txt") as file_handler:
+            text = file_handler.read(4000)
+        with tempfile.TemporaryDirectory() as directory:
+            for dtype, max_kl in [("int8", 0.01), ("float16", 0.0001)]:
+                file_path = os.path.join(directory, "weights.{}.npz".format(dtype))
+                save_quantized(layer_weights, layer_configs, file_path, dtype=dtype)
+                self.assertLess(os.path.getsize(file_path), os.path.getsize("data/model_weights.h5") * 0.6)
+
+                metrics = compare_models(self.model, NumpyGRU.from_checkpoint(file_path), text, batch_size=8)
+                self.assertLess(metrics["mean_kl"], max_kl)
+                self.assertGreater(metrics["top1_agreement"], 0.95)
+
+    @unittest.skipUnless(KERAS_AVAILABLE, "Keras is not installed")
+    def test_keras_parity(self):
+        """
+        Test to verify that NumpyGRU.predict() and step() match Keras predict() on the shipped weights, loaded into
+        the same architecture in Keras, and on small GRUs of a few random seeds, with and without reset_after.
+        """
+        import keras
+        from keras.layers import Dense, Embedding, GRU, TimeDistributed
+        from keras.models import Sequential
+
+        def keras2_hard_sigmoid(x):
+            # The shipped weights were trained with the hard_sigmoid of Keras 2
+            return keras.ops.clip(0.2 * x + 0.5, 0., 1.)
+
+        sequence = np.array([[44, 73, 80, 85, 1, 44, 73, 80], [1, 2, 3, 4, 5, 6, 7, 8]])
+        layer_weights, _ = read_checkpoint("data/model_weights.h5")
+        keras_model = Sequential([Embedding(self.model.vocab_size, 32)] +
+                                 [GRU(self.model.units, return_sequences=True, reset_after=False,
+                                      recurrent_activation=keras2_hard_sigmoid) for _ in self.model.layers] +
+                                 [TimeDistributed(Dense(self.model.vocab_size, activation="softmax"))])
+        keras_model.build(sequence.shape)
+        keras_model.set_weights([weight for _, _, weights in layer_weights for weight in weights])
+        models = [(keras_model, self.model)]
+
+        for seed, reset_after in [(0, False), (1, True), (2, True)]:
+            keras.utils.set_random_seed(seed)
+            keras_model = Sequential([Embedding(self.model.vocab_size, 8),
+                                      GRU(16, return_sequences=True, reset_after=reset_after),
+                                      GRU(16, return_sequences=True, reset_after=reset_after),
+                                      TimeDistributed(Dense(self.model.vocab_size, activation="softmax"))])
+            keras_model.build(sequence.shape)
+            models.append((keras_model, NumpyGRU.from_keras_model(keras_model)))
+
+        for keras_model, model in models:
+            expected = keras_model.predict(sequence, verbose=0)
+            model.reset_states()
+            self.assertTrue(np.allclose(expected, model.predict(sequence), rtol=1e-4, atol=1e-6))
+            states = model.zero_states(len(sequence))
+            for t in range(sequence.shape[1]):
+                self.assertTrue(np.allclose(expected[:, t], model.step(sequence[:, t], states), rtol=1e-4, atol=1e-6))
+
+    @unittest.skipUnless(KERAS_AVAILABLE, "Keras is not installed")
+    def test_from_keras_model(self):
+        """
+        Test to verify that a Keras model compiled into a NumpyGRU predicts the same next char distributions as
+        Keras, stepping one char at a time with explicit states.
+        """
+        from keras.layers import Dense, Embedding, GRU, TimeDistributed
+        from keras.models import Sequential
+
+        keras_model = Sequential([Embedding(self.model.vocab_size, 8), GRU(16, return_sequences=True),
+                                  GRU(16, return_sequences=True),
+                                  TimeDistributed(Dense(self.model.vocab_size, activation="softmax"))])
+        sequence = np.array([[44, 73, 80, 85, 1]])
+        expected = keras_model.predict(sequence, verbose=0)
+
+        model = NumpyGRU.from_keras_model(keras_model)
+        states = model.zero_states(1)
+        for t in range(sequence.shape[1]):
+            np.testing.assert_allclose(expected[:, t], model.step(sequence[:, t], states), rtol=1e-4, atol=1e-6)
+
+    @unittest.skipUnless(KERAS_AVAILABLE, "Keras is not installed")
+    def test_hard_sigmoid(self):
+        """
+        Test to verify that a GRU with the hard_sigmoid recurrent activation predicts like Keras, whose hard_sigmoid
+        changed slope in Keras 3, both when compiled from the Keras model and when read from an HDF5 model file.
+        """
+        import keras
+        from keras.layers import Dense, Embedding, GRU, TimeDistributed
+        from keras.models import Sequential
+
+        keras_model = Sequential([Embedding(self.model.vocab_size, 8),
+                                  GRU(16, return_sequences=True, recurrent_activation="hard_sigmoid"),
+                                  TimeDistributed(Dense(self.model.vocab_size, activation="softmax"))])
+        sequence = np.array([[44, 73, 80, 85, 1, 44, 73]])
+        expected = keras_model.predict(sequence, verbose=0)
+        np.testing.assert_allclose(expected, NumpyGRU.from_keras_model(keras_model).predict(sequence),
+                                   rtol=1e-4, atol=1e-6)
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "model.h5")
+            keras_model.save(file_path)
+            _, layer_configs = read_checkpoint(file_path)
+            recurrent_activations = [config["recurrent_activation"] for config in layer_configs.values()
+                                     if "recurrent_activation" in config]
+            self.assertEqual(["hard_sigmoid_keras3" if keras.__version__.startswith("3.") else "hard_sigmoid"],
+                             recurrent_activations)
+            np.testing.assert_allclose(expected, NumpyGRU.from_checkpoint(file_path).predict(sequence),
+                                       rtol=1e-4, atol=1e-6)
+
+        # The shipped checkpoint was saved by Keras 2
+        self.assertIs(hard_sigmoid, self.model.layers[0].recurrent_activation)
+        with self.assertRaises(ValueError):
+            resolve_activations({"recurrent_activation": "hard_sigmoid"}, "4.0.0")
+
+    def test_batch_scheduler(self):
+        """
+        Test to verify that generations batched together give the same greedy completions as generations run alone.
+        """
+        seeds = ["Where is my ord", "Hi", "Can you help me with my acc"]
+        scheduler = BatchScheduler(self.model, window=0.05, length=64, top_n=1).start()
+        try:
+            alone = [scheduler.submit(seed).result(timeout=10) for seed in seeds]
+            futures = [scheduler.submit(seed) for seed in seeds]
+            batched = [future.result(timeout=10) for future in futures]
+        finally:
+            scheduler.stop()
+
+        self.assertEqual(alone, batched)
+        for seed, completion in zip(seeds, batched):
+            self.assertTrue(completion.startswith(seed))
+
+    def test_batch_scheduler_on_text(self):
+        """
+        Test to verify that a generation passes its chars on to on_text as they are generated, and stops as soon
+        as on_text returns False.
+        """
+        scheduler = BatchScheduler(self.model, length=64, top_n=1).start()
+        chars = []
+        try:
+            complete = scheduler.submit("Hi", on_text=chars.append).result(timeout=10)
+            streamed = "Hi" + "".join(chars)
+            del chars[:]
+            stopped = scheduler.submit("Hi", on_text=lambda char: chars.append(char) or len(chars) < 3)
+            stopped = stopped.result(timeout=10)
+        finally:
+            scheduler.stop()
+
+        self.assertEqual(complete, streamed)
+        self.assertEqual(complete[:5], stopped)
+
+    def test_batch_scheduler_on_text_error(self):
+        """
+        Test to verify that a generation whose on_text raises fails on its own, while the rest of its batch, and
+        later generations, complete.
+        """
+        def closed_loop(char):
+            raise RuntimeError("Event loop is closed")
+
+        scheduler = BatchScheduler(self.model, window=0.05, length=64, top_n=1).start()
+        try:
+            alone = scheduler.submit("Hi").result(timeout=10)
+            failing = scheduler.submit("Hi", on_text=closed_loop)
+            batched = scheduler.submit("Hi")
+            with self.assertRaises(RuntimeError):
+                failing.result(timeout=10)
+            self.assertEqual(alone, batched.result(timeout=10))
+            self.assertEqual(alone, scheduler.submit("Hi").result(timeout=10))
+        finally:
+            scheduler.stop()
+
+    def test_state_cache(self):
+        """
+        Test to verify that generations resumed from cached prefix states match generations from scratch.
+        """
+        seeds = ["Where is my ord", "Where is my orde", "Where is my order"]
+        uncached = BatchScheduler(self.model, length=64, top_n=1).start()
+        state_cache = StateCache()
+        cached = BatchScheduler(self.model, length=64, top_n=1, state_cache=state_cache).start()
+        try:
+            for seed in seeds:
+                self.assertEqual(uncached.submit(seed).result(timeout=10), cached.submit(seed).result(timeout=10))
+        finally:
+            uncached.stop()
+            cached.stop()
+
+        self.assertEqual(len(seeds), len(state_cache))
+        self.assertEqual(2, state_cache.hits)
+
+        state_cache.max_bytes = state_cache.num_bytes - 1
+        state_cache.put("Hi", np.zeros((2, 128)))
+        self.assertLessEqual(state_cache.num_bytes, state_cache.max_bytes)
+
+    def test_beam_search(self):
+        """
+        Test to verify that beam search returns n distinct completions of the seed, most likely first.
+        """
+        seed = "Where is my ord"
+        completions = beam_search(self.model, seed, n=3, beam_width=5)
+        self.assertEqual(3, len(completions))
+        self.assertEqual(3, len(set(completions)))
+        for completion in completions:
+            self.assertTrue(completion.startswith(seed))
+        # With a single beam, the most likely completion is the greedy one
+        scheduler = BatchScheduler(self.model, length=128, top_n=1).start()
+        try:
+            greedy = scheduler.submit(seed).result(timeout=10)
+        finally:
+            scheduler.stop()
+        self.assertEqual([greedy], beam_search(self.model, seed, n=1))
+
+    def test_rnn_executor_queue_depth(self):
+        """
+        Test to verify that RNNExecutor rejects completions beyond its queue depth, and frees a slot on cancellation.
+        """
+        # The scheduler is not started, so submitted completions stay queued
+        executor = RNNExecutor(self.model, batch_scheduler=BatchScheduler(self.model), max_pending=1)
+        future = executor.submit("Hi")
+        with self.assertRaises(QueueFullError):
+            executor.submit("Hello")
+        self.assertTrue(future.cancel())
+        executor.submit("Hello")
+
+    def test_rnn_executor_budget(self):
+        """
+        Test to verify that a completion with a latency budget returns the text generated so far when the budget
+        passes, and that later completions are limited to the chars that fit in their budget.
+        """
+        scheduler = BatchScheduler(self.model, length=512, top_n=1).start()
+        executor = RNNExecutor(self.model, batch_scheduler=scheduler)
+        try:
+            self.assertIsNone(executor.max_length(1.))
+            partial = asyncio.run(executor.complete("Hi", budget=0.))
+            self.assertTrue(partial.startswith("Hi"))
+            self.assertIsNotNone(scheduler.step_seconds)
+            self.assertEqual(max(1, int(0.001 / scheduler.step_seconds)), executor.max_length(0.001))
+        finally:
+            scheduler.stop()
+
+    def test_rnn_executor_without_model(self):
+        """
+        Test to verify that RNNExecutor rejects completions until a model is swapped in, as with --fast-start.
+        """
+        executor = RNNExecutor(None)
+        with self.assertRaises(ModelNotReadyError):
+            executor.submit("Hi")
+        executor.swap_model(self.model, batch_scheduler=BatchScheduler(self.model))
+        self.assertIsNotNone(executor.submit("Hi"))
+
+
+class TestBatchGenerator(unittest.TestCase):
+
+    def test_batches(self):
+        """
+        Test to verify that lazily sliced batches match the rows of the whole sequence split into batches and rolled
+        by one row per epoch, with sparse or one-hot labels.
+        """
+        sequence = np.arange(2 * 3 * 4 + 5) % VOCAB_SIZE
+        x = sequence[:24].reshape(2, 12)
+        y = sequence[1:25].reshape(2, 12)
+        batches = batch_generator(sequence, batch_size=2, seq_len=4, sparse_labels=True)
+        for epoch in range(2):
+            for batch in range(3):
+                x_batch, y_batch = next(batches)
+                np.testing.assert_array_equal(np.roll(x, -epoch, axis=0)[:, batch * 4:(batch + 1) * 4], x_batch)
+                np.testing.assert_array_equal(np.roll(y, -epoch, axis=0)[:, batch * 4:(batch + 1) * 4], y_batch[:, :, 0])
+
+        x_batch, y_batch = next(batch_generator(sequence, batch_size=2, seq_len=4, one_hot_labels=True))
+        self.assertEqual((2, 4, VOCAB_SIZE), y_batch.shape)
+        np.testing.assert_array_equal(y[:, :4], y_batch.argmax(axis=2))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_eviction_and_invalidation(self):
+        """
+        Test to verify that ResponseCache evicts least recently used entries, and is cleared when its sources change.
+        """
+        trie, model = object(), object()
+        cache = ResponseCache(max_entries=2)
+        self.assertIsNone(cache.get(("Wh", 3, "sample"), (trie, model)))
+        cache.put(("Wh", 3, "sample"), ["What?"], (trie, model))
+        cache.put(("Hi", 3, "sample"), "Hi there.", (trie, model))
+        self.assertEqual(["What?"], cache.get(("Wh", 3, "sample"), (trie, model)))
+        cache.put(("Ok", 3, "sample"), "Ok.", (trie, model))
+
+        self.assertIsNone(cache.get(("Hi", 3, "sample"), (trie, model)))
+        self.assertEqual("Ok.", cache.get(("Ok", 3, "sample"), (trie, model)))
+        self.assertEqual(1, cache.evictions)
+
+        self.assertIsNone(cache.get(("Wh", 3, "sample"), (object(), model)))
+        self.assertEqual(0, len(cache))
+        self.assertEqual(2, cache.stats()["hits"])
+        self.assertEqual(1, cache.stats()["invalidations"])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_workloads_and_summaries(self):
+        """
+        Test to verify that the keystroke stream types every prefix of the sampled sentences, that request logs
+        mix JSON and plain lines, and that summaries and comparisons of results are computed per metric.
+        """
+        self.assertEqual(["H", "Hi", "Hi!"], keystroke_prefixes(["Hi!"], num_sentences=5))
+        self.assertEqual(keystroke_prefixes(["Hi!", "Ok."], seed=1), keystroke_prefixes(["Hi!", "Ok."], seed=1))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as file_handler:
+            file_handler.write('{"q": "What is", "mode": "beam"}\nWhere is my\n\n"quoted"\n')
+        try:
+            self.assertEqual([{"q": "What is", "mode": "beam"}, {"q": "Where is my"}, {"q": '"quoted"'}],
+                             read_request_log(file_handler.name))
+        finally:
+            os.remove(file_handler.name)
+
+        summary = latency_summary([0.001] * 99 + [0.1])
+        self.assertAlmostEqual(1., summary["p50"])
+        self.assertAlmostEqual(100., summary["max"])
+        self.assertEqual({}, latency_summary([]))
+
+        baseline = {"qps": 100., "latency_ms": {"p99": 20.}, "tiers": {"rnn": 0}}
+        candidate = {"qps": 150., "latency_ms": {"p99": 10.}, "tiers": {"rnn": 3}}
+        self.assertEqual({"qps": 1.5, "latency_ms": {"p99": 0.5}, "tiers": {}}, compare_results(baseline, candidate))
+
+    @unittest.skipUnless(KERAS_AVAILABLE, "Keras is not installed")
+    def test_micro_keras(self):
+        """
+        Test to verify that micro times rnn.generate_text() on a stateful Keras model saved with its training batch
+        shape, and rejects weights files, which Keras cannot load as a model.
+        """
+        from keras import Input
+        from keras.layers import Dense, Embedding, GRU, TimeDistributed
+        from keras.models import Sequential
+
+        model = Sequential([Input(batch_shape=(4, 8)), Embedding(VOCAB_SIZE, 8),
+                            GRU(16, return_sequences=True, stateful=True),
+                            TimeDistributed(Dense(VOCAB_SIZE, activation="softmax"))])
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint_path = os.path.join(directory, "model.h5")
+            model.save(checkpoint_path)
+            sentences_path = os.path.join(directory, "sentences.txt")
+            with open(sentences_path, "w") as file_handler:
+                file_handler.write("What is your name?\nWhere is my order?\nThanks for your help.\n")
+            output_path = os.path.join(directory, "results.json")
+            command = [sys.executable, "benchmark.py", "micro", "--inference-engine", "keras", "--sentences",
+                       sentences_path, "--num-sentences", "3", "--generations", "2", "--length", "5",
+                       "--output", output_path]
+            subprocess.run(command + ["--checkpoint-path", checkpoint_path], check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, timeout=120)
+            with open(output_path) as file_handler:
+                results = json.load(file_handler)["results"]
+            self.assertGreater(results["generate_text_per_char_ms"], 0.)
+
+            process = subprocess.run(command + ["--checkpoint-path", "data/model_weights.h5"],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=120)
+            self.assertEqual(2, process.returncode)
+            self.assertIn(b"requires a model saved by rnn.py train", process.stderr)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_prometheus_text_format(self):
+        """
+        Test to verify that counters, histograms and cache stats render in the Prometheus text format, with
+        cumulative histogram buckets.
+        """
+        registry = Registry()
+        requests = registry.register(Counter("requests_total", "Requests.", ["endpoint", "status"]))
+        latency = registry.register(Histogram("latency_seconds", "Latency.", ["tier"], buckets=(0.01, 0.1)))
+        requests.inc("autocomplete", 200)
+        requests.inc("autocomplete", 200)
+        latency.observe(0.005, "trie")
+        latency.observe(0.05, "trie")
+        latency.observe(1., "trie")
+        cache = ResponseCache()
+        cache.put(("Hi", 3, "sample"), ["Hi there."])
+
+        lines = registry.render(extra=cache_metrics({"response_cache": cache, "state_cache": None})).splitlines()
+        self.assertIn("# TYPE requests_total counter", lines)
+        self.assertIn('requests_total{endpoint="autocomplete",status="200"} 2', lines)
+        self.assertIn('latency_seconds_bucket{tier="trie",le="0.01"} 1', lines)
+        self.assertIn('latency_seconds_bucket{tier="trie",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{tier="trie",le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_count{tier="trie"} 3', lines)
+        self.assertIn('autocomplete_cache_entries{cache="response_cache"} 1', lines)
+        self.assertFalse(any("state_cache" in line for line in lines))
+        self.assertEqual("rnn", slowest_tier(["trie", "rnn", "fuzzy"]))
+        self.assertEqual("none", slowest_tier([]))
+
+    def test_sample_stacks(self):
+        """
+        Test to verify that the sampling profiler collapses the stacks of the other threads for flame graphs.
+        """
+        done = threading.Event()
+        thread = threading.Thread(target=done.wait, name="sleeper")
+        thread.start()
+        try:
+            stacks = sample_stacks(0.05, interval=0.01)
+        finally:
+            done.set()
+            thread.join()
+        sleeper = [stack for stack in stacks if stack.startswith("sleeper;")]
+        self.assertTrue(sleeper)
+        self.assertIn("wait (threading.py:", sleeper[0])
+
+
+class TestServer(AsyncHTTPTestCase):
+    """
+    Requests to the endpoints of make_app(), served from a small trie and the shipped RNN(GRU) weights.
+    """
+    sentences = ["What is your account number?", "What is your order number?", "Where is my order?",
+                 "What is your account number?", "Thanks for your help."]
+    backend = "object"
+
+    def setUp(self):
+        counts = {}
+        for sentence in self.sentences:
+            counts[sentence] = counts.get(sentence, 0) + 1
+        trie = Trie.from_counts(counts)
+        if self.backend == "compact":
+            trie = CompactTrie.from_trie(trie)
+        else:
+            trie.cache_top_completions(3)
+        self.model = NumpyGRU.from_checkpoint("data/model_weights.h5")
+        self.scheduler = BatchScheduler(self.model, length=64).start()
+        self.rnn_executor = RNNExecutor(self.model, batch_scheduler=self.scheduler, timeout=10.)
+        self.response_cache = ResponseCache()
+        self.trie = trie
+        super(TestServer, self).setUp()
+
+    def tearDown(self):
+        super(TestServer, self).tearDown()
+        self.scheduler.stop()
+
+    def get_app(self):
+        self.reloaded_trie = Trie.from_counts({"Reloaded.": 1})
+        return make_app(self.trie, self.rnn_executor, response_cache=self.response_cache, admin_token="s3",
+                        reload_trie=lambda: {"trie": self.reloaded_trie}, profiler=True,
+                        normalized_index=NormalizedIndex.from_trie(self.trie),
+                        infix_index=InfixIndex.from_trie(self.trie, min_chars=4))
+
+    def fetch_json(self, path, **kwargs):
+        """
+        Returns:
+            (status code, decoded JSON body, or None for the HTML error pages of Tornado).
+        """
+        response = self.fetch(path, **kwargs)
+        is_json = response.headers.get("Content-Type", "").startswith("application/json")
+        return response.code, json.loads(response.body) if is_json else None
+
+    def fetch_events(self, path):
+        """
+        Returns:
+            list of (event, decoded data) pairs of a Server-Sent Events response.
+        """
+        response = self.fetch(path)
+        self.assertEqual(200, response.code)
+        self.assertEqual("text/event-stream", response.headers["Content-Type"])
+        events = []
+        for block in response.body.decode().split("\n\n"):
+            if block:
+                event, data = block.split("\n")
+                events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+        return events
+
+    def test_autocomplete(self):
+        """
+        Test to verify that each tier answers the prefixes it should, and that an unknown mode is rejected.
+        """
+        code, response = self.fetch_json("/autocomplete?q=What%20is")
+        self.assertEqual(200, code)
+        self.assertEqual({"Completions": ["What is your account number?", "What is your order number?"],
+                          "Tier": "trie"}, response)
+        self.assertEqual("normalized", self.fetch_json("/autocomplete?q=what%20IS")[1]["Tier"])
+        self.assertEqual("fuzzy", self.fetch_json("/autocomplete?q=Whet%20is")[1]["Tier"])
+        self.assertEqual("infix", self.fetch_json("/autocomplete?q=my%20ord")[1]["Tier"])
+
+        code, response = self.fetch_json("/autocomplete?q=Zzqx%20blorp")
+        self.assertEqual(200, code)
+        self.assertEqual("rnn", response["Tier"])
+        self.assertIsInstance(response["Completions"], str)
+        code, response = self.fetch_json("/autocomplete?q=Zzqx%20blorp&mode=beam")
+        self.assertEqual("rnn", response["Tier"])
+        self.assertEqual(3, len(response["Completions"]))
+        self.assertEqual(400, self.fetch("/autocomplete?q=Zzqx%20blorp&mode=greedy").code)
+
+    def test_autocomplete_budget(self):
+        """
+        Test to verify that a latency budget is checked, and that a tight one still answers, with what was found in
+        time.
+        """
+        for budget_ms in ["abc", "0", "-5", "nan"]:
+            self.assertEqual(400, self.fetch("/autocomplete?q=What&budget_ms=" + budget_ms).code, budget_ms)
+        code, response = self.fetch_json("/autocomplete?q=What%20is&budget_ms=0.001")
+        self.assertEqual((200, "trie"), (code, response["Tier"]))
+        code, response = self.fetch_json("/autocomplete?q=Zzqx%20blorp&budget_ms=1")
+        self.assertEqual(200, code)
+        self.assertIn(response["Tier"], ("rnn", "none"))
+        self.assertEqual(["Completions", "Tier"], sorted(response))
+
+    def test_autocomplete_unavailable(self):
+        """
+        Test to verify that novel prefixes are answered with 503 and no completions while the model is not loaded,
+        and prefixes of the trie with 200 still.
+        """
+        self.rnn_executor.swap_model(None)
+        response = self.fetch("/autocomplete?q=Zzqx%20blorp")
+        self.assertEqual(503, response.code)
+        self.assertEqual("1", response.headers["Retry-After"])
+        self.assertEqual({"Completions": [], "Tier": "none"}, json.loads(response.body))
+        self.assertEqual(200, self.fetch("/autocomplete?q=What").code)
+
+        code, response = self.fetch_json("/autocomplete/batch", method="POST",
+                                         body=json.dumps({"prefixes": ["What is", "Zzqx blorp"]}))
+        self.assertEqual(200, code)
+        self.assertEqual(["trie", "none"], response["Tiers"])
+        self.assertEqual([], response["Completions"][1])
+
+        events = self.fetch_events("/autocomplete/stream?q=Zzqx%20blorp")
+        self.assertEqual([("completions", []), ("error", {"status": 503}), ("done", None)], events)
+
+    def test_autocomplete_timeout(self):
+        """
+        Test to verify that a novel prefix whose RNN completion times out is answered with 504 and no completions.
+        """
+        self.rnn_executor.timeout = 1e-6
+        code, response = self.fetch_json("/autocomplete?q=Zzqx%20blorp")
+        self.assertEqual(504, code)
+        self.assertEqual({"Completions": [], "Tier": "none"}, response)
+        events = self.fetch_events("/autocomplete/stream?q=Zzqx%20blorp")
+        self.assertEqual(("error", {"status": 504}), events[-2])
+
+    def test_stream(self):
+        """
+        Test to verify that the stream sends the trie completions of known prefixes at once, and the chars of the
+        RNN(GRU) completion of novel prefixes as they are generated, then "done".
+        """
+        events = self.fetch_events("/autocomplete/stream?q=Where")
+        self.assertEqual([("completions", ["Where is my order?"]), ("done", None)], events)
+
+        events = self.fetch_events("/autocomplete/stream?q=Zzqx%20blorp")
+        self.assertEqual(("completions", []), events[0])
+        self.assertEqual(("done", None), events[-1])
+        self.assertEqual({"text"}, {event for event, _ in events[1:-1]})
+        self.assertTrue("".join(text for _, text in events[1:-1]))
+
+        events = self.fetch_events("/autocomplete/stream?q=Zzqx%20blorp&mode=beam")
+        self.assertEqual(["completions", "completions", "done"], [event for event, _ in events])
+        self.assertEqual(3, len(events[1][1]))
+        events = self.fetch_events("/autocomplete/stream?q=Zzqx%20blorp&mode=greedy")
+        self.assertEqual("error", events[1][0])
+        self.assertEqual(400, events[1][1]["status"])
+
+    def test_batch(self):
+        """
+        Test to verify that the batch endpoint answers every prefix in order, with the tier that answered each.
+        """
+        body = json.dumps({"prefixes": ["What is", "Zzqx blorp"]})
+        code, response = self.fetch_json("/autocomplete/batch", method="POST", body=body)
+        self.assertEqual(200, code)
+        self.assertEqual(["What is your account number?", "What is your order number?"], response["Completions"][0])
+        self.assertTrue(response["Completions"][1].startswith("Zzqx blorp"))
+        self.assertEqual(["trie", "rnn"], response["Tiers"])
+
+    def test_batch_invalid_input(self):
+        """
+        Test to verify that batch bodies that are not a JSON object with a list of str prefixes are rejected with
+        400, rather than completed char by char or failing with 500.
+        """
+        for body in ['{"prefixes": "What"}', '{"prefixes": [1]}', '["What"]', '"What"', 'not json', '{}',
+                     '{"prefixes": ["What"], "mode": 1}', '{"prefixes": ["What"], "budget_ms": [1]}']:
+            self.assertEqual(400, self.fetch("/autocomplete/batch", method="POST", body=body).code, body)
+
+    def test_query_argument(self):
+        """
+        Test to verify that both trie backends answer the empty prefix with the top completions of the whole trie,
+        and that a missing q arg is rejected with 400.
+        """
+        code, response = self.fetch_json("/autocomplete?q=")
+        self.assertEqual(200, code)
+        self.assertEqual(["What is your account number?", "What is your order number?", "Where is my order?"],
+                         response["Completions"])
+        self.assertEqual("trie", response["Tier"])
+        self.assertEqual(400, self.fetch("/autocomplete").code)
+        self.assertEqual(400, self.fetch("/autocomplete/stream").code)
+        body = self.fetch("/autocomplete/stream?q=").body.decode()
+        self.assertIn('"What is your account number?"', body)
+        self.assertIn("event: done", body)
+
+    def test_admin_sentences_malformed(self):
+        """
+        Test to verify that a body with a malformed sentence adds none of its sentences, even from an earlier chunk,
+        and leaves the cached responses as they were.
+        """
+        headers = {"X-Admin-Token": "s3"}
+        self.fetch("/autocomplete?q=Whoa")
+        num_cached = self.response_cache.stats()["entries"]
+        body = json.dumps({"sentences": ["Whoa there."] * 1500 + [["Whoa, not counted.", 0]]})
+        response = self.fetch("/admin/sentences", method="POST", body=body, headers=headers)
+        self.assertEqual(400, response.code)
+        self.assertEqual(num_cached, self.response_cache.stats()["entries"])
+        (contains, _) = self.trie.contains(self.trie.root, "Whoa")
+        self.assertFalse(contains)
+
+    def test_admin_reload_disabled(self):
+        """
+        Test to verify that a reload of a model that cannot be reloaded is refused before the trie is reloaded.
+        """
+        headers = {"X-Admin-Token": "s3"}
+        response = self.fetch("/admin/reload", method="POST", body="{}", headers=headers)
+        self.assertEqual(400, response.code)
+        code, response = self.fetch_json("/autocomplete?q=What")
+        self.assertEqual("trie", response["Tier"])
+        self.assertNotIn("Reloaded.", response["Completions"])
+        code, response = self.fetch_json("/admin/reload", method="POST", body='{"model": false}', headers=headers)
+        self.assertEqual({"trie"}, set(response["reloaded"]))
+        self.assertEqual(["Reloaded."], self.fetch_json("/autocomplete?q=R")[1]["Completions"])
+
+    def test_batch_limit(self):
+        """
+        Test to verify that batches of more than max_batch_prefixes prefixes are rejected.
+        """
+        body = json.dumps({"prefixes": ["What"] * 1001})
+        self.assertEqual(400, self.fetch("/autocomplete/batch", method="POST", body=body).code)
+        body = json.dumps({"prefixes": ["What"] * 1000})
+        code, response = self.fetch_json("/autocomplete/batch", method="POST", body=body)
+        self.assertEqual(200, code)
+        self.assertEqual(["trie"] * 1000, response["Tiers"])
+
+    def test_admin(self):
+        """
+        Test to verify that the admin endpoints require the admin token, add sentences to an object trie only, and
+        return sampled stacks.
+        """
+        headers = {"X-Admin-Token": "s3"}
+        for path, method, body in [("/admin/sentences", "POST", '{"sentences": []}'), ("/admin/reload", "POST", "{}"),
+                                   ("/admin/profile?seconds=0.01", "GET", None)]:
+            self.assertEqual(403, self.fetch(path, method=method, body=body).code, path)
+            self.assertEqual(403, self.fetch(path, method=method, body=body, headers={"X-Admin-Token": "s4"}).code)
+
+        self.fetch("/autocomplete?q=Whoa")
+        body = json.dumps({"sentences": ["Whoa there.", ["Whoa, slow down.", 2], "  "]})
+        code, response = self.fetch_json("/admin/sentences", method="POST", body=body, headers=headers)
+        if self.backend == "compact":
+            self.assertEqual(400, code)
+        else:
+            self.assertEqual((200, {"added": 2}), (code, response))
+            self.assertEqual(0, self.response_cache.stats()["entries"])
+            code, response = self.fetch_json("/autocomplete?q=Whoa")
+            self.assertEqual({"Completions": ["Whoa, slow down.", "Whoa there."], "Tier": "trie"}, response)
+        for body in ['{"sentences": "Whoa"}', '[]', 'not json']:
+            self.assertEqual(400, self.fetch("/admin/sentences", method="POST", body=body, headers=headers).code)
+
+        response = self.fetch("/admin/profile?seconds=0.05", headers=headers)
+        self.assertEqual(200, response.code)
+        self.assertTrue(all(re.match(r"^\S.* \d+$", line) for line in response.body.decode().splitlines()))
+        for seconds in ["abc", "0", "61"]:
+            self.assertEqual(400, self.fetch("/admin/profile?seconds=" + seconds, headers=headers).code)
+
+    @gen_test
+    async def test_sentences_ingested_while_indexes_are_built(self):
+        """
+        Test to verify that a --fast-start server caches the top completions of its trie in the background, and that
+        the sentences ingested while it builds its trie indexes are held back, then added to the trie and the new
+        indexes.
+        """
+        if self.backend == "compact":
+            return
+        models = self._app.settings["models"]
+        self.trie = Trie.from_counts({sentence: 1 for sentence in self.sentences})
+        models.update(trie=self.trie, normalized_index=None, infix_index=None)
+        model_loading = threading.Event()
+        args = argparse.Namespace(top_k=3, no_normalized_index=False, infix_min_chars=4)
+        loading = asyncio.ensure_future(load_in_background(
+            models, args, lambda: model_loading.wait(10) and (self.model, self.scheduler, None)))
+
+        body = json.dumps({"sentences": ["Whoa there."]})
+        response = await self.http_client.fetch(self.get_url("/admin/sentences"), method="POST", body=body,
+                                                headers={"X-Admin-Token": "s3"})
+        self.assertEqual({"added": 1}, json.loads(response.body))
+        self.assertFalse(self.trie.contains(self.trie.root, "Whoa")[0])
+
+        model_loading.set()
+        await loading
+        self.assertEqual(3, self.trie.top_k)
+        self.assertTrue(self.trie.contains(self.trie.root, "Whoa")[0])
+        self.assertEqual(["Whoa there."], models["normalized_index"].complete("whoa"))
+        self.assertEqual(["Say Whoa there."], models["infix_index"].complete("Say Whoa there"))
+        self.assertIsNone(models["pending_sentences"])
+
+    def test_ready(self):
+        """
+        Test to verify that /ready reports the available completion paths, with 503 until the model is loaded.
+        """
+        code, response = self.fetch_json("/ready")
+        self.assertEqual(200, code)
+        self.assertEqual({"trie": True, "rnn": True, "normalized_index": True, "infix_index": True}, response)
+        self.rnn_executor.swap_model(None)
+        code, response = self.fetch_json("/ready")
+        self.assertEqual(503, code)
+        self.assertFalse(response["rnn"])
+
+    def test_metrics(self):
+        """
+        Test to verify that /metrics counts requests by endpoint and status, and that /cache/stats returns the cache
+        counters as JSON.
+        """
+        before = REQUESTS.value("autocomplete", 200)
+        self.fetch("/autocomplete?q=What")
+        self.fetch("/autocomplete?q=What")
+        response = self.fetch("/metrics")
+        self.assertEqual(200, response.code)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        metrics = response.body.decode()
+        self.assertIn('autocomplete_requests_total{{endpoint="autocomplete",status="200"}} {}'.format(before + 2),
+                      metrics)
+        self.assertIn('autocomplete_cache_hits_total{cache="response_cache"} 1', metrics)
+        self.assertIn("autocomplete_request_duration_seconds_bucket", metrics)
+
+        code, response = self.fetch_json("/cache/stats")
+        self.assertEqual(200, code)
+        self.assertEqual({"hits": 1, "misses": 1, "entries": 1}, {stat: response["response_cache"][stat]
+                                                                   for stat in ("hits", "misses", "entries")})
+
+
+class TestCompactServer(TestServer):
+    """
+    The requests of TestServer, served from a CompactTrie.
+    """
+    backend = "compact"
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_main_imports_lazily(self):
+        """
+        Test to verify that importing the server does not import Keras or NLTK, which only the keras engine and
+        training text ingestion use.
+        """
+        code = "import sys, main; print(sorted({'keras', 'tensorflow', 'nltk'} & set(sys.modules)))"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual("[]", output.decode().strip())
+
+
+class TestPrefork(unittest.TestCase):
+
+    def test_supervisor_restarts_failed_workers(self):
+        """
+        Test to verify that Supervisor forks every worker, forks a failed worker again, and returns once all
+        workers have exited successfully.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            supervisor = Supervisor(2, max_restarts=1)
+            worker_id = supervisor.start()
+            if worker_id is not None:
+                # Worker 1 fails the first time it runs
+                marker = os.path.join(tmp_dir, "worker{}".format(worker_id))
+                failed = worker_id == 1 and not os.path.exists(marker)
+                open(marker, "a").close()
+                os._exit(1 if failed else 0)
+
+            self.assertEqual(1, supervisor.num_restarts)
+            self.assertEqual({}, supervisor.children)
+            self.assertEqual(["worker0", "worker1"], sorted(os.listdir(tmp_dir)))
+
+    def test_shutdown_finishes_requests_in_flight(self):
+        """
+        Test to verify that a worker receiving SIGTERM during a slow request stops accepting connections, but
+        answers the request before exiting.
+        """
+        server_code = """
+import asyncio, sys, tornado.ioloop, tornado.web
+from main import tracked_handler
+from prefork import ActiveRequests, shutdown_gracefully
+
+class slow_handler(tracked_handler):
+    async def get(self):
+        await asyncio.sleep(1)
+        self.write("done")
+
+async def main():
+    app = tornado.web.Application([(r"/slow", slow_handler)], active_requests=ActiveRequests())
+    server = app.listen(0, "127.0.0.1")
+    shutdown_gracefully(server, active_requests=app.settings["active_requests"])
+    port = next(iter(server._sockets.values())).getsockname()[1]
+    print(port, flush=True)
+    await asyncio.Event().wait()
+
+try:
+    asyncio.run(main())
+except RuntimeError:
+    # The shutdown stops the loop before main() returns
+    pass
+"""
+        worker = subprocess.Popen([sys.executable, "-c", server_code], stdout=subprocess.PIPE,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            port = int(worker.stdout.readline())
+            responses = []
+            client = threading.Thread(target=lambda: responses.append(
+                urllib.request.urlopen("http://127.0.0.1:{}/slow".format(port), timeout=10)))
+            client.start()
+            time.sleep(0.3)
+            worker.send_signal(signal.SIGTERM)
+            client.join()
+            self.assertEqual(200, responses[0].status)
+            self.assertEqual(b"done", responses[0].read())
+            self.assertEqual(0, worker.wait(timeout=10))
+        finally:
+            if worker.poll() is None:
+                worker.kill()
+            worker.stdout.close()
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
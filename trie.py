@@ -1,13 +1,22 @@
 # Write function to process dataset into usable data model
 # Construct a prefix tree (trie) from the dataset
 
+import gc
+import heapq
 import os.path
 import json
 import pickle
 import sys
-import nltk
-nltk.download("punkt")
-from nltk.tokenize import sent_tokenize
+from compact_trie import CompactTrie
+from ingest import count_sentences, count_sentences_file, sent_tokenize
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# Version of the pickled Trie, bumped whenever the attributes of Trie or TrieNode change, so that a trie pickled by
+# an older version is rebuilt instead of failing on the first lookup
+TRIE_FORMAT_VERSION = 2
 
 
 class TrieNode(object):
@@ -18,54 +27,166 @@ class TrieNode(object):
         self.char = char
         self.children = []
         self.is_end_of_sentence = False
+        # Number of times the sentence ending at this node was added, and the largest count below this node
+        self.count = 0
+        self.max_count = 0
+        # Top completions below this node, filled in by Trie.cache_top_completions()
+        self.completions = None
 
 
 class Trie(object):
     """
     Implementation of a trie: https://en.wikipedia.org/wiki/Trie
     Each node in the trie is a letter of a sentence.  All descendants of a node share a common prefix.
+    Completions are ranked by the number of times each sentence was added, ties broken by insertion order.
     """
     def __init__(self, root: TrieNode):
         self.root = root
-
-    def add_sentence(self, root: TrieNode, sentence: str):
+        self.format_version = TRIE_FORMAT_VERSION
+        # Number of completions cached on each node, 0 if no completions are cached
+        self.top_k = 0
+        # Tie-breaking rank of the next sentence added while completions are cached
+        self.next_rank = 0
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        Build a Trie in one pass over the distinct sentences in sorted order, instead of adding them one by one.
+        In sorted order, a sentence shares its path with the previous sentence down to their common prefix, so
+        only new nodes are created and no children are scanned.  The children of each node are then ordered by
+        first occurrence, so the Trie is the same as one built by add_sentence() in corpus order.
+        Args:
+            counts (dict): maps each distinct sentence to its count, in order of first occurrence.
+        Returns:
+            Trie object.
+        """
+        root = TrieNode("")
+        no_key = len(counts)
+        # Nodes along the previous sentence, the first occurrence of any sentence below each of them, and the
+        # first occurrences below each of their finished children
+        path = [root]
+        keys = [no_key]
+        child_keys = [None]
+
+        first_seen = {sentence: index for index, sentence in enumerate(counts)}
+        # Nothing built here is garbage, so keep the collector from traversing the growing trie over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            previous = ""
+            # Empty sentences are not added, and the empty sentence at the end finishes every node
+            for sentence in sorted(sentence for sentence in counts if sentence) + [""]:
+                common = len(os.path.commonprefix([previous, sentence]))
+
+                # Finish the nodes below the common prefix, handing their first occurrences and counts up
+                while len(path) > common + 1:
+                    node, key, node_child_keys = path.pop(), keys.pop(), child_keys.pop()
+                    if len(node.children) > 1:
+                        node.children = [child for _, child in sorted(zip(node_child_keys, node.children))]
+                    parent = path[-1]
+                    if child_keys[-1] is None:
+                        child_keys[-1] = [key]
+                    else:
+                        child_keys[-1].append(key)
+                    if key < keys[-1]:
+                        keys[-1] = key
+                    if node.max_count > parent.max_count:
+                        parent.max_count = node.max_count
+                if not sentence:
+                    break
+
+                for character in sentence[common:]:
+                    node = TrieNode(character)
+                    path[-1].children.append(node)
+                    path.append(node)
+                keys.extend([no_key] * (len(sentence) - common))
+                child_keys.extend([None] * (len(sentence) - common))
+                node.is_end_of_sentence = True
+                node.count = node.max_count = counts[sentence]
+                keys[-1] = first_seen[sentence]
+                previous = sentence
+
+            if len(root.children) > 1:
+                root.children = [child for _, child in sorted(zip(child_keys[0], root.children))]
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        return cls(root)
+
+    def add_sentence(self, root: TrieNode, sentence: str, count=1):
         """
         Adds a sentence to the Trie, one char at a time, from a given node.
+        Adding a sentence that already exists increments its count.
+        If completions are cached, the cached completions of the nodes along the path are updated, and no others.
         Args:
             root (TrieNode): the TrieNode at which to begin appending a sentence.
             sentence (str): the str to append below the supplied root.
+            count (int): number of occurrences of the sentence to add.
         Returns:
             the updated Trie.
         """
-        character = sentence[0]
-
-        for child in root.children:
-
-            # If the leading char in the string is already a child, no need to add a new node
-            if character == child.char:
-
-                # Mark as end of sentence if we are looking at the last char of a string
-                if len(sentence) == 1:
-                    child.is_end_of_sentence = True
-                    return self
-
-                return self.add_sentence(child, sentence[1:])
-
-        # If the leading char is not already a child, append the char as a child of the node
-        node = TrieNode(character)
-
-        # Mark as end of sentence if we are looking at the last char of a string
-        if len(sentence) == 1:
-            node.is_end_of_sentence = True
-            root.children.append(node)
+        if not sentence:
             return self
 
-        root.children.append(node)
-        return self.add_sentence(node, sentence[1:])
+        node = root
+        path = [root]
+        for character in sentence:
+            # If the char is already a child, no need to add a new node
+            for child in node.children:
+                if character == child.char:
+                    break
+            else:
+                child = TrieNode(character)
+                node.children.append(child)
+            node = child
+            path.append(node)
+
+        # Mark as end of sentence once we have reached the last char of the string
+        node.is_end_of_sentence = True
+        node.count += count
+
+        # Keep the bound used by search_completions() up to date along the path
+        for ancestor in path:
+            if ancestor.max_count < node.count:
+                ancestor.max_count = node.count
+
+        if self.top_k > 0:
+            if node.completions is None:
+                node.completions = ()
+            self.update_cached_completions(path[:-1], sentence, node.count)
+
+        return self
+
+    def update_cached_completions(self, path, sentence: str, count: int):
+        """
+        Update the completions cached on the nodes above a sentence after its count increased.
+        Counts only increase, so the new top completions of a node are its old ones with the entry of the
+        sentence replaced, and the nodes off the path are unaffected.
+        Args:
+            path (list): the TrieNodes from the root down to the parent of the sentence's last node.
+            sentence (str): the full sentence from the root.
+            count (int): the new count of the sentence.
+        """
+        # Keep the rank of a sentence already cached somewhere along the path, so ties stay in the same order
+        rank = None
+        for node in path:
+            rank = next((entry[1] for entry in node.completions or () if entry[2] == sentence), None)
+            if rank is not None:
+                break
+        if rank is None:
+            rank = self.next_rank
+            self.next_rank += 1
+
+        entry = (-count, rank, sentence)
+        for node in path:
+            completions = [cached for cached in node.completions or () if cached[2] != sentence]
+            completions.append(entry)
+            node.completions = tuple(heapq.nsmallest(self.top_k, completions))
 
     def return_completions_from_node(self, node: TrieNode, prefix=""):
         """
-        Enumerate all possible sentence completions given a prefix.
+        Enumerate all possible sentence completions given a prefix, most frequent first.
         Args:
             node (TrieNode): the TrieNode at which to begin our search for possible completions.
             prefix (str): the prefix for which completions are enumerated.
@@ -77,7 +198,7 @@ class Trie(object):
             if len(node.children) > 0:
                 for child in node.children:
                     if child.is_end_of_sentence:
-                        sentences.append(prefix + sentence + child.char)
+                        sentences.append((child.count, prefix + sentence + child.char))
                     if len(child.children) > 0:
                         enumerate_sentences(child, sentence + child.char, sentences, prefix)
                     else:
@@ -88,7 +209,130 @@ class Trie(object):
         if node == None:
             return []
 
-        return enumerate_sentences(node, "", [], prefix)
+        # Sorting is stable, so sentences with equal counts keep their insertion order
+        sentences = sorted(enumerate_sentences(node, "", [], prefix), key=lambda item: -item[0])
+        return [sentence for _, sentence in sentences]
+
+    def search_completions(self, node: TrieNode, prefix="", n=3):
+        """
+        Best-first search for the n most frequent completions given a prefix.
+        Subtrees are expanded in order of the largest count they contain, so the search stops as soon as
+        n completions are found instead of enumerating every sentence below the node.
+        Args:
+            node (TrieNode): the TrieNode at which to begin our search for possible completions.
+            prefix (str): the prefix for which completions are returned.
+            n (int): number of completions to return.
+        Returns:
+            a list of at most n str, in the same order as return_completions_from_node().
+        """
+        if node == None:
+            return []
+
+        # Heap entries: (-count, path of child indices, kind, text, node)
+        # The path of child indices orders entries with equal counts by insertion order, and a subtree
+        # (kind 0) is popped before the sentence ending at its own node (kind 1).
+        completions = []
+        heap = [(-node.max_count, (), 0, prefix, node)]
+        while heap and len(completions) < n:
+            _, path, kind, text, current = heapq.heappop(heap)
+            if kind == 1:
+                completions.append(text)
+                continue
+
+            for index, child in enumerate(current.children):
+                child_path = path + (index,)
+                child_text = text + child.char
+                if child.is_end_of_sentence:
+                    heapq.heappush(heap, (-child.count, child_path, 1, child_text, child))
+                if child.children:
+                    heapq.heappush(heap, (-child.max_count, child_path, 0, child_text, child))
+
+        return completions
+
+    def cache_top_completions(self, k=3):
+        """
+        Store the k most frequent completions below every node on the node itself, so that a lookup only
+        costs O(len(prefix)) regardless of how many sentences share the prefix.
+        Cached completions are full sentences from the root, in the same order as return_completions_from_node().
+        Nodes with a single, non-terminal child share the child's tuple of completions.
+        Sentences added afterwards are ranked after the existing sentences with the same count.
+        Args:
+            k (int): maximum number of completions to store on each node.
+        Returns:
+            the updated Trie.
+        """
+        # Iterative post-order traversal, as sentences are too long for the default recursion limit.
+        # Cached entries are (-count, preorder index, sentence), so that sorting them ranks completions.
+        preorder_index = 0
+        path = []
+        stack = [(self.root, iter(self.root.children), [], None)]
+
+        while stack:
+            node, children, completions, own_entry = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                preorder_index += 1
+                path.append(child.char)
+                child_entry = None
+                if child.is_end_of_sentence:
+                    child_entry = (-child.count, preorder_index, "".join(path))
+                stack.append((child, iter(child.children), [], child_entry))
+                continue
+
+            stack.pop()
+            if len(node.children) == 1 and not node.children[0].is_end_of_sentence:
+                node.completions = node.children[0].completions
+            else:
+                node.completions = tuple(heapq.nsmallest(k, completions))
+
+            # Hand this node's sentence and completions up to its parent
+            if stack:
+                parent_completions = stack[-1][2]
+                if own_entry is not None:
+                    parent_completions.append(own_entry)
+                parent_completions.extend(node.completions)
+                path.pop()
+
+        self.top_k = k
+        self.next_rank = preorder_index + 1
+        return self
+
+    def top_completions(self, node: TrieNode, prefix="", n=3):
+        """
+        Return the n most frequent completions of a prefix, using the completions cached on the node when available.
+        Args:
+            node (TrieNode): the TrieNode reached by following the prefix from the root.
+            prefix (str): the prefix for which completions are returned.
+            n (int): number of completions to return.
+        Returns:
+            a list of at most n str, where each element is a possible completion of the prefix.
+        """
+        if node == None:
+            return []
+
+        if node.completions is not None and n <= self.top_k:
+            return [sentence for _, _, sentence in node.completions[:n]]
+
+        return self.search_completions(node, prefix=prefix, n=n)
+
+    def iter_children(self, node: TrieNode):
+        """
+        Iterate over the (character, child node) pairs of a node.
+        """
+        for child in node.children:
+            yield child.char, child
+
+    def max_count(self, node: TrieNode):
+        """
+        Return the largest count of a sentence ending at or below a node.
+        """
+        return node.max_count
+
+    def count(self, node: TrieNode):
+        """
+        Return the number of times the sentence ending at a node was added, 0 if no sentence ends there.
+        """
+        return node.count if node.is_end_of_sentence else 0
 
     def contains(self, root: TrieNode, sentence: str):
         """
@@ -101,6 +345,9 @@ class Trie(object):
             (True, last node visited) if a sentence exists in the trie, starting at a given node.
             (False, None) otherwise.
         """
+        # The empty sentence is the prefix of every sentence, as in CompactTrie
+        if not sentence:
+            return (True, root)
         character = sentence[0]
 
         for child in root.children:
@@ -111,6 +358,36 @@ class Trie(object):
 
         return (False, None)
 
+    def contains_many(self, root: TrieNode, sentences):
+        """
+        Look up many sentences at once, starting at the given node.
+        Sentences are walked in sorted order, so the walk down to the common prefix of consecutive sentences is
+        shared instead of repeated.
+        Args:
+            root (TrieNode): node at which to begin checking for existence of the sentences.
+            sentences (list): strings to check for existence in the trie.
+        Returns:
+            list of the last node visited for each sentence, in the order of sentences, None where a sentence
+            does not exist in the trie.
+        """
+        nodes = [None] * len(sentences)
+        # path[i] is the node reached after the first i chars of the previous sentence
+        path = [root]
+        previous = ""
+        for index in sorted(range(len(sentences)), key=sentences.__getitem__):
+            sentence = sentences[index]
+            common = min(len(os.path.commonprefix([previous, sentence])), len(path) - 1)
+            del path[common + 1:]
+            node = path[-1]
+            for character in sentence[common:]:
+                node = next((child for child in node.children if child.char == character), None)
+                if node is None:
+                    break
+                path.append(node)
+            nodes[index] = node
+            previous = sentence
+        return nodes
+
 
 def extract_sentences_from_json(file_path: str):
     """
@@ -133,7 +410,7 @@ def extract_sentences_from_json(file_path: str):
             # If the text contains multiple sentences, add each individual sentence to the dataset to be added to the trie
             sub_sentences = sent_tokenize(text)
             if len(sub_sentences) > 1:
-                sentences.extend(sent_tokenize(text))
+                sentences.extend(sub_sentences)
 
     return sentences
 
@@ -150,35 +427,83 @@ def save_sentences_to_file(sentences: list, file_path: str):
             file_handler.write(sentence + "\n")
 
 
-def initialize_prefix_trie():
+def load_pickled_trie(file_path):
+    """
+    Load a pickled Trie, unless it was pickled with another version of its format.
+    Returns:
+        Trie object, or None if the file holds another version, or cannot be unpickled by this version.
+    """
+    try:
+        with open(file_path, "rb") as file_handler:
+            trie = pickle.load(file_handler)
+    except (pickle.UnpicklingError, AttributeError, EOFError, ImportError) as e:
+        logger.warning("cannot load the pickled trie: %s", e)
+        return None
+    version = getattr(trie, "format_version", None)
+    if not isinstance(trie, Trie) or version != TRIE_FORMAT_VERSION:
+        logger.warning("pickled trie has format version %s instead of %s.", version, TRIE_FORMAT_VERSION)
+        return None
+    return trie
+
+
+def initialize_prefix_trie(top_k=0, backend="object"):
     """
     Create or load a prefix trie from a given dataset.
+    Args:
+        top_k (int): if greater than 0, cache the top_k completions on every node of the trie.
+        backend (str): "object" for a Trie of TrieNode objects, "compact" for an array-backed CompactTrie,
+            or "mmap" for a CompactTrie memory-mapped from a binary file.
     Returns:
-        Trie object.
+        Trie or CompactTrie object.
     """
     # Initialize the prefix trie model for autocompletion
     trie_file_path = b"data/trie.obj"
+    compact_trie_file_path = "data/trie.bin"
     sentences_file_path = "data/sentences.txt"
 
+    # The memory-mapped trie is queried in place, so there is nothing to build or unpickle
+    if backend == "mmap" and os.path.isfile(compact_trie_file_path):
+        try:
+            return CompactTrie.load(compact_trie_file_path)
+        except ValueError as e:
+            logger.warning("rebuilding trie file: %s", e)
+
     # If pickled file with trie exists, load the model. Else, create the model from the sentences
+    trie = None
+    stale = False
     if os.path.isfile(trie_file_path):
-        file = open(trie_file_path, 'rb')
-        trie = pickle.load(file)
+        trie = load_pickled_trie(trie_file_path)
+        stale = trie is None
+    if trie is not None:
         root = trie.root
     else:
-        root = TrieNode('')
-        trie = Trie(root)
-
-        sentences = extract_sentences_from_json("data/sample_conversations.json")
-        if not os.path.isfile(sentences_file_path):
-            save_sentences_to_file(sentences, sentences_file_path)
-
-        for sentence in sentences:
-            trie.add_sentence(root, sentence)
+        if stale and os.path.isfile(sentences_file_path):
+            # The sentences were already tokenized from the conversations when the stale trie was built
+            logger.info("rebuilding the pickled trie from %s.", sentences_file_path)
+            counts = count_sentences_file(sentences_file_path)
+        else:
+            # Stream the conversations through a pool of tokenizing processes, then build the trie from the counts
+            write_sentences = not os.path.isfile(sentences_file_path)
+            counts = count_sentences("data/sample_conversations.json",
+                                     sentences_file_path=sentences_file_path if write_sentences else None)
+        trie = Trie.from_counts(counts)
+        root = trie.root
+        del counts
 
         sys.setrecursionlimit(5000)
         filehandler = open(trie_file_path, "wb")
         pickle.dump(trie, filehandler)
         filehandler.close()
-    
+
+    # The compact trie answers lookups with a bounded search, so it does not cache completions
+    if backend == "mmap":
+        CompactTrie.from_trie(trie).save(compact_trie_file_path)
+        return CompactTrie.load(compact_trie_file_path)
+    if backend == "compact":
+        return CompactTrie.from_trie(trie)
+
+    # Cache completions after pickling, so the pickled trie stays small and k can change between runs
+    if top_k > 0:
+        trie.cache_top_completions(top_k)
+
     return trie
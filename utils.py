@@ -51,9 +51,23 @@ def one_hot_encode(indices, num_classes):
     return np.eye(num_classes)[indices]
 
 
-def batch_generator(sequence, batch_size=64, seq_len=64, one_hot_features=False, one_hot_labels=False):
+def batch_generator(sequence, batch_size=64, seq_len=64, one_hot_features=False, one_hot_labels=False,
+                    sparse_labels=False):
     """
     Batch generator for training and validation.
+    The sequence is read as batch_size rows in parallel, and each batch is the next seq_len chars of every row, so
+    that the rnn states carry over from one batch to the next.  Batches are sliced from the rows as they are
+    yielded, and only a batch is ever one-hot encoded, so memory does not grow with the length of the sequence.
+    Args:
+        sequence (array): char ids of the text.
+        batch_size (int): number of rows.
+        seq_len (int): number of chars of every row per batch.
+        one_hot_features (bool): one-hot encode the inputs.
+        one_hot_labels (bool): one-hot encode the labels, for a categorical crossentropy loss.
+        sparse_labels (bool): yield the labels as char ids of shape (batch_size, seq_len, 1), for a sparse
+            categorical crossentropy loss.
+    Yields:
+        (inputs, labels) batches, forever.
     """
     # Calculate effective length of text to use
     num_batches = (len(sequence) - 1) // (batch_size * seq_len)
@@ -63,23 +77,26 @@ def batch_generator(sequence, batch_size=64, seq_len=64, one_hot_features=False,
     rounded_len = num_batches * batch_size * seq_len
     logger.info("effective text length: %s.", rounded_len)
 
+    # Views of the sequence, not copies
     x = np.reshape(sequence[: rounded_len], [batch_size, num_batches * seq_len])
-    if one_hot_features:
-        x = one_hot_encode(x, VOCAB_SIZE)
     logger.info("x shape: %s.", x.shape)
-
     y = np.reshape(sequence[1: rounded_len + 1], [batch_size, num_batches * seq_len])
-    if one_hot_labels:
-        y = one_hot_encode(y, VOCAB_SIZE)
     logger.info("y shape: %s.", y.shape)
 
     epoch = 0
     while True:
-        # Roll so that no need to reset rnn states over epochs
-        x_epoch = np.split(np.roll(x, -epoch, axis=0), num_batches, axis=1)
-        y_epoch = np.split(np.roll(y, -epoch, axis=0), num_batches, axis=1)
         for batch in range(num_batches):
-            yield x_epoch[batch], y_epoch[batch]
+            columns = slice(batch * seq_len, (batch + 1) * seq_len)
+            # Roll the rows so that no need to reset rnn states over epochs
+            x_batch = np.roll(x[:, columns], -epoch, axis=0)
+            y_batch = np.roll(y[:, columns], -epoch, axis=0)
+            if one_hot_features:
+                x_batch = one_hot_encode(x_batch, VOCAB_SIZE)
+            if one_hot_labels:
+                y_batch = one_hot_encode(y_batch, VOCAB_SIZE)
+            elif sparse_labels:
+                y_batch = y_batch[:, :, np.newaxis]
+            yield x_batch, y_batch
         epoch += 1
 
 # Text generation
@@ -111,6 +128,22 @@ def sample_from_probs(probs, top_n=1):
     sampled_index = np.random.choice(len(probs), p=probs)
     return sampled_index
 
+
+def sample_from_probs_batch(probs, top_n=1):
+    """
+    Truncated weighted random choice for every row of a (batch_size, vocab_size) array at once.
+    Set top_n=1 to sample only highest probability choices.
+    """
+    # Need 64 floating point precision
+    probs = np.array(probs, dtype=np.float64)
+    # Set probabilities after top_n to 0 in every row
+    probs[np.arange(len(probs))[:, None], np.argsort(probs, axis=1)[:, :-top_n]] = 0
+    # Sample by inverting the cumulative distribution of each row
+    cumulative = np.cumsum(probs, axis=1)
+    thresholds = np.random.random_sample(len(probs)) * cumulative[:, -1]
+    sampled_indices = (cumulative <= thresholds[:, None]).sum(axis=1)
+    return np.minimum(sampled_indices, probs.shape[1] - 1)
+
 # Main - used for training
 
 def main(framework, train_main):
@@ -143,6 +176,9 @@ def main(framework, train_main):
                               help="max norm to clip gradient (default: %(default)s)")
     train_parser.add_argument("--batch-size", type=int, default=64,
                               help="training batch size (default: %(default)s)")
+    train_parser.add_argument("--sparse-labels", action="store_true",
+                              help="train on char ids with a sparse categorical crossentropy loss, instead of "
+                                   "one-hot encoded labels")
     train_parser.add_argument("--num-epochs", type=int, default=32,
                               help="number of epochs for training (default: %(default)s)")
     train_parser.add_argument("--log-path", default=os.path.join(os.path.dirname(__file__), "main.log"),